@@ -2,19 +2,33 @@
 This  file contains the flask factory function which will create an app.
 """
 
+import hashlib
+
 from flask import Flask
-from app.config import Config
-from app.database_client import DatabaseClient
+from app.config import Config, PROFILES, apply_profile
+from app.database_client import create_database_client
+from app.ingest_queue import WriteBehindQueue
+from app.jobs import JobManager
+from app.config_store import ConfigFile, parse_videos, parse_input_fields
 
 
-def create_app(conf=Config):
+def create_app(conf=Config, profile=None):
     """
     Function to create an app.
     Using a factory function like this allows for better test handling (
     creating apps with certain parameters for testing and other parameters
     for production, without changing the code inbetween).
 
+    The profile decides which pages the app serves: 'ingest' only has the
+    annotators' pages and the save endpoints, 'analytics' only the
+    researcher's pages, and 'all' both. The control pages (role selection,
+    configuration changes, status) are part of every profile. Links to pages
+    of the other profile are still generated, so a proxy in front of the
+    apps can send them to the right one.
+
     :param conf: The configuration class
+    :param profile: 'ingest', 'analytics' or 'all', defaults to the PROFILE
+    config value
     :return: The app
     """
     # Initialise the flask app:
@@ -26,29 +40,110 @@ def create_app(conf=Config):
     # Load app into Flask's app_context
     app.app_context().push()
 
-    # Register blueprints:
-    from app.user import bp as user_bp
-    app.register_blueprint(user_bp)
+    # Sizing defaults of the profile:
+    apply_profile(app.config, profile or app.config['PROFILE'])
 
+    # Register the blueprints of the profile:
+    from app.user import bp as user_bp
     from app.researcher import bp as researcher_bp
-    app.register_blueprint(researcher_bp)
-
     from app.control import bp as control_bp
-    app.register_blueprint(control_bp)
+    blueprints = {'user': user_bp, 'researcher': researcher_bp,
+                  'control': control_bp}
+    served = PROFILES[app.config['PROFILE']]['blueprints']
+    for name in served:
+        app.register_blueprint(blueprints[name])
+    _link_other_profiles(app, blueprints, served)
 
     # Initialise the database client:
-    app.d = DatabaseClient()
+    app.d = create_database_client()
+    # Queue through which annotations are written to the database:
+    app.ingest = WriteBehindQueue(
+        sink=lambda posts: app.d.insert_posts(posts),
+        batch_size=app.config['INGEST_BATCH_SIZE'],
+        flush_interval=app.config['INGEST_FLUSH_INTERVAL'],
+        max_size=app.config['INGEST_QUEUE_SIZE'],
+        max_attempts=app.config['INGEST_MAX_ATTEMPTS'],
+        on_flush=lambda posts: _signal_flushed_posts(app, posts))
+    # Prefix of the cache keys of this app (see cache_key()), so that other
+    # apps sharing the cache file do not read its results. Apps running from
+    # the same folder (e.g. the ingest and analytics profiles) share it:
+    app.cache_namespace = app.config['CACHE_NAMESPACE'] or hashlib.sha1(
+        app.instance_path.encode('utf-8')).hexdigest()[:12]
+    # Process pool for the clustering, sharing the outcomes of the jobs with
+    # the other worker processes through the cache:
+    app.jobs = JobManager(max_workers=app.config['CLUSTER_WORKERS'],
+                          keep=app.config['CLUSTER_JOBS_KEEP'],
+                          store=app.config['CACHE'],
+                          running_timeout=app.config['CLUSTER_JOB_TIMEOUT'],
+                          namespace=app.cache_namespace + '_')
     # File where the videos are stored:
     app.vid_file = 'app/user/video_conf.txt'
     # File where the user instructions are stored:
     app.user_instructions_file = 'app/user/user_instructions.txt'
     # File where the input fields are stored:
     app.input_fields = 'app/user/input_conf.txt'
+    # Cached access to these files:
+    app.vid_store = ConfigFile(app.vid_file, parse_videos)
+    app.user_instructions_store = ConfigFile(app.user_instructions_file,
+                                             lambda text: text)
+    app.input_fields_store = ConfigFile(app.input_fields, parse_input_fields)
     # All the databases that are available:
-    app.dbs = {'prod': 'Production', 'dev': 'Development', 'local': 'Local'}
+    app.dbs = {'prod': 'Production', 'dev': 'Development', 'local': 'Local',
+               'sqlite': 'Local (SQLite)'}
     # The default page for the researcher:
     app.researcher_default = 'researcher.clusters'
     # The default page for the user:
     app.user_default = 'user.userinstructions'
 
+    # Time every request (and profile a sample of them):
+    from app.metrics import init_app as init_metrics
+    init_metrics(app)
+
+    # Register the command line commands:
+    from app.commands import register_commands
+    register_commands(app)
+
     return app
+
+
+def _link_other_profiles(app, blueprints, served):
+    """
+    Let url_for() build the URLs of pages that belong to blueprints this app
+    does not serve, using a map of the URLs of all blueprints.
+    :param app: The app
+    :param blueprints: Dictionary of all blueprints by name
+    :param served: Names of the blueprints registered on the app
+    :return: None
+    """
+    others = [name for name in blueprints if name not in served]
+    if not others:
+        return
+    full = Flask(__name__)
+    for blueprint in blueprints.values():
+        full.register_blueprint(blueprint)
+    adapter = full.url_map.bind('')
+
+    def build_other(error, endpoint, values):
+        if endpoint.split('.')[0] not in others:
+            return None
+        # url_for() adds its own options (_external, _anchor, ...) to values
+        anchor = values.get('_anchor')
+        url = adapter.build(endpoint, dict(
+            (k, v) for k, v in values.items() if not k.startswith('_')))
+        return url + '#' + anchor if anchor else url
+
+    app.url_build_error_handlers.append(build_other)
+
+
+def _signal_flushed_posts(app, posts):
+    """
+    Mark the videos of posts that have been written to the database as
+    modified. Runs in the flusher thread, hence the app context.
+    :param app: The app
+    :param posts: List of the written posts
+    :return: None
+    """
+    from app.functionalities import signal_data_modification
+    with app.app_context():
+        for videoid in set(p['videoid'] for p in posts):
+            signal_data_modification(videoid)
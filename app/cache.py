@@ -0,0 +1,492 @@
+"""
+This file contains the cache backends of the app. All of them implement the
+werkzeug cache interface (get, set, delete, clear, ...), so they can be used
+as Config.CACHE instead of a SimpleCache.
+
+- LRUCache: in-process cache bounded by the size of its values, evicting
+  the least recently used values.
+- SQLiteCache: cache in a SQLite file, shared by all worker processes on a
+  host and also bounded by size. As the values are pickled, the file is
+  only readable by its owner and a file owned by another user is refused.
+- TieredCache: an LRUCache in front of a SQLiteCache. Values are read from
+  the fast in-process tier as long as the shared tier has the same version
+  of the value, so changes made by one worker are seen by all others.
+
+add(), inc() and dec() are atomic in all of them, also across the processes
+sharing a SQLiteCache, so they can be used for counters and markers.
+
+Each cache counts hits, misses and evictions, see stats().
+"""
+import os
+import pickle
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from werkzeug.contrib.cache import BaseCache
+
+
+def _private_file(path):
+    """
+    Create a file (and its directory) that only the current user can access,
+    or check that the existing file belongs to the current user, so that
+    nobody else can plant the pickled values the cache loads.
+    :param path: Path of the file
+    :return: None
+    :raise PermissionError: If the file or its SQLite journal belongs to
+    another user
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(directory):
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+    try:
+        os.close(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600))
+    except FileExistsError:
+        pass
+    if not hasattr(os, 'geteuid'):
+        return
+    for name in [path, path + '-wal', path + '-shm']:
+        if os.path.exists(name) and os.stat(name).st_uid != os.geteuid():
+            raise PermissionError('The cache file {} belongs to another '
+                                  'user.'.format(name))
+
+
+def _expires(timeout):
+    """
+    :param timeout: Timeout in seconds, 0 or None for no timeout
+    :return: Time at which a value with this timeout expires, or None
+    """
+    if not timeout or timeout > 1e10:
+        return None
+    return time.time() + timeout
+
+
+class LRUCache(BaseCache):
+    """
+    In-process cache holding pickled values up to a total size, evicting the
+    least recently used values first.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 ** 2, default_timeout=0):
+        BaseCache.__init__(self, default_timeout)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # key: (pickled value, expiry time, version)
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_entry(self, key):
+        """
+        :param key: The key
+        :return: Tuple (pickled value, version), or None if the key is
+        missing or expired
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or (entry[1] is not None and
+                                 entry[1] < time.time()):
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0], entry[2]
+
+    def put_entry(self, key, data, expires=None, version=None):
+        """
+        Store a pickled value.
+        :param key: The key
+        :param data: The pickled value
+        :param expires: Expiry time (optional)
+        :param version: Version of the value (optional)
+        :return: None
+        """
+        with self._lock:
+            self._put(key, data, expires, version)
+
+    def _put(self, key, data, expires, version):
+        """
+        Store a pickled value. Must be called with the lock held.
+        """
+        if key in self._entries:
+            self._remove(key)
+        if len(data) > self.max_bytes:
+            return
+        self._entries[key] = (data, expires, version)
+        self._bytes += len(data)
+        while self._bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def _remove(self, key):
+        """
+        Remove an entry. Must be called with the lock held.
+        """
+        data = self._entries.pop(key)[0]
+        self._bytes -= len(data)
+
+    def get(self, key):
+        entry = self.get_entry(key)
+        return None if entry is None else pickle.loads(entry[0])
+
+    def set(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.default_timeout
+        self.put_entry(key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+                       _expires(timeout))
+        return True
+
+    def add(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.default_timeout
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            if self._alive(key):
+                return False
+            self._put(key, data, _expires(timeout), None)
+        return True
+
+    def inc(self, key, delta=1):
+        with self._lock:
+            entry = self._entries.get(key) if self._alive(key) else None
+            value = (pickle.loads(entry[0]) if entry else 0) + delta
+            self._put(key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+                      entry[1] if entry else None, None)
+        return value
+
+    def dec(self, key, delta=1):
+        return self.inc(key, -delta)
+
+    def has(self, key):
+        with self._lock:
+            return self._alive(key)
+
+    def _alive(self, key):
+        """
+        Must be called with the lock held.
+        :return: Whether the key is stored and not expired
+        """
+        entry = self._entries.get(key)
+        return entry is not None and (entry[1] is None or
+                                      entry[1] >= time.time())
+
+    def delete(self, key):
+        with self._lock:
+            if key not in self._entries:
+                return False
+            self._remove(key)
+            return True
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+        return True
+
+    def stats(self):
+        """
+        :return: Dictionary with the counters of the cache
+        """
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self._bytes,
+                    'max_bytes': self.max_bytes, 'hits': self.hits,
+                    'misses': self.misses, 'evictions': self.evictions}
+
+
+class SQLiteCache(BaseCache):
+    """
+    Cache stored in a SQLite file, shared by all processes using the same
+    file, holding values up to a total size and evicting the least recently
+    used values first.
+    """
+
+    def __init__(self, path, max_bytes=512 * 1024 ** 2, default_timeout=0):
+        BaseCache.__init__(self, default_timeout)
+        self.path = path
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _connection(self):
+        """
+        Get the connection of the current thread, connecting if this thread
+        (or this process, after a fork) has no connection yet.
+        :return: The connection
+        """
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            _private_file(self.path)
+            connection = sqlite3.connect(self.path, timeout=10,
+                                         isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS cache ('
+                               'key TEXT PRIMARY KEY, value BLOB, '
+                               'size INTEGER, expires REAL, accessed REAL, '
+                               'version TEXT)')
+            connection.execute('CREATE INDEX IF NOT EXISTS cache_accessed '
+                               'ON cache (accessed)')
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def get_version(self, key):
+        """
+        :param key: The key
+        :return: Version of the value stored under key, or None if the key is
+        missing or expired
+        """
+        row = self._connection().execute(
+            'SELECT version FROM cache WHERE key = ? AND '
+            '(expires IS NULL OR expires >= ?)',
+            (key, time.time())).fetchone()
+        return None if row is None else row[0]
+
+    def get_entry(self, key):
+        """
+        :param key: The key
+        :return: Tuple (pickled value, version, expiry time), or None if the
+        key is missing or expired
+        """
+        connection = self._connection()
+        now = time.time()
+        row = connection.execute(
+            'SELECT value, version, expires FROM cache WHERE key = ? AND '
+            '(expires IS NULL OR expires >= ?)', (key, now)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        connection.execute('UPDATE cache SET accessed = ? WHERE key = ?',
+                           (now, key))
+        return bytes(row[0]), row[1], row[2]
+
+    def put_entry(self, key, data, expires=None):
+        """
+        Store a pickled value.
+        :param key: The key
+        :param data: The pickled value
+        :param expires: Expiry time (optional)
+        :return: The version of the stored value
+        """
+        return self._put(self._connection(), key, data, expires)
+
+    def _put(self, connection, key, data, expires):
+        """
+        Store a pickled value, see put_entry().
+        """
+        version = uuid.uuid4().hex
+        connection.execute(
+            'INSERT OR REPLACE INTO cache (key, value, size, expires, '
+            'accessed, version) VALUES (?, ?, ?, ?, ?, ?)',
+            (key, sqlite3.Binary(data), len(data), expires, time.time(),
+             version))
+        self._evict(connection)
+        return version
+
+    @contextmanager
+    def _transaction(self):
+        """
+        Run a with block in a transaction that holds the write lock of the
+        file from the start, so that no other process can change the cache
+        between reading and writing a value.
+        :return: The connection
+        """
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield connection
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+    def _evict(self, connection):
+        """
+        Remove expired values, and the least recently used values while the
+        cache is larger than max_bytes.
+        """
+        connection.execute('DELETE FROM cache WHERE expires < ?',
+                           (time.time(),))
+        total = connection.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM cache').fetchone()[0]
+        while total > self.max_bytes:
+            row = connection.execute(
+                'SELECT key, size FROM cache ORDER BY accessed '
+                'LIMIT 1').fetchone()
+            if row is None:
+                break
+            connection.execute('DELETE FROM cache WHERE key = ?', (row[0],))
+            total -= row[1]
+            self.evictions += 1
+
+    def get(self, key):
+        entry = self.get_entry(key)
+        return None if entry is None else pickle.loads(entry[0])
+
+    def set(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.default_timeout
+        self.put_entry(key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+                       _expires(timeout))
+        return True
+
+    def add(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.default_timeout
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        with self._transaction() as connection:
+            if self._row(connection, key) is not None:
+                return False
+            self._put(connection, key, data, _expires(timeout))
+        return True
+
+    def inc(self, key, delta=1):
+        return self.inc_entry(key, delta)[0]
+
+    def inc_entry(self, key, delta=1):
+        """
+        Atomically add to a number, which starts at 0 if the key is missing.
+        :param key: The key
+        :param delta: The number to add
+        :return: Tuple (new value, pickled new value, version, expiry time)
+        """
+        with self._transaction() as connection:
+            row = self._row(connection, key)
+            value = (pickle.loads(bytes(row[0])) if row else 0) + delta
+            data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+            expires = row[1] if row else None
+            version = self._put(connection, key, data, expires)
+        return value, data, version, expires
+
+    def dec(self, key, delta=1):
+        return self.inc(key, -delta)
+
+    @staticmethod
+    def _row(connection, key):
+        """
+        :return: The value and expiry time stored under key, or None if the
+        key is missing or expired
+        """
+        return connection.execute(
+            'SELECT value, expires FROM cache WHERE key = ? AND '
+            '(expires IS NULL OR expires >= ?)',
+            (key, time.time())).fetchone()
+
+    def has(self, key):
+        return self.get_version(key) is not None
+
+    def delete(self, key):
+        cursor = self._connection().execute('DELETE FROM cache WHERE key = ?',
+                                            (key,))
+        return cursor.rowcount > 0
+
+    def clear(self):
+        self._connection().execute('DELETE FROM cache')
+        return True
+
+    def stats(self):
+        """
+        :return: Dictionary with the counters of the cache (the counters are
+        those of this process, the size is that of the shared file)
+        """
+        entries, size = self._connection().execute(
+            'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache').fetchone()
+        return {'entries': entries, 'bytes': size,
+                'max_bytes': self.max_bytes, 'hits': self.hits,
+                'misses': self.misses, 'evictions': self.evictions}
+
+
+class TieredCache(BaseCache):
+    """
+    In-process LRUCache in front of a shared SQLiteCache.
+
+    A value is only taken from the in-process tier if the shared tier still
+    has the same version of it, which is a small query that does not load
+    the value. Otherwise the value is loaded from the shared tier.
+    """
+
+    def __init__(self, path, max_bytes=512 * 1024 ** 2,
+                 local_max_bytes=64 * 1024 ** 2, default_timeout=0):
+        BaseCache.__init__(self, default_timeout)
+        self.local = LRUCache(local_max_bytes, default_timeout)
+        self.shared = SQLiteCache(path, max_bytes, default_timeout)
+
+    def get(self, key):
+        version = self.shared.get_version(key)
+        if version is None:
+            self.local.delete(key)
+            self.shared.misses += 1
+            return None
+        entry = self.local.get_entry(key)
+        if entry is not None and entry[1] == version:
+            return pickle.loads(entry[0])
+        entry = self.shared.get_entry(key)
+        if entry is None:
+            return None
+        data, version, expires = entry
+        self.local.put_entry(key, data, expires, version)
+        return pickle.loads(data)
+
+    def set(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.default_timeout
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        expires = _expires(timeout)
+        version = self.shared.put_entry(key, data, expires)
+        self.local.put_entry(key, data, expires, version)
+        return True
+
+    def add(self, key, value, timeout=None):
+        return self.shared.add(key, value, timeout)
+
+    def inc(self, key, delta=1):
+        value, data, version, expires = self.shared.inc_entry(key, delta)
+        self.local.put_entry(key, data, expires, version)
+        return value
+
+    def dec(self, key, delta=1):
+        return self.inc(key, -delta)
+
+    def has(self, key):
+        return self.shared.has(key)
+
+    def delete(self, key):
+        self.local.delete(key)
+        return self.shared.delete(key)
+
+    def clear(self):
+        self.local.clear()
+        return self.shared.clear()
+
+    def stats(self):
+        """
+        :return: Dictionary with the counters of both tiers
+        """
+        return {'local': self.local.stats(), 'shared': self.shared.stats()}
+
+
+def create_cache(cache_type, path=None, max_bytes=512 * 1024 ** 2,
+                 local_max_bytes=64 * 1024 ** 2):
+    """
+    Create the cache of the given type.
+    :param cache_type: 'tiered', 'sqlite' or 'lru'
+    :param path: Path of the SQLite file for 'tiered' and 'sqlite'
+    :param max_bytes: Maximum size of the shared tier (or of the LRUCache)
+    :param local_max_bytes: Maximum size of the in-process tier of 'tiered'
+    :return: The cache
+    """
+    if cache_type == 'lru':
+        return LRUCache(max_bytes)
+    if cache_type == 'sqlite':
+        return SQLiteCache(path, max_bytes)
+    return TieredCache(path, max_bytes, local_max_bytes)
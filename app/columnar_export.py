@@ -0,0 +1,154 @@
+"""
+This file contains the functions to export data in columnar formats that
+keep the types of the columns: Parquet and Arrow IPC streams for the raw
+posts, and compressed NumPy .npz archives for the resampled series.
+
+Parquet and Arrow need the optional package pyarrow
+(pip install pyarrow).
+"""
+from io import BytesIO
+
+import numpy as np
+
+from app.functionalities import resample_users
+
+# Mimetypes and file extensions of the columnar formats:
+FORMATS = {'parquet': ('application/octet-stream', 'parquet'),
+           'arrow': ('application/vnd.apache.arrow.stream', 'arrows'),
+           'npz': ('application/octet-stream', 'npz')}
+
+
+class ChunkSink(object):
+    """
+    Writable file-like object collecting what is written to it until it is
+    drained, so that a file can be sent while it is being written.
+    """
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+        self.closed = False
+
+    def write(self, data):
+        data = bytes(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        """
+        :return: Everything written since the last call, as bytes
+        """
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _to_int(value):
+    value = _to_float(value)
+    return None if value is None or value != value else int(value)
+
+
+def _to_str(value):
+    return None if value is None else str(value)
+
+
+def stream_columnar(posts, columns, fmt, batch_size=10000):
+    """
+    Create a generator writing posts as a Parquet file or Arrow IPC stream,
+    one record batch (or row group) of batch_size posts at a time.
+    :param posts: Iterable of posts, e.g. a database cursor
+    :param columns: The columns to write
+    :param fmt: 'parquet' or 'arrow'
+    :param batch_size: Number of posts per batch
+    :return: Generator yielding the file in chunks of bytes
+    :raises ImportError: If pyarrow is not installed
+    """
+    import pyarrow as pa
+    if fmt == 'parquet':
+        import pyarrow.parquet as pq
+
+    types = {'videoid': (pa.string(), _to_str),
+             'username': (pa.string(), _to_str),
+             'date': (pa.int64(), _to_int)}
+    default_type = (pa.float64(), _to_float)
+    column_types = [types.get(c, default_type) for c in columns]
+    schema = pa.schema([pa.field(c, t) for c, (t, _) in
+                        zip(columns, column_types)])
+
+    def to_batch(batch):
+        arrays = [pa.array([convert(p.get(c)) for p in batch], type=t)
+                  for c, (t, convert) in zip(columns, column_types)]
+        return pa.RecordBatch.from_arrays(arrays, names=columns)
+
+    def generate():
+        sink = ChunkSink()
+        if fmt == 'parquet':
+            writer = pq.ParquetWriter(sink, schema)
+            write = lambda b: writer.write_table(pa.Table.from_batches([b]))
+        else:
+            writer = pa.RecordBatchStreamWriter(sink, schema)
+            write = writer.write_batch
+
+        batch = []
+        for post in posts:
+            batch.append(post)
+            if len(batch) >= batch_size:
+                write(to_batch(batch))
+                batch = []
+                yield sink.drain()
+        if batch:
+            write(to_batch(batch))
+        writer.close()
+        yield sink.drain()
+
+    return generate()
+
+
+def resampled_npz(videoid):
+    """
+    Write the resampled users x time matrices of every variable of a video
+    to a compressed .npz archive. For each variable the archive contains the
+    arrays '<variable>' (the matrix), '<variable>_timestamps' (the grid) and
+    '<variable>_usernames' (the user of each row).
+    :param videoid: The id of the video
+    :return: The archive as bytes, or None if there is no data for the video
+    """
+    resampled = resample_users(videoid)
+    if resampled is None:
+        return None
+
+    arrays = {}
+    for variable in resampled['variable_list']:
+        if variable != resampled['variable']:
+            resampled = resample_users(videoid, variable)
+        arrays[variable] = resampled['matrix']
+        arrays[variable + '_timestamps'] = resampled['xs']
+        arrays[variable + '_usernames'] = np.array(resampled['usernames'],
+                                                   dtype=str)
+
+    buffer = BytesIO()
+    np.savez_compressed(buffer, **arrays)
+    return buffer.getvalue()
@@ -0,0 +1,41 @@
+"""
+This file contains the command line commands of the app, which can be run
+with 'flask <command>' (with FLASK_APP set as described in the README).
+"""
+
+import click
+from flask import current_app
+
+from app.functionalities import cache_key
+
+
+def register_commands(app):
+    """
+    Register the commands with an app.
+    :param app: The app
+    :return: None
+    """
+    app.cli.add_command(rebuild_series)
+    app.cli.add_command(migrate_types)
+
+
+@click.command('rebuild-series')
+def rebuild_series():
+    """
+    Regenerate the series store from the raw posts in the database.
+    """
+    n = current_app.d.rebuild_series()
+    click.echo('Rebuilt the series store from ' + str(n) + ' posts.')
+
+
+@click.command('migrate-types')
+def migrate_types():
+    """
+    Convert the timestamps, dates and slider values that older versions
+    saved as strings to numbers.
+    """
+    n = current_app.d.migrate_types()
+    # Range queries find the converted posts now (see untyped_posts())
+    for field in ('timestamp', 'date'):
+        current_app.config['CACHE'].delete(cache_key('untyped_' + field))
+    click.echo('Converted ' + str(n) + ' posts.')
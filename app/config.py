@@ -3,7 +3,46 @@ This file specifies how the flask app is configured.
 """
 
 import os
-from werkzeug.contrib.cache import SimpleCache
+
+from app.cache import create_cache
+
+CORES = os.cpu_count() or 1
+
+# The profiles the app can be created with (see create_app()): the
+# blueprints they serve and their default sizing, i.e. the number of gunicorn
+# worker processes, threads per worker and processes computing clusterings.
+# The annotators' pages and save endpoints are light and latency-sensitive,
+# so the ingest profile runs many workers with several threads, while the
+# analysis is CPU-heavy and gets few workers with most cores for clustering.
+# Every worker has its own clustering pool, so a CLUSTER_WORKERS of None
+# divides the cores of the host among the workers (see apply_profile()).
+PROFILES = {
+    'ingest': {'blueprints': ['user', 'control'],
+               'WORKERS': 2 * CORES + 1, 'THREADS': 4, 'CLUSTER_WORKERS': 1},
+    'analytics': {'blueprints': ['researcher', 'control'],
+                  'WORKERS': 2, 'THREADS': 1, 'CLUSTER_WORKERS': None},
+    'all': {'blueprints': ['user', 'researcher', 'control'],
+            'WORKERS': CORES + 1, 'THREADS': 2, 'CLUSTER_WORKERS': None}}
+
+
+def apply_profile(config, profile):
+    """
+    Set the sizing settings that are not configured (None) to the defaults
+    of a profile.
+    :param config: Dictionary-like configuration, e.g. app.config
+    :param profile: 'ingest', 'analytics' or 'all'
+    :return: None
+    :raises ValueError: If the profile does not exist
+    """
+    if profile not in PROFILES:
+        raise ValueError('Unknown profile "' + str(profile) + '", use one of '
+                         + ', '.join(sorted(PROFILES)) + '.')
+    config['PROFILE'] = profile
+    for key in ['WORKERS', 'THREADS', 'CLUSTER_WORKERS']:
+        if config.get(key) is None:
+            config[key] = PROFILES[profile][key]
+    if config['CLUSTER_WORKERS'] is None:
+        config['CLUSTER_WORKERS'] = max(1, CORES // config['WORKERS'])
 
 
 class Config(object):
@@ -12,12 +51,102 @@ class Config(object):
     """
     SESSION_TYPE = 'memcached'
 
+    # Which part of the app to run: 'ingest' (the annotators' pages and the
+    # save endpoints), 'analytics' (the researcher's pages) or 'all', and
+    # the number of gunicorn worker processes and threads per worker
+    # (defaulting to the ones of the profile, see PROFILES):
+    PROFILE = os.environ.get('APP_PROFILE') or 'all'
+    WORKERS = int(os.environ.get('WORKERS') or 0) or None
+    THREADS = int(os.environ.get('THREADS') or 0) or None
+
     # If there is an environment variable set with a secret key, use it:
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'very_secret_key'
 
     # The database used can be the production database, the development
-    # database (both online) or local if the user has MongoDB running locally.
-    # Values DB can take are hence 'prod', 'dev', or 'local'. Defaults
-    # to 'prod'.
+    # database (both online), local if the user has MongoDB running locally,
+    # or sqlite for a database file that needs no database server.
+    # Values DB can take are hence 'prod', 'dev', 'local' or 'sqlite'.
+    # Defaults to 'prod'.
     DB = os.environ.get('DB') or 'prod'
-    CACHE = SimpleCache(default_timeout=1000000000000000000000)
+    # File of the sqlite database:
+    SQLITE_PATH = os.environ.get('SQLITE_PATH') or 'videoannotator.sqlite'
+
+    # Connection pool of each database client (one per database and worker
+    # process): maximum and minimum number of connections, and timeouts in
+    # milliseconds for connecting, for finding a server, for a response and
+    # for waiting for a free connection (None for no timeout).
+    MONGO_MAX_POOL_SIZE = int(os.environ.get('MONGO_MAX_POOL_SIZE') or 100)
+    MONGO_MIN_POOL_SIZE = int(os.environ.get('MONGO_MIN_POOL_SIZE') or 0)
+    MONGO_CONNECT_TIMEOUT_MS = int(os.environ.get('MONGO_CONNECT_TIMEOUT_MS') or
+                                   20000)
+    MONGO_SERVER_SELECTION_TIMEOUT_MS = int(
+        os.environ.get('MONGO_SERVER_SELECTION_TIMEOUT_MS') or 30000)
+    MONGO_SOCKET_TIMEOUT_MS = int(os.environ.get('MONGO_SOCKET_TIMEOUT_MS') or
+                                  0) or None
+    MONGO_WAIT_QUEUE_TIMEOUT_MS = int(
+        os.environ.get('MONGO_WAIT_QUEUE_TIMEOUT_MS') or 0) or None
+
+    # The cache for computed results. 'tiered' keeps the results in a SQLite
+    # file shared by all worker processes on the host with a faster
+    # in-process tier in front of it, 'sqlite' uses only the file and 'lru'
+    # only the in-process tier. Both tiers are limited in size (in bytes) and
+    # evict the least recently used results. The file is kept in the
+    # instance folder of the app (app.instance_path) by default. Apps sharing
+    # the file only see each other's results if they have the same
+    # CACHE_NAMESPACE (by default, if they run from the same folder).
+    CACHE_TYPE = os.environ.get('CACHE_TYPE') or 'tiered'
+    CACHE_PATH = os.environ.get('CACHE_PATH') or os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        'instance', 'video_annotator_cache.sqlite')
+    CACHE_NAMESPACE = os.environ.get('CACHE_NAMESPACE') or None
+    CACHE_MAX_BYTES = int(os.environ.get('CACHE_MAX_BYTES') or 512 * 1024 ** 2)
+    CACHE_LOCAL_MAX_BYTES = int(os.environ.get('CACHE_LOCAL_MAX_BYTES') or
+                                64 * 1024 ** 2)
+    CACHE = create_cache(CACHE_TYPE, CACHE_PATH, CACHE_MAX_BYTES,
+                         CACHE_LOCAL_MAX_BYTES)
+
+    # Settings of the write-behind queue the annotations are saved through:
+    # number of posts written to the database at once, seconds to wait for
+    # more posts before writing and number of posts that may wait in the
+    # queue before new ones are rejected.
+    INGEST_BATCH_SIZE = int(os.environ.get('INGEST_BATCH_SIZE') or 500)
+    INGEST_FLUSH_INTERVAL = float(os.environ.get('INGEST_FLUSH_INTERVAL') or
+                                  0.5)
+    INGEST_QUEUE_SIZE = int(os.environ.get('INGEST_QUEUE_SIZE') or 50000)
+    # Number of times writing a post is attempted before it is dropped:
+    INGEST_MAX_ATTEMPTS = int(os.environ.get('INGEST_MAX_ATTEMPTS') or 5)
+    # Seconds a client should wait before retrying when the queue is full:
+    INGEST_RETRY_AFTER = 1
+
+    # Read the users' series for the analysis from the series store, which is
+    # kept up to date when annotations are saved, instead of regrouping all
+    # raw posts. Run 'flask rebuild-series' before switching this on for a
+    # database that already contains data.
+    USE_SERIES_STORE = os.environ.get('USE_SERIES_STORE') == 'true'
+
+    # Number of processes computing clusterings in the background (defaults
+    # to the one of the profile, see PROFILES), number of finished
+    # clusterings kept for reuse in every worker process, and seconds after
+    # which a clustering another worker started is started again if it has
+    # not finished (e.g. because the worker died):
+    CLUSTER_WORKERS = int(os.environ.get('CLUSTER_WORKERS') or 0) or None
+    CLUSTER_JOBS_KEEP = int(os.environ.get('CLUSTER_JOBS_KEEP') or 100)
+    CLUSTER_JOB_TIMEOUT = int(os.environ.get('CLUSTER_JOB_TIMEOUT') or 600)
+
+    # Seconds between checks for new annotations when streaming them to a
+    # live chart, seconds after which a stream is closed (the browser
+    # reconnects and continues where it stopped), and seconds of annotations
+    # that are checked again for posts other workers wrote late (see
+    # DatabaseClient.posts_after()):
+    LIVE_POLL_INTERVAL = 1.0
+    LIVE_STREAM_SECONDS = 300
+    LIVE_OVERLAP_SECONDS = 5
+    # A stream keeps a worker busy for LIVE_STREAM_SECONDS, so live charts
+    # poll for new annotations unless the app runs with an asynchronous
+    # gunicorn worker class (e.g. gevent) and this is switched on:
+    LIVE_STREAM = os.environ.get('LIVE_STREAM') == 'true'
+
+    # Fraction of the requests that are profiled with cProfile (0 to switch
+    # profiling off), and the directory the profiles are written to:
+    PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE') or 0)
+    PROFILE_DIR = os.environ.get('PROFILE_DIR') or 'profiles'
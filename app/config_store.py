@@ -0,0 +1,146 @@
+"""
+This file contains the store for the configuration files (videos, input
+fields and user instructions).
+
+Each file is parsed once and only read again when it has changed on disk,
+so the files are not read on every request. Changes are written to a
+temporary file which then replaces the original file, under a file lock, so
+that all worker processes always see a complete file.
+"""
+import os
+import tempfile
+import threading
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+class ConfigFile:
+    """
+    A configuration file with a cached, parsed version of its contents.
+    """
+
+    def __init__(self, path, parser):
+        """
+        :param path: Path of the file
+        :param parser: Function converting the contents of the file (a
+        string) to the parsed version
+        """
+        self.path = path
+        self.parser = parser
+        self._lock = threading.Lock()
+        self._signature = None
+        self._text = None
+        self._parsed = None
+
+    def _stat_signature(self):
+        """
+        :return: Tuple that changes whenever the file is changed or replaced
+        """
+        st = os.stat(self.path)
+        return st.st_ino, st.st_size, st.st_mtime_ns
+
+    def _refresh(self):
+        """
+        Read and parse the file if it changed since it was last read. Must be
+        called with the lock held.
+        :return: None
+        """
+        signature = self._stat_signature()
+        if signature != self._signature:
+            with open(self.path, 'r') as f:
+                self._text = f.read()
+            self._parsed = self.parser(self._text)
+            self._signature = signature
+
+    def read(self):
+        """
+        :return: The parsed contents of the file
+        """
+        with self._lock:
+            self._refresh()
+            return self._parsed
+
+    def read_text(self):
+        """
+        :return: The contents of the file as string
+        """
+        with self._lock:
+            self._refresh()
+            return self._text
+
+    def update(self, transform):
+        """
+        Change the file. The file is locked, so that changes from other
+        processes are not lost, and replaced atomically.
+        :param transform: Function getting the current contents of the file
+        and returning the new contents
+        :return: The new contents
+        """
+        with self._lock, open(self.path + '.lock', 'w') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                with open(self.path, 'r') as f:
+                    text = transform(f.read())
+                directory = os.path.dirname(os.path.abspath(self.path))
+                fd, tmp_path = tempfile.mkstemp(dir=directory,
+                                                prefix='.tmp_config_')
+                try:
+                    with os.fdopen(fd, 'w') as f:
+                        f.write(text)
+                        f.flush()
+                        os.fsync(f.fileno())
+                    os.chmod(tmp_path, os.stat(self.path).st_mode & 0o777)
+                    os.replace(tmp_path, self.path)
+                except Exception:
+                    os.remove(tmp_path)
+                    raise
+                self._signature = None
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+        return text
+
+    def write(self, text):
+        """
+        Replace the contents of the file.
+        :param text: The new contents
+        :return: None
+        """
+        self.update(lambda _: text)
+
+
+def config_lines(text):
+    """
+    Split the contents of a configuration file into its lines, ignoring empty
+    lines and lines starting with #.
+    :param text: The contents of the file
+    :return: List of stripped lines
+    """
+    return [x.strip() for x in text.splitlines() if x.strip() if
+            (x.strip()[0] != '#')]
+
+
+def parse_videos(text):
+    """
+    Parse the video configuration file.
+    :param text: The contents of the file
+    :return: Dictionary of available videos, each stored as id:name, and list
+    containing id and name of the video that is the first one in the file.
+    """
+    vid_list = config_lines(text)
+    vid_dict = dict([i.split(':', 1) for i in vid_list])
+    first_vid = vid_list[0].split(':', 1)
+    return vid_dict, first_vid
+
+
+def parse_input_fields(text):
+    """
+    Parse the input field configuration file.
+    :param text: The contents of the file
+    :return: List containing information on sliders (see get_input_fields())
+    """
+    return [i.split(':') for i in config_lines(text)]
@@ -6,18 +6,25 @@ It has only the webpages belonging to control functions of our app,
 i.e. those belonging to the control blueprint.
 """
 from flask import request, redirect, url_for, render_template, session, \
-    flash, send_file, current_app
+    flash, current_app, jsonify, Response, stream_with_context
 
+import csv
+import itertools
 import json
-from io import StringIO, BytesIO
+from io import StringIO
 import datetime
 
-from app.functionalities import collect_mongodbobjects, check_access_right, \
-    sort_df, signal_data_modification
+from app.functionalities import check_access_right, store_posts, \
+    get_variable_names, get_videos, untyped_posts
+from app.columnar_export import FORMATS, stream_columnar, resampled_npz
 from app.control import bp
-from app.database_client import DatabaseClient
+from app.database_client import create_database_client, clients
+from app.metrics import metrics, count_rows
 import pymongo
-from werkzeug.contrib.cache import SimpleCache
+
+# Number of posts fetched from the database and written per chunk when
+# exporting:
+EXPORT_CHUNK_SIZE = 1000
 
 
 @bp.route('/')
@@ -86,13 +93,21 @@ def save():
                       "timestamp": request.form.get('timestamp'),
                       "date": request.form.get('date')
                       }
-        values = json.loads(request.form.get('values'))
-        names = json.loads(request.form.get('names'))
+        try:
+            values = json.loads(request.form.get('values'))
+            names = json.loads(request.form.get('names'))
+        except (TypeError, ValueError):
+            return "Error: 'names' and 'values' must be JSON lists", 400
+        if not isinstance(names, list) or not isinstance(values, list):
+            return "Error: 'names' and 'values' must be JSON lists", 400
         for n, v in zip(names, values):
+            if not isinstance(n, str):
+                return "Error: the names must be strings", 400
             data_point[n] = v
 
-        current_app.d.insert_post(data_point)
-        signal_data_modification(request.form.get('videoid'))
+        busy = store_posts([data_point])
+        if busy:
+            return busy
         return "Saving completed"
 
 
@@ -105,17 +120,137 @@ def save2D():
     if not session.get('username'):
         return "Error: username not set"
     else:
-        current_app.d.insert_post({"videoid": request.form.get('videoid'),
-                                   "username": session['username'],
-                                   "timestamp": request.form.get('timestamp'),
-                                   "value": request.form.get('value'),
-                                   "value2": request.form.get('value2'),
-                                   "date": request.form.get('date')
-                                   })
-        signal_data_modification(request.form.get('videoid'))
+        busy = store_posts([{"videoid": request.form.get('videoid'),
+                             "username": session['username'],
+                             "timestamp": request.form.get('timestamp'),
+                             "value": request.form.get('value'),
+                             "value2": request.form.get('value2'),
+                             "date": request.form.get('date')
+                             }])
+        if busy:
+            return busy
         return "Saving completed"
 
 
+@bp.route('/save_batch', methods=['POST'])
+def save_batch():
+    """
+    Save several buffered samples (from 1d- and 2d-sliders) to the database at
+    once. The request body is JSON of the form {"samples": [...]}, where each
+    sample contains 'videoid', 'timestamp', 'date' and the lists 'names' and
+    'values'.
+    :return: Feedback string, or with status 207 JSON with the number of
+    samples that were saved ('saved') and the index and error of the ones
+    that were invalid ('rejected')
+    """
+    if not session.get('username'):
+        return "Error: username not set"
+    payload = request.get_json(force=True, silent=True)
+    if not isinstance(payload, dict):
+        return "Error: the body must be a JSON object", 400
+    samples = payload.get('samples') or []
+    if not isinstance(samples, list):
+        return "Error: 'samples' must be a list", 400
+
+    posts = []
+    for sample in samples:
+        if not isinstance(sample, dict):
+            return "Error: every sample must be a JSON object", 400
+        names = sample.get('names') or []
+        values = sample.get('values') or []
+        if not isinstance(names, list) or not isinstance(values, list):
+            return "Error: 'names' and 'values' must be lists", 400
+        data_point = {"videoid": sample.get('videoid'),
+                      "username": session['username'],
+                      "timestamp": sample.get('timestamp'),
+                      "date": sample.get('date')
+                      }
+        for n, v in zip(names, values):
+            if not isinstance(n, str):
+                return "Error: the names must be strings", 400
+            data_point[n] = v
+        posts.append(data_point)
+
+    if not posts:
+        return "Error: no samples given", 400
+
+    rejected = []
+    busy = store_posts(posts, rejected)
+    if busy:
+        return busy
+    if rejected:
+        return jsonify(saved=len(posts) - len(rejected),
+                       rejected=[{'index': i, 'error': error}
+                                 for i, error in rejected]), 207
+    return "Saving completed (" + str(len(posts)) + " samples)"
+
+
+@bp.route('/ingest_status')
+def ingest_status():
+    """
+    Show the counters of the write-behind queue (queue depth, number of
+    written and rejected posts and flush latency) as JSON.
+
+    Operation is not allowed for role user.
+    :return: JSON with the queue statistics
+    """
+    check_access_right(forbidden='user', redirect_url='control.index')
+    return jsonify(current_app.ingest.stats())
+
+
+@bp.route('/db_status')
+def db_status():
+    """
+    Show the pool settings and usage of the database clients of this worker
+    process (number of commands, most commands running at once) and whether
+    each database answers, as JSON.
+
+    Operation is not allowed for role user.
+    :return: JSON with the client statistics
+    """
+    check_access_right(forbidden='user', redirect_url='control.index')
+    stats = clients.stats(ping=True)
+    status = 200 if all(s['healthy'] for s in stats.values()) else 503
+    return jsonify(stats), status
+
+
+@bp.route('/cache_status')
+def cache_status():
+    """
+    Show the counters of the cache (number and size of the cached results,
+    hits, misses and evictions) as JSON.
+
+    Operation is not allowed for role user.
+    :return: JSON with the cache statistics
+    """
+    check_access_right(forbidden='user', redirect_url='control.index')
+    return jsonify(current_app.config['CACHE'].stats())
+
+
+@bp.route('/metrics')
+def metrics_endpoint():
+    """
+    Export the metrics of this worker process in the Prometheus text format:
+    latency histograms of the requests, analysis stages and background jobs,
+    row counts, and the counters of the cache and the write-behind queue.
+    :return: The metrics as plain text
+    """
+    gauges = []
+    stats = current_app.config['CACHE'].stats()
+    tiers = {'all': stats} if 'hits' in stats else stats
+    for tier, tier_stats in sorted(tiers.items()):
+        lookups = tier_stats['hits'] + tier_stats['misses']
+        for counter in ['hits', 'misses', 'evictions', 'entries', 'bytes']:
+            gauges.append(('app_cache_' + counter, {'tier': tier},
+                           tier_stats[counter]))
+        gauges.append(('app_cache_hit_ratio', {'tier': tier},
+                       tier_stats['hits'] / lookups if lookups else 0))
+    for counter, value in sorted(current_app.ingest.stats().items()):
+        gauges.append(('app_ingest_' + counter, {}, value))
+    return Response(metrics.render(gauges),
+                    mimetype='text/plain; version=0.0.4')
+
+
 @bp.route('/<path:path>')
 def static_file(path):
     """
@@ -129,29 +264,130 @@ def static_file(path):
 @bp.route('/export_all')
 def export_all():
     """
-    Export all the data stored in MongoDB to a file
+    Export the data stored in MongoDB to a file. The file is streamed
+    straight from the database cursor in chunks, so the export runs in
+    constant memory and the download starts immediately.
+
+    The argument 'format' selects the file format: 'csv' (default),
+    'parquet' or 'arrow' for the raw data with typed columns, or 'npz' for
+    the resampled users x time matrices of one video (see
+    app/columnar_export.py).
+
+    The export can be restricted to one video with the argument 'vid', and
+    to the posts saved in a date range with the arguments 'from' and 'to'
+    (formatted as YYYY-MM-DD, both inclusive). The date range is refused
+    while there are posts whose date an older version saved as string,
+    which it would miss (see 'flask migrate-types').
+
+    The columns are the standard fields, the configured sliders and the
+    values of sliders that have been removed from the configuration.
 
     Operation is not allowed for role user.
-    :return:
+    :return: The file
     """
     check_access_right(forbidden='user', redirect_url='control.index')
 
-    b, data = collect_mongodbobjects()
-    if b:
-        bytes_buffer = BytesIO()
-        with StringIO() as str_buffer:
-            data.to_csv(str_buffer, index=False)
-            str_buffer.seek(0)
-            bytes_buffer.write(str_buffer.getvalue().encode('utf-8'))
-        bytes_buffer.seek(0)
-        filename = 'video_annotations_{date:%Y-%m-%d_%H-%M-%S}.csv'.format(
-            date=datetime.datetime.now())
-        return send_file(bytes_buffer,
-                         as_attachment=True, attachment_filename=filename,
-                         mimetype='text/csv')
-    else:
+    fmt = request.args.get('format', 'csv')
+    if fmt != 'csv' and fmt not in FORMATS:
+        flash('Unknown export format "' + fmt + '".')
+        return redirect(url_for('researcher.data'))
+    filename = 'video_annotations_{date:%Y-%m-%d_%H-%M-%S}'.format(
+        date=datetime.datetime.now())
+
+    if fmt == 'npz':
+        videoid = request.args.get('vid') or get_videos()[1][0]
+        archive = resampled_npz(videoid)
+        if archive is None:
+            flash('No data to export!')
+            return redirect(url_for('researcher.data'))
+        mimetype, extension = FORMATS[fmt]
+        return Response(archive, mimetype=mimetype,
+                        headers={'Content-Disposition':
+                                 'attachment; filename=' + filename + '_' +
+                                 videoid + '.' + extension})
+
+    try:
+        date_from = parse_date(request.args.get('from'))
+        date_to = parse_date(request.args.get('to'), end_of_day=True)
+    except ValueError:
+        flash('Dates have to be given in the format YYYY-MM-DD.')
+        return redirect(url_for('researcher.data'))
+    if (date_from is not None or date_to is not None) and \
+            untyped_posts('date'):
+        flash('Some posts were saved with their date as text by an older '
+              'version, so they cannot be filtered by date. Run "flask '
+              'migrate-types" first, or export without dates.')
+        return redirect(url_for('researcher.data'))
+
+    videoid = request.args.get('vid') or None
+    cursor = current_app.d.query_posts(
+        videoid=videoid, date_from=date_from, date_to=date_to,
+        sort=['videoid', 'username', 'timestamp'],
+        batch_size=EXPORT_CHUNK_SIZE)
+    first = next(cursor, None)
+    if first is None:
         flash('No data to export!')
-        return render_template('control/data.html', data='', headers='')
+        return redirect(url_for('researcher.data'))
+
+    standard_data_cols = ['videoid', 'username', 'timestamp', 'date']
+    variables = get_variable_names()
+    # Values of sliders that are no longer configured are exported too:
+    variables += [v for v in current_app.d.post_variables(
+        videoid, date_from, date_to) if v not in variables]
+    columns = standard_data_cols[:3] + variables + standard_data_cols[-1:]
+
+    if fmt != 'csv':
+        try:
+            generator = stream_columnar(itertools.chain([first], cursor),
+                                        columns, fmt)
+        except ImportError:
+            flash('Exporting as ' + fmt + ' requires the package pyarrow.')
+            return redirect(url_for('researcher.data'))
+        mimetype, extension = FORMATS[fmt]
+        return Response(stream_with_context(generator), mimetype=mimetype,
+                        headers={'Content-Disposition':
+                                 'attachment; filename=' + filename + '.' +
+                                 extension})
+
+    def generate():
+        buffer = StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=columns,
+                                extrasaction='ignore')
+        writer.writeheader()
+        writer.writerow(first)
+        rows = 1
+        for i, post in enumerate(cursor):
+            writer.writerow(post)
+            rows += 1
+            if (i + 1) % EXPORT_CHUNK_SIZE == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate(0)
+        yield buffer.getvalue()
+        count_rows('export_all', rows)
+
+    return Response(stream_with_context(generate()), mimetype='text/csv',
+                    headers={'Content-Disposition':
+                             'attachment; filename=' + filename + '.csv'})
+
+
+def parse_date(date, end_of_day=False):
+    """
+    Convert a date given as YYYY-MM-DD to milliseconds since the epoch,
+    which is how the dates of posts are stored.
+    :param date: The date string, or None
+    :param end_of_day: Return the last instead of the first millisecond of
+    the day
+    :return: Milliseconds since the epoch, or None if no date is given
+    """
+    if not date:
+        return None
+    day = datetime.datetime.strptime(date, '%Y-%m-%d')
+    if end_of_day:
+        day += datetime.timedelta(days=1)
+    epoch = datetime.datetime(1970, 1, 1)
+    milliseconds = int((day - epoch).total_seconds() * 1000)
+    return milliseconds - 1 if end_of_day else milliseconds
 
 
 @bp.route('/delete_all')
@@ -164,7 +400,7 @@ def delete_all():
     """
     check_access_right(forbidden='user', redirect_url='control.index')
     current_app.d.delete_many({})
-    current_app.config['CACHE'] = SimpleCache(default_timeout=1e15)
+    current_app.config['CACHE'].clear()
     flash('All data deleted!')
     return redirect(url_for('researcher.data'))
 
@@ -193,8 +429,8 @@ def add_video():
                     'should end in a number, like for example '
                     '"https://vimeo.com/65107797"')
                 return (redirect(url_for('researcher.config')))
-        with open(current_app.vid_file, 'a') as f:
-            f.write('\n' + vid_id + ':' + vid_name)
+        current_app.vid_store.update(
+            lambda text: text + '\n' + vid_id + ':' + vid_name)
         flash('Video "' + vid_name + '" was successfully added.')
 
     return redirect(url_for('researcher.config'))
@@ -211,16 +447,15 @@ def remove_video():
     vid_id = request.args.get('vid_id')
     vid_name = request.args.get('vid_name')
 
-    removed = False
+    removed = []
 
-    with open(current_app.vid_file, 'r') as f:
-        lines = f.readlines()
-    with open(current_app.vid_file, 'w') as f:
-        for line in lines:
-            if vid_id not in line:
-                f.write(line)
-            else:
-                removed = True
+    def remove(text):
+        lines = text.splitlines(True)
+        kept = [line for line in lines if vid_id not in line]
+        removed.extend(line for line in lines if vid_id in line)
+        return ''.join(kept)
+
+    current_app.vid_store.update(remove)
 
     if removed:
         flash('Video "' + vid_name + '" has been removed.')
@@ -250,9 +485,9 @@ def add_slider():
         return redirect(url_for('researcher.config'))
 
     if slider_type == 'slider':
-        with open(current_app.input_fields, 'a') as f:
-            f.write('\n' + slider_type + ':' + min_val + ':' + max_val + ':' +
-                    def_val + ':' + name)
+        current_app.input_fields_store.update(
+            lambda text: text + '\n' + slider_type + ':' + min_val + ':' +
+                         max_val + ':' + def_val + ':' + name)
         flash('Slider "' + name + '" was successfully added.')
 
     elif slider_type == '2dslider':
@@ -264,10 +499,10 @@ def add_slider():
             flash("You need to provide values to all fields in order to add a "
                   "slider!")
             return redirect(url_for('researcher.config'))
-        with open(current_app.input_fields, 'a') as f:
-            f.write(
-                '\n' + slider_type + ':' + min_val + ':' + min_val2 + ':' + max_val + ':' + max_val2 + ':' +
-                def_val + ':' + def_val2 + ':' + name + ':' + name2)
+        current_app.input_fields_store.update(
+            lambda text: text +
+                         '\n' + slider_type + ':' + min_val + ':' + min_val2 + ':' + max_val + ':' + max_val2 + ':' +
+                         def_val + ':' + def_val2 + ':' + name + ':' + name2)
         flash('Slider "' + name + ':' + name2 + '" was successfully added.')
 
     else:
@@ -287,17 +522,19 @@ def remove_slider():
 
     slider_name = request.args.get('slider_name')
 
-    removed = False
+    removed = []
 
-    with open(current_app.input_fields, 'r') as f:
-        lines = f.readlines()
-    with open(current_app.input_fields, 'w') as f:
-        for line in lines:
+    def remove(text):
+        kept = []
+        for line in text.splitlines(True):
             if (line[-len(slider_name):] != slider_name) and (
                     line[-len(slider_name) - 1:] != slider_name + '\n'):
-                f.write(line)
+                kept.append(line)
             else:
-                removed = True
+                removed.append(line)
+        return ''.join(kept)
+
+    current_app.input_fields_store.update(remove)
 
     if removed:
         flash('Slider "' + slider_name + '" has been removed.')
@@ -319,8 +556,10 @@ def change_db():
     new_db = request.form.get('db')
     current_app.config['DB'] = new_db
 
-    current_app.d = DatabaseClient()
+    # Clients are shared per database, so switching back and forth does not
+    # open new connections:
+    current_app.d = create_database_client()
 
     flash('Database changed to "' + current_app.dbs[new_db] + '".')
-    current_app.config['CACHE'] = SimpleCache(default_timeout=1e15)
+    current_app.config['CACHE'].clear()
     return redirect(url_for('researcher.config'))
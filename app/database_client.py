@@ -1,9 +1,244 @@
 """
 This file contains the interface class for the MongoDB database.
+
+The MongoClients are kept in a registry with one client (and thus one
+connection pool) per database target, which is reused by every
+DatabaseClient for that target. Clients are only created when the database
+is first used, and are created again in a forked process, because a
+MongoClient must not be shared with a child process.
 """
+import datetime
+import math
+import os
+import threading
+import time
+
 from flask import current_app
 
-from pymongo import MongoClient
+from bson.objectid import ObjectId
+from pymongo import MongoClient, ASCENDING, DESCENDING, UpdateOne
+from pymongo import monitoring
+from pymongo.errors import BulkWriteError
+
+from app.ingest_queue import PartialWrite
+
+# The fields every annotation post has, independent of the configured sliders:
+STANDARD_FIELDS = ['videoid', 'username', 'timestamp', 'date']
+
+# Error code of MongoDB for a document whose _id already exists:
+DUPLICATE_KEY = 11000
+
+
+def typed_value(field, value):
+    """
+    Convert a field of a post to the type it is stored with: 'videoid' and
+    'username' as string, 'date' as integer (milliseconds since the epoch),
+    'timestamp' and the slider values as float.
+    :param field: The name of the field
+    :param value: The value, e.g. a string from a form
+    :return: The converted value
+    :raises ValueError: If the value cannot be converted or is not a finite
+    number
+    """
+    if field in ('videoid', 'username'):
+        if value is None:
+            raise ValueError('"' + field + '" is missing.')
+        return str(value)
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        raise ValueError('"' + field + '" is not a number: ' + repr(value))
+    if not math.isfinite(number):
+        raise ValueError('"' + field + '" is not finite.')
+    if field == 'date':
+        return int(number)
+    return number
+
+# Connection settings of the database targets, as (host, port, database
+# name, user, password). The local database runs on the default port and
+# needs no authentication.
+TARGETS = {'local': (None, None, 'videoannotatordb', None, None),
+           'dev': ('ds231956.mlab.com', 31956, 'videoannotatordbdev',
+                   'videoadmin', 'kantapassu123'),
+           'prod': ('ds159185.mlab.com', 59185, 'videoannotatordb',
+                    'videoadmin', 'kantapassu123')}
+
+
+class CommandCounter(monitoring.CommandListener):
+    """
+    Counts the commands sent by a client, and how many of them are running at
+    the same time. Each running command holds a connection of the pool, so
+    the maximum number of running commands shows how large the pool needs
+    to be.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.commands = 0
+        self.failed_commands = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.seconds_total = 0.0
+
+    def started(self, event):
+        with self._lock:
+            self.commands += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    def succeeded(self, event):
+        with self._lock:
+            self.in_flight -= 1
+            self.seconds_total += event.duration_micros / 1e6
+
+    def failed(self, event):
+        with self._lock:
+            self.in_flight -= 1
+            self.failed_commands += 1
+            self.seconds_total += event.duration_micros / 1e6
+
+    def stats(self):
+        """
+        :return: Dictionary with the counters
+        """
+        with self._lock:
+            return {'commands': self.commands,
+                    'failed_commands': self.failed_commands,
+                    'in_flight': self.in_flight,
+                    'max_in_flight': self.max_in_flight,
+                    'command_seconds_total': self.seconds_total}
+
+
+class ClientRegistry:
+    """
+    Keeps one MongoClient per database target for the current process.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = None
+        # Database target: dictionary with client, database, counter and
+        # whether the indexes have been created
+        self._entries = {}
+
+    def _check_pid(self):
+        """
+        Forget the clients of the parent process after a fork. They are not
+        closed, as their sockets still belong to the parent. Must be called
+        with the lock held.
+        :return: None
+        """
+        if self._pid != os.getpid():
+            self._entries = {}
+            self._pid = os.getpid()
+
+    def database(self, target, settings, prepare=None):
+        """
+        Get the database of a target, creating its client if needed.
+        :param target: 'local', 'dev' or 'prod'
+        :param settings: Dictionary of pool settings passed to MongoClient
+        :param prepare: Function called once per process with the database
+        when the client has been created, e.g. to create indexes (optional)
+        :return: The database
+        """
+        with self._lock:
+            self._check_pid()
+            entry = self._entries.get(target)
+            if entry is None:
+                host, port, name, user, password = TARGETS[target]
+                counter = CommandCounter()
+                options = dict(settings)
+                if user is not None:
+                    options.update(username=user, password=password,
+                                   authSource=name)
+                # connect=False: connect in the background on first use
+                client = MongoClient(host, port, connect=False,
+                                     event_listeners=[counter], **options)
+                entry = {'client': client, 'database': client[name],
+                         'counter': counter, 'prepared': False,
+                         'settings': dict(settings)}
+                self._entries[target] = entry
+            run_prepare = prepare is not None and not entry['prepared']
+            entry['prepared'] = entry['prepared'] or run_prepare
+        if run_prepare:
+            try:
+                prepare(entry['database'])
+            except Exception:
+                entry['prepared'] = False
+                raise
+        return entry['database']
+
+    def close(self, target=None):
+        """
+        Close the client of a target, or all clients.
+        :param target: The target, or None for all targets
+        :return: None
+        """
+        with self._lock:
+            self._check_pid()
+            targets = list(self._entries) if target is None else [target]
+            entries = [self._entries.pop(t) for t in targets
+                       if t in self._entries]
+        for entry in entries:
+            entry['client'].close()
+
+    def stats(self, ping=False):
+        """
+        Collect the settings and usage of the pool of every client.
+        :param ping: Whether to check that each database answers, which
+        waits up to the server selection timeout
+        :return: Dictionary target: statistics
+        """
+        with self._lock:
+            self._check_pid()
+            entries = dict(self._entries)
+        result = {}
+        for target, entry in entries.items():
+            stats = {'pid': os.getpid(), 'settings': entry['settings']}
+            stats.update(entry['counter'].stats())
+            if ping:
+                start = time.time()
+                try:
+                    entry['client'].admin.command('ping')
+                    stats['healthy'] = True
+                except Exception as e:
+                    stats['healthy'] = False
+                    stats['error'] = str(e)
+                stats['ping_seconds'] = time.time() - start
+            result[target] = stats
+        return result
+
+
+clients = ClientRegistry()
+
+
+def pool_settings(config):
+    """
+    :param config: The configuration of the app
+    :return: Dictionary of the MongoClient pool settings in the configuration
+    """
+    settings = {'maxPoolSize': config['MONGO_MAX_POOL_SIZE'],
+                'minPoolSize': config['MONGO_MIN_POOL_SIZE'],
+                'connectTimeoutMS': config['MONGO_CONNECT_TIMEOUT_MS'],
+                'serverSelectionTimeoutMS':
+                    config['MONGO_SERVER_SELECTION_TIMEOUT_MS'],
+                'socketTimeoutMS': config['MONGO_SOCKET_TIMEOUT_MS'],
+                'waitQueueTimeoutMS': config['MONGO_WAIT_QUEUE_TIMEOUT_MS']}
+    return {k: v for k, v in settings.items() if v is not None}
+
+
+def create_database_client(target=None):
+    """
+    Create the client of the configured storage backend.
+    :param target: 'local', 'dev' or 'prod' for MongoDB, or 'sqlite' for the
+    embedded SQLite database, defaults to the DB config value
+    :return: The client
+    """
+    target = target or current_app.config['DB']
+    if target == 'sqlite':
+        from app.sqlite_client import SQLiteClient
+        return SQLiteClient()
+    return DatabaseClient(target)
 
 
 class DatabaseClient:
@@ -11,35 +246,67 @@ class DatabaseClient:
     Class specifying the connection to the MongoDB database.
     """
 
-    def __init__(self):
+    def __init__(self, target=None):
         """
         Initiate the database connection.
-        Depending on the DB_TYPE environment variable it will be connected to a
+        Depending on the DB config value it will be connected to a
         local database (this requires to have MongoDB running on the local
         machine), or to the dev-database or to a production database
-        (which is the default).
+        (which is the default). The connection itself is only opened when
+        the database is first used.
+        :param target: 'local', 'dev' or 'prod', defaults to the DB config
+        value
         """
-        type = current_app.config['DB']
-        if type == 'local':
-            client = MongoClient()
-            db = client.videoannotatordb
-        else:
-            if type == 'dev':
-                DB_NAME = "videoannotatordbdev"
-                DB_HOST = "ds231956.mlab.com"
-                DB_PORT = 31956
-                DB_USER = "videoadmin"
-                DB_PASS = "kantapassu123"
-            else:  # type ='prod'
-                DB_NAME = "videoannotatordb"
-                DB_HOST = "ds159185.mlab.com"
-                DB_PORT = 59185
-                DB_USER = "videoadmin"
-                DB_PASS = "kantapassu123"
-            client = MongoClient(DB_HOST, DB_PORT)
-            db = client[DB_NAME]
-            db.authenticate(DB_USER, DB_PASS)
-        self.posts = db.posts
+        self.target = target or current_app.config['DB']
+        if self.target not in TARGETS:
+            self.target = 'prod'
+        self.settings = pool_settings(current_app.config)
+
+    @property
+    def db(self):
+        """
+        :return: The database, with its indexes created
+        """
+        return clients.database(self.target, self.settings,
+                                prepare=lambda db: self.ensure_indexes())
+
+    @property
+    def posts(self):
+        return self.db.posts
+
+    @property
+    def series(self):
+        # Derived store with the series of every (video, user, variable),
+        # maintained when posts are inserted
+        return self.db.series
+
+    def ensure_indexes(self):
+        """
+        Create the indexes the analytics queries rely on. Creating an index
+        that already exists is a no-op in MongoDB, so this is safe to call
+        whenever a process first uses the database.
+
+        The indexes on the timestamp end with the _id, so that they also
+        serve the pages of raw data sorted by (timestamp, _id) (see
+        page_posts()) without sorting all matching posts in memory.
+        :return: None
+        """
+        self.posts.create_index([('videoid', ASCENDING),
+                                 ('username', ASCENDING),
+                                 ('timestamp', ASCENDING),
+                                 ('_id', ASCENDING)])
+        self.posts.create_index([('videoid', ASCENDING),
+                                 ('timestamp', ASCENDING),
+                                 ('_id', ASCENDING)])
+        self.posts.create_index([('username', ASCENDING),
+                                 ('timestamp', ASCENDING),
+                                 ('_id', ASCENDING)])
+        self.posts.create_index([('timestamp', ASCENDING),
+                                 ('_id', ASCENDING)])
+        self.posts.create_index([('videoid', ASCENDING), ('_id', ASCENDING)])
+        self.series.create_index([('videoid', ASCENDING),
+                                  ('variable', ASCENDING),
+                                  ('username', ASCENDING)], unique=True)
 
     def insert_post(self, post_data):
         """
@@ -48,6 +315,169 @@ class DatabaseClient:
         :return: None
         """
         self.posts.insert_one(post_data)
+        self.update_series([post_data])
+
+    def insert_posts(self, posts):
+        """
+        Insert several posts into the database with a single round trip.
+
+        insert_many() gives every post an _id, which the posts keep. A post
+        that is inserted again with its _id (because an earlier attempt
+        failed after writing it) is a duplicate key error and counts as
+        written, so retrying does not store posts twice.
+        :param posts: List of posts to be inserted
+        :return: None
+        :raises PartialWrite: If some of the posts could not be inserted
+        """
+        if not posts:
+            return
+        try:
+            self.posts.insert_many(posts, ordered=False)
+        except BulkWriteError as e:
+            failed = set(error['index'] for error in
+                         e.details.get('writeErrors', [])
+                         if error.get('code') != DUPLICATE_KEY)
+            written = [p for i, p in enumerate(posts) if i not in failed]
+            self.update_series(written)
+            if failed:
+                raise PartialWrite(
+                    'Inserting {} posts failed.'.format(len(failed)),
+                    written, [posts[i] for i in sorted(failed)])
+            return
+        self.update_series(posts)
+
+    def update_series(self, posts):
+        """
+        Add the values of posts to the series store. Each (video, user,
+        variable) is one document whose points are kept sorted by timestamp,
+        so that the analysis can read finished series instead of regrouping
+        all raw posts.
+        :param posts: List of posts
+        :return: None
+        """
+        points = {}
+        for p in posts:
+            try:
+                t = float(p['timestamp'])
+            except (KeyError, TypeError, ValueError):
+                continue
+            for variable, v in p.items():
+                if variable in STANDARD_FIELDS or variable == '_id':
+                    continue
+                try:
+                    v = float(v)
+                except (TypeError, ValueError):
+                    continue
+                if v != v:
+                    # Value is nan
+                    continue
+                key = (p['videoid'], p['username'], variable)
+                points.setdefault(key, []).append({'t': t, 'v': v})
+
+        operations = [UpdateOne({'videoid': videoid, 'username': username,
+                                 'variable': variable},
+                                {'$push': {'points': {'$each': pts,
+                                                      '$sort': {'t': 1}}}},
+                                upsert=True)
+                      for (videoid, username, variable), pts in
+                      points.items()]
+        if operations:
+            self.series.bulk_write(operations, ordered=False)
+
+    def collect_series(self, videoid, variable, username=None, start=None,
+                       end=None):
+        """
+        Collect the series of all users for a video and variable from the
+        series store.
+        :param videoid: The id of the video
+        :param variable: The variable
+        :param username: Only return the series of the users in this list
+        (optional)
+        :param start: Only return points with timestamp >= start (optional)
+        :param end: Only return points with timestamp <= end (optional)
+        :return: Cursor over documents containing 'username' and 'points'
+        (list of {'t': timestamp, 'v': value}, sorted by timestamp), sorted
+        by username
+        """
+        rule = {'videoid': videoid, 'variable': variable}
+        if username is not None:
+            rule['username'] = {'$in': list(username)}
+        if start is None and end is None:
+            return self.series.find(rule, {'_id': False, 'username': True,
+                                           'points': True}).sort('username',
+                                                                 ASCENDING)
+        # Only send the points in the selected part of the video
+        conditions = []
+        if start is not None:
+            conditions.append({'$gte': ['$$point.t', start]})
+        if end is not None:
+            conditions.append({'$lte': ['$$point.t', end]})
+        return self.series.aggregate([
+            {'$match': rule},
+            {'$sort': {'username': ASCENDING}},
+            {'$project': {'_id': False, 'username': True,
+                          'points': {'$filter': {
+                              'input': '$points', 'as': 'point',
+                              'cond': {'$and': conditions}}}}}])
+
+    def series_variables(self, videoid):
+        """
+        Find the variables there are series of for a video.
+        :param videoid: The id of the video
+        :return: Sorted list of variable names
+        """
+        return sorted(self.series.distinct('variable', {'videoid': videoid}))
+
+    def rebuild_series(self, batch_size=1000):
+        """
+        Regenerate the series store from the raw posts, which stay the source
+        of truth.
+        :param batch_size: Number of posts processed at once
+        :return: Number of posts processed
+        """
+        self.series.delete_many({})
+        batch = []
+        n = 0
+        for p in self.posts.find({}, {'_id': False}).sort(
+                'timestamp', ASCENDING).batch_size(batch_size):
+            batch.append(p)
+            if len(batch) >= batch_size:
+                self.update_series(batch)
+                n += len(batch)
+                batch = []
+        self.update_series(batch)
+        return n + len(batch)
+
+    def post_variables(self, videoid=None, date_from=None, date_to=None):
+        """
+        Find the names of the slider values stored in the posts, including
+        those of sliders that are no longer configured.
+        :param videoid: Only look at the posts of this video (optional)
+        :param date_from: Only look at the posts saved at or after this date
+        (optional, see query_posts())
+        :param date_to: Only look at the posts saved at or before this date
+        (optional)
+        :return: Sorted list of names
+        """
+        rule = self._build_rule(videoid, date_from=date_from, date_to=date_to)
+        names = self.posts.aggregate([
+            {'$match': rule},
+            {'$project': {'fields': {'$objectToArray': '$$ROOT'}}},
+            {'$unwind': '$fields'},
+            {'$group': {'_id': '$fields.k'}}], allowDiskUse=True)
+        return sorted(n['_id'] for n in names
+                      if n['_id'] not in STANDARD_FIELDS and n['_id'] != '_id')
+
+    def has_untyped(self, field):
+        """
+        Check whether older versions saved a field of some posts as string,
+        which range queries on the field do not find until the posts have
+        been converted (see migrate_types()).
+        :param field: 'timestamp' or 'date'
+        :return: Boolean
+        """
+        return self.posts.find_one({field: {'$type': 'string'}},
+                                   {'_id': True}) is not None
 
     def collect_posts(self):
         """
@@ -56,6 +486,203 @@ class DatabaseClient:
         """
         return self.posts.find()
 
+    def query_posts(self, videoid=None, username=None, start=None, end=None,
+                    variable=None, sort=True, date_from=None, date_to=None,
+                    batch_size=None):
+        """
+        Collect the entries matching the given filters. Filtering, projection
+        and sorting all happen inside MongoDB, so only the requested documents
+        are sent over the wire.
+        :param videoid: Only return posts of this video (optional)
+        :param username: Only return posts of this user, or of any user in
+        the list if a list is given (optional)
+        :param start: Only return posts with timestamp >= start (optional)
+        :param end: Only return posts with timestamp <= end (optional)
+        :param variable: If given, only return the standard fields and this
+        variable instead of all slider values
+        :param sort: Sort the posts by username and timestamp if True, or by
+        the fields in the list if a list of field names is given
+        :param date_from: Only return posts saved at or after this date,
+        given in milliseconds since the epoch (optional)
+        :param date_to: Only return posts saved at or before this date,
+        given in milliseconds since the epoch (optional)
+        :param batch_size: Number of posts fetched per round trip (optional)
+        :return: Cursor over the matching posts (without '_id')
+        """
+        rule = self._build_rule(videoid, username, start, end, date_from,
+                                date_to)
+
+        if variable is None:
+            projection = {'_id': False}
+        else:
+            projection = dict((f, True) for f in STANDARD_FIELDS + [variable])
+            projection['_id'] = False
+
+        cursor = self.posts.find(rule, projection)
+        if sort is True:
+            sort = ['username', 'timestamp']
+        if sort:
+            cursor = cursor.sort([(field, ASCENDING) for field in sort])
+        if batch_size:
+            cursor = cursor.batch_size(batch_size)
+        return cursor
+
+    @staticmethod
+    def _build_rule(videoid=None, username=None, start=None, end=None,
+                    date_from=None, date_to=None):
+        """
+        Build the query selecting posts by video, user, timestamp range and
+        date range. See query_posts() for the parameters.
+        :return: The query
+        """
+        rule = {}
+        if videoid is not None:
+            rule['videoid'] = videoid
+        if username is not None:
+            if isinstance(username, (list, tuple, set)):
+                rule['username'] = {'$in': list(username)}
+            else:
+                rule['username'] = username
+        if start is not None or end is not None:
+            rule['timestamp'] = {}
+            if start is not None:
+                rule['timestamp']['$gte'] = start
+            if end is not None:
+                rule['timestamp']['$lte'] = end
+        if date_from is not None or date_to is not None:
+            rule['date'] = {}
+            if date_from is not None:
+                rule['date']['$gte'] = date_from
+            if date_to is not None:
+                rule['date']['$lte'] = date_to
+        return rule
+
+    def page_posts(self, videoid=None, username=None, start=None, end=None,
+                   sort_field='_id', descending=False, after=None,
+                   limit=100):
+        """
+        Collect one page of posts, using keyset pagination: instead of
+        skipping the posts of all previous pages, the page continues after
+        the last post of the previous page, so every page costs the same.
+        :param videoid: Only return posts of this video (optional)
+        :param username: Only return posts of this user (optional)
+        :param start: Only return posts with timestamp >= start (optional)
+        :param end: Only return posts with timestamp <= end (optional)
+        :param sort_field: Field to sort by, '_id' (order of saving) or
+        'timestamp'
+        :param descending: Sort in descending order
+        :param after: Tuple (value of sort_field, id as string) of the last
+        post of the previous page, None for the first page
+        :param limit: Number of posts on a page
+        :return: List of posts on the page, and a boolean indicating whether
+        there are more posts
+        """
+        rule = self._build_rule(videoid, username, start, end)
+        direction = DESCENDING if descending else ASCENDING
+        op = '$lt' if descending else '$gt'
+
+        if after is not None and ObjectId.is_valid(after[1]):
+            value, last_id = after
+            last_id = ObjectId(last_id)
+            if sort_field == '_id':
+                keyset = {'_id': {op: last_id}}
+            else:
+                keyset = {'$or': [{sort_field: {op: value}},
+                                  {sort_field: value, '_id': {op: last_id}}]}
+            rule = {'$and': [rule, keyset]} if rule else keyset
+
+        if sort_field == '_id':
+            sort = [('_id', direction)]
+        else:
+            sort = [(sort_field, direction), ('_id', direction)]
+        posts = list(self.posts.find(rule).sort(sort).limit(limit + 1))
+        return posts[:limit], len(posts) > limit
+
+    def last_post_id(self, videoid):
+        """
+        Find the id of the newest post of a video.
+        :param videoid: The id of the video
+        :return: The id as string, or None if there are no posts
+        """
+        post = self.posts.find_one({'videoid': videoid}, {'_id': True},
+                                   sort=[('_id', DESCENDING)])
+        return None if post is None else str(post['_id'])
+
+    def posts_after(self, videoid, after=None, variable=None, limit=1000,
+                    overlap=0):
+        """
+        Collect the posts of a video saved after a given post, in the order
+        of their ids.
+
+        The ids are created by the worker processes, from the time in
+        seconds and a per-process part, so a post that another worker writes
+        later can have a smaller id than the last known post. To find such
+        posts, the posts whose ids were created up to overlap seconds before
+        the last known post are returned again; the caller has to drop the
+        ones it already knows.
+        :param videoid: The id of the video
+        :param after: Id (as string) of the last post already known, None to
+        start from the first post
+        :param variable: If given, only return the standard fields and this
+        variable instead of all slider values
+        :param limit: Maximum number of posts after the last known one
+        :param overlap: Seconds of posts before the last known one that are
+        returned again
+        :return: List of posts sorted by id, including their '_id'
+        """
+        rule = {'videoid': videoid}
+        projection = None
+        if variable is not None:
+            projection = dict((f, True) for f in STANDARD_FIELDS + [variable])
+        if after is None or not ObjectId.is_valid(after):
+            return list(self.posts.find(rule, projection).sort(
+                '_id', ASCENDING).limit(limit))
+
+        after = ObjectId(after)
+        posts = []
+        if overlap:
+            since = ObjectId.from_datetime(
+                after.generation_time - datetime.timedelta(seconds=overlap))
+            posts = list(self.posts.find(
+                dict(rule, _id={'$gte': since, '$lte': after}),
+                projection).sort('_id', ASCENDING))
+        return posts + list(self.posts.find(
+            dict(rule, _id={'$gt': after}), projection).sort(
+            '_id', ASCENDING).limit(limit))
+
+    def migrate_types(self, batch_size=1000):
+        """
+        Convert the fields of the posts that were saved as strings to their
+        types (see typed_value()). Values that cannot be converted are left
+        as they are. The series store is not affected, it always holds
+        floats.
+        :param batch_size: Number of posts updated at once
+        :return: Number of converted posts
+        """
+        n = 0
+        operations = []
+        for p in self.posts.find().batch_size(batch_size):
+            changes = {}
+            for field, value in p.items():
+                if field == '_id':
+                    continue
+                try:
+                    typed = typed_value(field, value)
+                except ValueError:
+                    continue
+                if type(typed) is not type(value):
+                    changes[field] = typed
+            if changes:
+                operations.append(UpdateOne({'_id': p['_id']},
+                                            {'$set': changes}))
+            if len(operations) >= batch_size:
+                self.posts.bulk_write(operations, ordered=False)
+                n += len(operations)
+                operations = []
+        if operations:
+            self.posts.bulk_write(operations, ordered=False)
+        return n + len(operations)
+
     def delete_many(self, rule):
         """
         Delete posts according to a rule.
@@ -63,3 +690,4 @@ class DatabaseClient:
         :return: None
         """
         self.posts.delete_many(rule)
+        self.series.delete_many(rule)
@@ -5,70 +5,182 @@ particular webpage.
 """
 from flask import session, url_for, flash, current_app, request
 from werkzeug.routing import RequestRedirect
-import pandas as pd
+import hashlib
+import json
+import math
+import time
 import numpy as np
-from scipy.interpolate import PchipInterpolator
 
-from bokeh.models import HoverTool
-from bokeh.plotting import figure
-from bokeh.embed import components
-from bokeh.palettes import Spectral6
+from app.database_client import STANDARD_FIELDS, typed_value
+from app.ingest_queue import QueueFull
+from app.metrics import stage, count_rows
 
 
 def eucl(a, b):
     return np.sqrt((a - b) ** 2)
 
 
-def collect_mongodbobjects(videoid=None):
+def collect_mongodbobjects(videoid=None, variable=None, start=None, end=None,
+                           users=None):
     """
-    Fetch all data that is stored in the MongoDB database.
-
-    NB: This already processes them as a DataFrame using sort_df(),
-    which means that the names and variable types of the data must be known
-    in advance (they're hardcoded, see sort_df() ).
+    Fetch the data that is stored in the MongoDB database, optionally only
+    for one video, a part of it and some of the users. The filtering is done
+    by the database (using the index on video, user and timestamp), so only
+    the documents of the requested selection are transferred.
+
+    NB: This already processes them as a DataFrame using posts_frame() and
+    sort_df(), which means that the names and variable types of the data
+    must be known in advance (they're hardcoded, see sort_df() ).
+    :param videoid: Only fetch the data of this video (optional)
+    :param variable: Only fetch this variable of the sliders (optional)
+    :param start: Only fetch posts with timestamp >= start (optional)
+    :param end: Only fetch posts with timestamp <= end (optional)
+    :param users: Only fetch posts of the users in this list (optional)
     :return: Boolean indicating availability of data, DataFrame with all db
     entries
     """
-    posts = current_app.d.collect_posts()
-    collected = []
-    for p in posts:
-        if p['_id']:
-            del p['_id']
-        if videoid == None or p['videoid'] == videoid:
-            collected.append(p)
+    with stage('fetch'):
+        df = posts_frame(current_app.d.query_posts(
+            videoid=videoid, username=users, start=start, end=end,
+            variable=variable, batch_size=FRAME_BATCH_SIZE))
+    count_rows('fetch', len(df))
 
     # If there is data at all
-    if collected:
-        df = pd.DataFrame(collected)
+    if len(df):
         df = sort_df(df)
         return True, df
     else:
         return False, None
 
 
+# Number of posts converted to arrays at once by posts_frame():
+FRAME_BATCH_SIZE = 10000
+
+
+def _column(values, dtype):
+    """
+    Convert a list of values to an array, with nan for missing values and
+    values that are not numbers.
+    :param values: The list
+    :param dtype: The type of the array
+    :return: The array
+    """
+    try:
+        return np.array(values, dtype=dtype)
+    except (TypeError, ValueError):
+        import pandas as pd
+        return pd.to_numeric(pd.Series(values, dtype=object),
+                             errors='coerce').values.astype(dtype)
+
+
+def posts_frame(posts, batch_size=FRAME_BATCH_SIZE):
+    """
+    Build a compact dataframe from posts, converting them to arrays batch by
+    batch while they are read instead of first collecting all of them as
+    dictionaries. 'videoid' and 'username' are stored as categoricals (with
+    sorted categories, so the codes sort like the names), 'timestamp' as
+    float64, 'date' as int64 and the slider values as float32.
+    :param posts: Iterable of posts, e.g. a database cursor
+    :param batch_size: Number of posts converted at once
+    :return: The dataframe (empty if there are no posts)
+    """
+    import pandas as pd
+    # Code of every video and user, in order of appearance:
+    id_codes = {'videoid': {}, 'username': {}}
+    # Arrays of every batch, per column:
+    chunks = {'videoid': [], 'username': [], 'timestamp': [], 'date': []}
+    lengths = []
+
+    def convert(batch):
+        for field, codes in id_codes.items():
+            chunks[field].append(np.array(
+                [codes.setdefault(str(p.get(field)), len(codes))
+                 for p in batch],
+                dtype=np.int32))
+        chunks['timestamp'].append(_column([p.get('timestamp') for p in batch],
+                                           np.float64))
+        chunks['date'].append(_column([p.get('date') for p in batch],
+                                      np.float64))
+        variables = set()
+        for p in batch:
+            variables.update(p)
+        for variable in variables.difference(STANDARD_FIELDS + ['_id']):
+            # Batches before this variable appeared have no values for it
+            chunk_list = chunks.setdefault(variable, [
+                np.full(n, np.nan, dtype=np.float32) for n in lengths])
+            chunk_list.append(_column([p.get(variable) for p in batch],
+                                      np.float32))
+        lengths.append(len(batch))
+        for chunk_list in chunks.values():
+            if len(chunk_list) < len(lengths):
+                chunk_list.append(np.full(len(batch), np.nan,
+                                          dtype=np.float32))
+
+    batch = []
+    for post in posts:
+        batch.append(post)
+        if len(batch) >= batch_size:
+            convert(batch)
+            batch = []
+    if batch or not lengths:
+        convert(batch)
+
+    columns = {}
+    for field, codes in id_codes.items():
+        # Renumber the codes so that the categories are sorted
+        names = sorted(codes)
+        renumber = np.empty(len(codes), dtype=np.int32)
+        renumber[[codes[name] for name in names]] = np.arange(len(names))
+        columns[field] = pd.Categorical.from_codes(
+            renumber[np.concatenate(chunks[field])] if names else
+            np.zeros(0, dtype=np.int32),
+            categories=names, ordered=True)
+    date = np.concatenate(chunks['date'])
+    columns['date'] = date.astype(np.int64) if \
+        np.isfinite(date).all() else date
+    for column in sorted(chunks):
+        if column not in columns:
+            columns[column] = np.concatenate(chunks[column])
+    return pd.DataFrame(columns)
+
+
+@stage('sort_df')
 def sort_df(df):
     """
-    Reorder columns in a dataframe, give them suitable data types and sort the
-    values.
+    Reorder the columns in a dataframe, make sure the timestamps, slider
+    values and dates are numbers and sort the rows by username and
+    timestamp.
+
+    The posts are saved with these types and fetched in this order, so
+    usually nothing needs to be converted or sorted. Posts saved as strings
+    by older versions are converted (see 'flask migrate-types'), values that
+    are not numbers become nan.
 
     :param df: Dataframe to be sorted
     :return: Sorted dataframe
     """
-    try:
-        standard_data_cols = ['videoid', 'username', 'timestamp', 'date']
-        user_data_cols = [c for c in list(df.columns.values) if
-                          c not in standard_data_cols]
-        ordered_cols = standard_data_cols[:3] + user_data_cols + \
-                       standard_data_cols[-1:]
-        col_types = ['str', 'str', 'float'] + ['float'] * len(user_data_cols) \
-                    + ['int']
-        df = df[ordered_cols]
-        for t, c in zip(col_types, ordered_cols):
-            df[c] = df[c].astype(t)
-        df.sort_values(ordered_cols, inplace=True)
-    except:
-        print("Error! Values are not in right types")
-        print(df)
+    import pandas as pd
+    standard_data_cols = ['videoid', 'username', 'timestamp', 'date']
+    user_data_cols = [c for c in list(df.columns.values) if
+                      c not in standard_data_cols]
+    ordered_cols = standard_data_cols[:3] + user_data_cols + \
+                   standard_data_cols[-1:]
+    df = df.reindex(columns=ordered_cols)
+    for c in ordered_cols[2:]:
+        if not pd.api.types.is_numeric_dtype(df[c]):
+            df[c] = pd.to_numeric(df[c], errors='coerce')
+
+    usernames = df['username']
+    if pd.api.types.is_categorical_dtype(usernames):
+        # The categories are sorted, so the codes sort like the names
+        usernames = usernames.cat.codes
+    usernames = usernames.values
+    timestamps = df['timestamp'].values
+    same_user = usernames[1:] == usernames[:-1]
+    in_order = np.all(usernames[1:] >= usernames[:-1]) and \
+        np.all(timestamps[1:][same_user] >= timestamps[:-1][same_user])
+    if not in_order:
+        df = df.sort_values(['username', 'timestamp'], kind='mergesort')
     return df
 
 
@@ -99,35 +211,98 @@ def check_access_right(forbidden, redirect_url, msg='default'):
         raise RequestRedirect(url_for(redirect_url))
 
 
-def get_interpolators(df, currentVariable):
+@stage('split_by_user')
+def split_by_user(df, currentVariable):
+    """
+    Split the timestamps and values of a variable into one series per user.
+    The frame is sorted once by (username, timestamp) and the boundaries
+    between users are found with NumPy, instead of grouping and converting
+    every user separately.
+    :param df: Dataframe containing the data
+    :param currentVariable: The name of the column with the values
+    :return: List of usernames, and lists with an array of timestamps and an
+    array of values for each user (in the same order as the usernames)
+    """
+    import pandas as pd
+    if pd.api.types.is_categorical_dtype(df['username']):
+        # Sorted categories, see posts_frame()
+        codes = np.asarray(df['username'].cat.codes)
+        names = np.asarray(df['username'].cat.categories)
+    else:
+        codes, names = pd.factorize(df['username'], sort=True)
+        names = np.asarray(names)
+    if not len(codes):
+        return [], [], []
+    t = np.asarray(df['timestamp'], dtype=float)
+    v = np.asarray(df[currentVariable], dtype=float)
+
+    order = np.lexsort((t, codes))
+    codes = codes[order]
+    # Index of the first row of every user except the first one
+    boundaries = np.flatnonzero(codes[1:] != codes[:-1]) + 1
+    ts = np.split(t[order], boundaries)
+    vals = np.split(v[order], boundaries)
+    starts = np.concatenate([[0], boundaries])
+    return list(names[codes[starts]]), ts, vals
+
+
+def get_interpolators(df, currentVariable, start=None, end=None):
+    """
+    Create an interpolator for the series of each user in a dataframe.
+    :param df: Dataframe containing the data
+    :param currentVariable: The name of the column with the values
+    :param start: Start of the selected part of the video (optional, see
+    interpolate_series())
+    :param end: End of the selected part of the video (optional)
+    :return: List of interpolators (ordered by username), last timestamp
+    """
+    _, ts, vals = split_by_user(df, currentVariable)
+    return interpolate_series(ts, vals, start, end)
 
-    # Group by username and extract timestamps and values for each user
-    grouped_data = df.groupby('username')
-    data_by_user = [user for _, user in grouped_data]
-    ts = [np.array(t) for t in
-          (data_by_user[i]['timestamp'].apply(lambda x: float(x)) for i in
-           range(len(data_by_user)))]
-    vals = [np.array(val) for val in
-            (data_by_user[i][currentVariable].apply(lambda x: float(x)) for i in
-             range(len(data_by_user)))]
 
+@stage('interpolation')
+def interpolate_series(ts, vals, start=None, end=None):
+    """
+    Create an interpolator for each user's series, after padding all series
+    to start and end at the same time: at 0 and the last timestamp of all
+    users, or at the start and end of the selected part of the video if
+    they are given.
+    :param ts: List with a sorted array of timestamps for each user
+    :param vals: List with an array of values for each user
+    :param start: Start of the selected part of the video (optional), no
+    timestamp may be smaller
+    :param end: End of the selected part of the video (optional), no
+    timestamp may be larger. The series end at the last timestamp of all
+    users if it is earlier.
+    :return: List of interpolators, last timestamp
+    """
+    from scipy.interpolate import PchipInterpolator
     # Make sure all data starts and ends at the same time for each user, if the
-    # data doesn't suggest otherwise start and end value are 50.
-    max_t = max([max(t) for t in ts])
-    total = np.sum([np.sum(v) for v in list(np.array(vals))])
+    # data doesn't suggest otherwise start and end value are the average.
+    firsts = np.array([t[0] for t in ts])
+    lasts = np.array([t[-1] for t in ts])
+    min_t = 0. if start is None else start
+    # A window reaching beyond the data ends with the data, so that it does
+    # not inflate the grid:
+    max_t = lasts.max() if end is None else min(end, lasts.max())
+    total = np.sum([v.sum() for v in vals])
     avg = total / np.sum([len(v) for v in vals])
-    for i in range(len(ts)):
-        if min(ts[i]) != 0:
-            ts[i] = np.append([0], ts[i])
-            vals[i] = np.append([avg], vals[i])
-        if max(ts[i]) != max_t:
-            ts[i] = np.append(ts[i], [max_t])
-            vals[i] = np.append(vals[i], [avg])
+
+    padded_ts = []
+    padded_vals = []
+    for t, v, first, last in zip(ts, vals, firsts, lasts):
+        front = [min_t] if first != min_t else []
+        back = [max_t] if last != max_t else []
+        t = np.concatenate((front, t, back))
+        v = np.concatenate(([avg] * len(front), v, [avg] * len(back)))
         # Round last timestamp up (for smoother display):
-        ts[i] = np.append(ts[i][:-1], int(ts[i][-1]) + 1)
+        t[-1] = int(t[-1]) + 1
+        padded_ts.append(t)
+        padded_vals.append(v)
 
     # Create the interpolation
-    interpolators = [PchipInterpolator(t, val) for (t, val) in zip(ts, vals)]
+    interpolators = [PchipInterpolator(t, val) for (t, val) in
+                     zip(padded_ts, padded_vals)]
     return interpolators, max_t
 
 
@@ -137,13 +312,7 @@ def get_videos():
     :return: Dictionary of available videos, each stored as id:name, and list
     containing id and name of the video that is the first one in the file.
     """
-    with open(current_app.vid_file, 'r') as f:
-        videos = f.readlines()
-    vid_list = [x.strip() for x in videos if x.strip() if
-                (x.strip()[0] is not '#')]
-    vid_dict = dict([i.split(':', 1) for i in vid_list])
-    first_vid = vid_list[0].split(':', 1)
-    return vid_dict, first_vid
+    return current_app.vid_store.read()
 
 
 def get_video_information(cur_vid_id='', cur_cluster_num=''):
@@ -178,13 +347,36 @@ def get_input_fields():
     a list itself, containing [slider type, min_val, max_val, default_val,
     slider name].
     """
-    with open(current_app.input_fields, 'r') as f:
-        fields = f.readlines()
-    field_list = [x.strip() for x in fields if x.strip() if
-                  (x.strip()[0] is not '#')]
-    field_list = [i.split(':') for i in field_list]
+    return current_app.input_fields_store.read()
 
-    return field_list
+
+def get_variable_names():
+    """
+    Find the names under which the values of the configured sliders are
+    stored in the database.
+    :return: List of variable names
+    """
+    names = []
+    for field in get_input_fields():
+        if field[0] == 'slider':
+            names.append(field[4])
+        elif field[0] == '2dslider':
+            # Values of 2d-sliders are saved as 'value' and 'value2':
+            names += ['value', 'value2']
+    # Remove duplicates, keeping the order:
+    return [n for i, n in enumerate(names) if n not in names[:i]]
+
+
+def cache_key(key):
+    """
+    Prefix a key of the cache with the namespace of the app and the database
+    it uses, so that apps or databases sharing the cache file do not read
+    each other's results.
+    :param key: The key
+    :return: The prefixed key
+    """
+    return '{}_{}_{}'.format(current_app.cache_namespace,
+                             current_app.d.target, key)
 
 
 def signal_data_modification(video_id):
@@ -192,8 +384,430 @@ def signal_data_modification(video_id):
     Signal cache that data of specified video id has changed. This causes
     re-calculating plots later.
     """
-    current_app.config['CACHE'].set(video_id + 'modified_correlations', True)
-    current_app.config['CACHE'].set(video_id + 'modified_chart', True)
+    cache = current_app.config['CACHE']
+    for purpose in ('correlations', 'chart'):
+        _generation(cache, video_id, purpose)
+        cache.inc(cache_key(video_id + 'generation_' + purpose))
+
+
+def get_generation(videoid, purpose):
+    """
+    Find the generation of the data of a video, a counter which
+    signal_data_modification() increases every time the data changes.
+    Results computed from the data are stored under the generation, so that
+    old results are never found again.
+    :param videoid: The id of the video
+    :param purpose: Which counter to use, 'chart' or 'correlations'
+    :return: The generation
+    """
+    return _generation(current_app.config['CACHE'], videoid, purpose)
+
+
+def _generation(cache, videoid, purpose):
+    """
+    Read the generation counter of a video, starting it if it is missing.
+    It starts at the current time in milliseconds instead of 0, so that a
+    counter that was evicted from the cache does not start again at a
+    generation whose results may still be cached.
+    :param cache: The cache
+    :param videoid: The id of the video
+    :param purpose: 'chart' or 'correlations'
+    :return: The generation
+    """
+    key = cache_key(videoid + 'generation_' + purpose)
+    generation = cache.get(key)
+    if generation is None:
+        # add() is atomic, so all workers start from the same value
+        cache.add(key, int(time.time() * 1000))
+        generation = cache.get(key)
+    return generation
+
+
+# Seconds the result of untyped_posts() is cached:
+UNTYPED_CHECK_SECONDS = 600
+
+
+def untyped_posts(field):
+    """
+    Check whether older versions saved a field of some posts as string,
+    which range queries on the field do not find until 'flask
+    migrate-types' has converted them. The answer is cached for
+    UNTYPED_CHECK_SECONDS.
+    :param field: 'timestamp' or 'date'
+    :return: Boolean
+    """
+    cache = current_app.config['CACHE']
+    key = cache_key('untyped_' + field)
+    untyped = cache.get(key)
+    if untyped is None:
+        untyped = current_app.d.has_untyped(field)
+        cache.set(key, untyped, timeout=UNTYPED_CHECK_SECONDS)
+    return untyped
+
+
+def get_cached(videoid, purpose, key, compute, generation=None):
+    """
+    Look up a result computed from the data of a video in the cache, or
+    compute and cache it. Cached results are only used as long as the data of
+    the video has not been modified, i.e. as long as
+    signal_data_modification() has not increased its generation.
+    :param videoid: The id of the video the result belongs to
+    :param purpose: Which generation counter to use, 'chart' or
+    'correlations'
+    :param key: Further key of the result, e.g. the requested variable
+    :param compute: Function without arguments computing the result
+    :param generation: The generation of the data as returned by
+    get_generation(), looked up if not given
+    :return: The (cached) result
+    """
+    cache = current_app.config['CACHE']
+    if generation is None:
+        generation = get_generation(videoid, purpose)
+
+    result_key = cache_key('{}_{}_{}_{}'.format(videoid, purpose, generation,
+                                                key))
+    result = cache.get(result_key)
+    if result is None:
+        result = compute()
+        cache.set(result_key, result)
+    return result
+
+
+def get_selection(args, start='start', end='end'):
+    """
+    Parse the part of a video and the users an analysis is restricted to, as
+    requested by the website. Without a selection the whole video is
+    analysed for all users.
+    :param args: The arguments of the request
+    :param start: Name of the argument with the first timestamp
+    :param end: Name of the argument with the last timestamp
+    :return: Dictionary with the 'start' and 'end' timestamps and the sorted
+    list of 'users' (each None if not selected)
+    """
+    selection = {'start': None, 'end': None, 'users': None}
+    for key, name in [('start', start), ('end', end)]:
+        try:
+            value = float(args.get(name))
+        except (TypeError, ValueError):
+            continue
+        if math.isfinite(value) and value >= 0:
+            selection[key] = value
+    if selection['start'] is not None and selection['end'] is not None and \
+            selection['start'] >= selection['end']:
+        # Not a part of the video
+        selection['start'] = selection['end'] = None
+    # Users can be given as repeated argument or as comma separated list
+    users = set(u.strip() for arg in args.getlist('users')
+                for u in arg.split(','))
+    users.discard('')
+    if users:
+        selection['users'] = sorted(users)
+    return selection
+
+
+def selection_key(request_variable, selection=None):
+    """
+    :param request_variable: The variable requested by the website
+    :param selection: The selection, as returned by get_selection()
+    (optional)
+    :return: The key of results computed for the variable and selection,
+    see get_cached()
+    """
+    if not selection or all(v is None for v in selection.values()):
+        return request_variable
+    return '{}_{}'.format(request_variable, hashlib.sha1(json.dumps(
+        [selection['start'], selection['end'], selection['users']]).encode(
+        'utf-8')).hexdigest())
+
+
+def resample_users(videoid, request_variable=None, start=None, end=None,
+                   users=None):
+    """
+    Fetch the data of a video and resample the series of every user on a
+    common grid of one sample per second using get_interpolators(). The
+    analysis can be restricted to a part of the video and to some of the
+    users, in which case only their data is fetched and the grid only spans
+    the selected part.
+
+    The result is cached until the data of the video changes.
+    :param videoid: The id of the video
+    :param request_variable: The variable requested by the website
+    :param start: Start of the selected part of the video (optional)
+    :param end: End of the selected part of the video (optional)
+    :param users: List of the selected users (optional)
+    :return: None if there is no data, otherwise a dictionary with the
+    entries 'variable', 'variable_list', 'usernames', 'xs' (the grid),
+    'matrix' (users x len(xs) array of resampled values), 'selection' (the
+    selected part and users) and 'generation' (the generation of the data,
+    see get_generation())
+    """
+    selection = {'start': start, 'end': end, 'users': users}
+
+    def compute():
+        if current_app.config['USE_SERIES_STORE']:
+            return resample_from_series_store(videoid, request_variable,
+                                              start, end, users)
+        currentVariable, variable_list = select_variable(videoid,
+                                                         request_variable)
+        if currentVariable is None:
+            return {'found': False}
+        found, data = collect_mongodbobjects(videoid, currentVariable,
+                                             start=start, end=end,
+                                             users=users)
+        if not found or currentVariable not in data.columns:
+            return {'found': False}
+        data, _, _ = extract_variable(data, currentVariable)
+        if data.empty:
+            return {'found': False}
+        usernames, ts, vals = split_by_user(data, currentVariable)
+        interpolators, max_t = interpolate_series(ts, vals, start, end)
+        xs = np.arange(start or 0, int(max_t) + 1.5, 1)
+        with stage('resample'):
+            matrix = np.array([interpolator(xs) for interpolator in
+                               interpolators])
+        return {'found': True, 'variable': currentVariable,
+                'variable_list': variable_list, 'usernames': usernames,
+                'xs': xs, 'matrix': matrix}
+
+    generation = get_generation(videoid, 'correlations')
+    result = get_cached(videoid, 'correlations',
+                        selection_key(request_variable, selection), compute,
+                        generation)
+    if not result['found']:
+        return None
+    result['generation'] = generation
+    result['selection'] = selection
+    return result
+
+
+def resample_from_series_store(videoid, request_variable=None, start=None,
+                               end=None, users=None):
+    """
+    Like resample_users(), but read the ready-made series of every user from
+    the series store instead of regrouping the raw posts.
+    :param videoid: The id of the video
+    :param request_variable: The variable requested by the website
+    :param start: Start of the selected part of the video (optional)
+    :param end: End of the selected part of the video (optional)
+    :param users: List of the selected users (optional)
+    :return: Dictionary as described in resample_users(), with 'found'
+    indicating whether there is data
+    """
+    variable_list = current_app.d.series_variables(videoid)
+    if not variable_list:
+        return {'found': False}
+    if request_variable in variable_list:
+        currentVariable = request_variable
+    else:
+        currentVariable = variable_list[0]
+
+    usernames, ts, vals = [], [], []
+    for s in current_app.d.collect_series(videoid, currentVariable,
+                                          username=users, start=start,
+                                          end=end):
+        if not s['points']:
+            # No values in the selected part
+            continue
+        usernames.append(s['username'])
+        ts.append(np.array([p['t'] for p in s['points']], dtype=float))
+        vals.append(np.array([p['v'] for p in s['points']], dtype=float))
+    if not usernames:
+        return {'found': False}
+
+    interpolators, max_t = interpolate_series(ts, vals, start, end)
+    xs = np.arange(start or 0, int(max_t) + 1.5, 1)
+    with stage('resample'):
+        matrix = np.array([interpolator(xs) for interpolator in
+                           interpolators])
+    return {'found': True, 'variable': currentVariable,
+            'variable_list': variable_list, 'usernames': usernames,
+            'xs': xs, 'matrix': matrix}
+
+
+def cluster_statistics(matrix, labels, centers, percentiles=(5, 25, 50, 75,
+                                                             95)):
+    """
+    Calculate statistics of each cluster for a clustering of the users'
+    series, using array operations over the whole users x time matrix.
+
+    The dispersion sigma of a cluster is the square root of the sum, over its
+    members, of the mean absolute distance between the member and the
+    cluster center.
+    :param matrix: Users x time array of resampled values
+    :param labels: Array with the cluster of each user
+    :param centers: Clusters x time array of cluster centers
+    :param percentiles: The percentiles to calculate at every timestamp
+    :return: List with a dictionary for each cluster containing 'cluster'
+    (its number), 'size', 'center' (the center series), 'center_mean',
+    'sigma', 'variance' and 'percentiles' (dictionary from percentile to
+    the series of that percentile over the members)
+    """
+    matrix = np.asarray(matrix, dtype=float)
+    labels = np.asarray(labels)
+    centers = np.asarray(centers, dtype=float).reshape(len(centers), -1)
+    n_clusters = len(centers)
+
+    sizes = np.bincount(labels, minlength=n_clusters)
+    # Mean absolute distance of every user to the center of its cluster:
+    distances = np.abs(matrix - centers[labels]).mean(axis=1)
+    variances = np.bincount(labels, weights=distances, minlength=n_clusters)
+    center_means = centers.mean(axis=1)
+
+    stats = []
+    for k in range(n_clusters):
+        members = matrix[labels == k]
+        if len(members):
+            q = np.percentile(members, percentiles, axis=0)
+        else:
+            q = np.full((len(percentiles), matrix.shape[1]), np.nan)
+        stats.append({'cluster': k, 'size': int(sizes[k]),
+                      'center': centers[k],
+                      'center_mean': center_means[k],
+                      'sigma': np.sqrt(variances[k]),
+                      'variance': variances[k],
+                      'percentiles': dict(zip(percentiles, q))})
+    return stats
+
+
+def lttb(x, y, n_out):
+    """
+    Downsample a series with the Largest-Triangle-Three-Buckets algorithm,
+    which keeps the points that matter for the visual shape of the series.
+    The first and last points are always kept, and from each of the
+    n_out - 2 buckets in between the point forming the largest triangle with
+    the previously chosen point and the average of the next bucket.
+
+    Instead of going through the buckets one by one, the points of all
+    buckets are chosen at once with numpy, starting with the averages of the
+    buckets in place of the previously chosen points. This is repeated with
+    the points chosen in the last pass until they do not change anymore,
+    which gives the same points as going through the buckets one by one
+    (after at most n_out - 2 passes, usually after a few).
+    :param x: Sorted array of x values
+    :param y: Array of y values
+    :param n_out: Number of points to keep
+    :return: Downsampled x and y arrays (x and y themselves if they have at
+    most n_out points)
+    """
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return x, y
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+
+    # Bucket i holds the points starts[i] to starts[i] + sizes[i] - 1
+    edges = np.floor(np.linspace(1, n - 1, n_out - 1)).astype(int)
+    starts, sizes = edges[:-1], np.diff(edges)
+    avg_x = np.add.reduceat(x[:-1], starts) / sizes
+    avg_y = np.add.reduceat(y[:-1], starts) / sizes
+    # The average of the next bucket, which is the last point for the last
+    # bucket:
+    next_x = np.append(avg_x[1:], x[-1])[:, np.newaxis]
+    next_y = np.append(avg_y[1:], y[-1])[:, np.newaxis]
+
+    # The points of the buckets in the rows of a matrix, padded with -inf
+    # (masked) where a bucket has fewer points than the largest:
+    columns = np.arange(sizes.max())
+    index = starts[:, np.newaxis] + columns
+    padding = columns >= sizes[:, np.newaxis]
+    index[padding] = 0
+    bucket_x, bucket_y = x[index], y[index]
+
+    previous_x = np.append(x[0], avg_x[:-1])[:, np.newaxis]
+    previous_y = np.append(y[0], avg_y[:-1])[:, np.newaxis]
+    chosen = None
+    for _ in range(n_out - 2):
+        area = np.abs((previous_x - next_x) * (bucket_y - previous_y) -
+                      (previous_x - bucket_x) * (next_y - previous_y))
+        area[padding] = -np.inf
+        new = starts + np.argmax(area, axis=1)
+        if chosen is not None and np.array_equal(new, chosen):
+            break
+        chosen = new
+        previous_x = np.append(x[0], x[chosen[:-1]])[:, np.newaxis]
+        previous_y = np.append(y[0], y[chosen[:-1]])[:, np.newaxis]
+
+    chosen = np.concatenate([[0], chosen, [n - 1]])
+    return x[chosen], y[chosen]
+
+
+def coerce_post(post, variable_names):
+    """
+    Check a post against the configured sliders and convert its fields to
+    the types they are stored with (see typed_value()), so that the analysis
+    can use the values without converting them.
+    :param post: The post, as received from the website
+    :param variable_names: The names of the slider values that may be saved,
+    see get_variable_names()
+    :return: The converted post
+    :raises ValueError: If a field is missing, has an unknown name or is not
+    a finite number
+    """
+    typed = {}
+    for field in STANDARD_FIELDS:
+        typed[field] = typed_value(field, post.get(field))
+    for field, value in post.items():
+        if field in STANDARD_FIELDS:
+            continue
+        if field not in variable_names:
+            raise ValueError('"' + str(field) + '" is not a configured '
+                                                'slider.')
+        typed[field] = typed_value(field, value)
+    if len(typed) == len(STANDARD_FIELDS):
+        raise ValueError('The post has no slider values.')
+    return typed
+
+
+def store_posts(posts, rejected=None):
+    """
+    Check and convert posts (see coerce_post()) and hand them over to the
+    write-behind queue, which writes them to the database in the background.
+    Invalid posts are not saved.
+    :param posts: List of posts
+    :param rejected: List to which the index and the error message of every
+    invalid post are added (optional)
+    :return: None, or a (message, status, headers) response if no post is
+    valid, or telling the client to retry later if the queue is full
+    """
+    variable_names = get_variable_names()
+    valid = []
+    error = None
+    for i, post in enumerate(posts):
+        try:
+            valid.append(coerce_post(post, variable_names))
+        except ValueError as e:
+            error = str(e)
+            if rejected is not None:
+                rejected.append((i, error))
+    if error is not None:
+        count_rows('rejected', len(posts) - len(valid))
+        if not valid:
+            return "Error: " + error, 400, {}
+    try:
+        current_app.ingest.put(valid)
+    except QueueFull:
+        retry_after = str(current_app.config['INGEST_RETRY_AFTER'])
+        return "Error: server busy, try again later", 503, \
+               {'Retry-After': retry_after}
+    return None
+
+
+def select_variable(videoid, request_variable):
+    """
+    Choose the variable to analyse from the ones stored for a video, before
+    fetching the data, so that only this variable has to be fetched: the
+    requested one if it is stored, otherwise the first.
+    :param videoid: The id of the video
+    :param request_variable: The variable requested by the website
+    :return: The variable (None if no variable is stored for the video) and
+    the list of all variables
+    """
+    variable_list = current_app.d.post_variables(videoid)
+    if not variable_list:
+        return None, []
+    if request_variable in variable_list:
+        return request_variable, variable_list
+    return variable_list[0], variable_list
 
 
 def extract_variable(data, request_variable):
@@ -207,6 +821,7 @@ def extract_variable(data, request_variable):
    :param request_variable: The name of the column in the dataframe
    :return: data, currentVariable, list of all possible variables
    """
+    import pandas as pd
     columns = data.columns.values
     other_columns = ['date', 'videoid', 'timestamp', 'username']
     variable_list = [x for x in columns if x not in other_columns]
@@ -216,6 +831,5 @@ def extract_variable(data, request_variable):
     else:
         currentVariable = variable_list[0]
 
-    data = data.replace('nan', np.nan)
     data = data[pd.notna(data[currentVariable])]
     return data, currentVariable, variable_list
@@ -0,0 +1,260 @@
+"""
+This file contains the write-behind queue for annotation posts.
+
+Instead of writing every post to the database inside the request, the save
+routes put the posts into this queue and return immediately. A background
+thread takes the posts out of the queue and writes them to the database in
+batches. Posts that cannot be written are retried a limited number of
+times and then dropped (and logged).
+"""
+import atexit
+import logging
+import threading
+import time
+from collections import deque
+
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFull(Exception):
+    """
+    Raised when posts are added to a queue that has no space left.
+    """
+    pass
+
+
+class PartialWrite(Exception):
+    """
+    Raised by a sink that wrote only some of the posts it was given.
+    """
+
+    def __init__(self, message, written, failed):
+        """
+        :param message: Description of the error
+        :param written: List of the posts that have been written
+        :param failed: List of the posts that have not been written
+        """
+        super().__init__(message)
+        self.written = written
+        self.failed = failed
+
+
+class WriteBehindQueue:
+    """
+    Bounded queue of posts that is flushed to the database by a background
+    thread.
+    """
+
+    def __init__(self, sink, batch_size=500, flush_interval=0.5,
+                 max_size=50000, on_flush=None, max_attempts=5):
+        """
+        Create the queue. The flusher thread is started lazily when the
+        first post is added, so that it is created in the (forked) worker
+        process that actually uses it.
+        :param sink: Function that writes a list of posts to the database.
+        It raises PartialWrite if only some of the posts have been written.
+        Writing a post again after it has been written must not store it
+        twice (see DatabaseClient.insert_posts()).
+        :param batch_size: Maximum number of posts written at once
+        :param flush_interval: Seconds to wait for more posts before flushing
+        :param max_size: Maximum number of posts waiting in the queue
+        :param on_flush: Function called with the list of posts after they
+        have been written (optional)
+        :param max_attempts: Number of times writing a post is attempted
+        before it is dropped
+        """
+        self.sink = sink
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_size = max_size
+        self.on_flush = on_flush
+        self.max_attempts = max_attempts
+
+        self._posts = deque()
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._thread = None
+        self._stopping = False
+        self._registered = False
+        # Failed attempts to write each post, by id() of the post:
+        self._attempts = {}
+
+        # Counters:
+        self.enqueued = 0
+        self.rejected = 0
+        self.flushed = 0
+        self.failed_flushes = 0
+        self.dropped = 0
+        self.flush_count = 0
+        self.flush_seconds_total = 0.0
+        self.flush_seconds_max = 0.0
+
+    def put(self, posts):
+        """
+        Add posts to the queue.
+        :param posts: List of posts
+        :return: None
+        :raises QueueFull: If the posts do not fit into the queue
+        """
+        with self._lock:
+            if self._stopping:
+                raise QueueFull('The queue is shutting down.')
+            if len(self._posts) + len(posts) > self.max_size:
+                self.rejected += len(posts)
+                raise QueueFull('The ingestion queue is full.')
+            self._posts.extend(posts)
+            self.enqueued += len(posts)
+            if len(self._posts) >= self.batch_size:
+                self._not_empty.notify()
+            self._start()
+
+    def _start(self):
+        """
+        Start the flusher thread if it is not running. Must be called with
+        the lock held.
+        :return: None
+        """
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run,
+                                            name='ingest-flusher')
+            self._thread.daemon = True
+            self._thread.start()
+            if not self._registered:
+                atexit.register(self.stop)
+                self._registered = True
+
+    def _take_batch(self):
+        """
+        Remove up to batch_size posts from the queue. Must be called with
+        the lock held.
+        :return: List of posts
+        """
+        n = min(self.batch_size, len(self._posts))
+        return [self._posts.popleft() for _ in range(n)]
+
+    def _run(self):
+        """
+        Main loop of the flusher thread.
+        :return: None
+        """
+        while True:
+            with self._lock:
+                if not self._stopping and len(self._posts) < self.batch_size:
+                    self._not_empty.wait(self.flush_interval)
+                batch = self._take_batch()
+                if not batch and self._stopping:
+                    return
+            if batch:
+                self._flush(batch)
+
+    def _flush(self, batch):
+        """
+        Write a batch of posts to the database. The posts that could not be
+        written are put back to the front of the queue and retried later,
+        until they have failed max_attempts times.
+        :param batch: List of posts
+        :return: None
+        """
+        start = time.time()
+        try:
+            self.sink(batch)
+            written, failed = batch, []
+        except PartialWrite as e:
+            logger.error('Writing %d of %d posts failed, retrying later: %s',
+                         len(e.failed), len(batch), e)
+            # These posts have not been written, so they get a new _id when
+            # they are written again
+            written = e.written
+            failed = e.failed
+            for post in failed:
+                post.pop('_id', None)
+        except Exception:
+            logger.exception('Writing %d posts failed, retrying later.',
+                             len(batch))
+            # Whether the posts have been written is unknown, so they keep
+            # their _id, which lets the sink recognise the written ones
+            written, failed = [], batch
+        duration = time.time() - start
+
+        if failed:
+            self._retry(failed)
+        with self._lock:
+            for post in written:
+                self._attempts.pop(id(post), None)
+            self.flushed += len(written)
+            self.flush_count += 1
+            self.flush_seconds_total += duration
+            self.flush_seconds_max = max(self.flush_seconds_max, duration)
+
+        if written and self.on_flush is not None:
+            try:
+                self.on_flush(written)
+            except Exception:
+                logger.exception('Post-flush callback failed.')
+        if failed:
+            # Give the database time to recover, also while stopping
+            time.sleep(self.flush_interval)
+
+    def _retry(self, posts):
+        """
+        Put posts that could not be written back to the front of the queue,
+        or drop them if they have failed too often.
+        :param posts: List of posts
+        :return: None
+        """
+        retry = []
+        dropped = []
+        with self._lock:
+            self.failed_flushes += 1
+            for post in posts:
+                attempts = self._attempts.get(id(post), 0) + 1
+                if attempts >= self.max_attempts:
+                    self._attempts.pop(id(post), None)
+                    dropped.append(post)
+                else:
+                    self._attempts[id(post)] = attempts
+                    retry.append(post)
+            self._posts.extendleft(reversed(retry))
+            self.dropped += len(dropped)
+        if dropped:
+            logger.error('Dropping %d posts after %d failed attempts: %r',
+                         len(dropped), self.max_attempts, dropped)
+
+    def stop(self, timeout=30):
+        """
+        Stop accepting posts, write all queued posts and stop the flusher
+        thread.
+        :param timeout: Seconds to wait for the queue to be drained
+        :return: None
+        """
+        with self._lock:
+            self._stopping = True
+            self._not_empty.notify()
+            thread = self._thread
+        if thread is not None and thread.is_alive():
+            thread.join(timeout)
+
+    def depth(self):
+        """
+        :return: Number of posts waiting in the queue
+        """
+        with self._lock:
+            return len(self._posts)
+
+    def stats(self):
+        """
+        Collect the counters of the queue.
+        :return: Dictionary with queue depth and flush statistics
+        """
+        with self._lock:
+            return {'depth': len(self._posts),
+                    'max_size': self.max_size,
+                    'enqueued': self.enqueued,
+                    'rejected': self.rejected,
+                    'flushed': self.flushed,
+                    'failed_flushes': self.failed_flushes,
+                    'dropped': self.dropped,
+                    'flush_count': self.flush_count,
+                    'flush_seconds_total': self.flush_seconds_total,
+                    'flush_seconds_max': self.flush_seconds_max}
@@ -0,0 +1,273 @@
+"""
+This file contains the job manager, which runs expensive computations (like
+clustering) in a pool of worker processes instead of inside the request.
+
+A job is identified by a key describing what it computes. Submitting a job
+whose key is already running or finished returns the id of that job instead
+of starting the computation again, and finished results (and errors) are
+kept for reuse.
+
+Every worker process has its own pool. So that a page computed by one worker
+can be polled and reloaded through any other one, the outcomes of the jobs
+and which jobs are running are also kept in a store shared by the workers
+(the cache of the app).
+
+The pool starts its processes with the forkserver (or spawn) method rather
+than by forking the worker, which has threads and open database connections.
+A pool whose process died is replaced by a new one. The failure of the jobs
+it was running is only kept for a short time, so they can be submitted
+again.
+"""
+import hashlib
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from app.metrics import metrics
+
+
+logger = logging.getLogger(__name__)
+
+# Seconds the failure of a job whose process died is kept:
+CRASH_TIMEOUT = 60
+
+
+class JobManager:
+    """
+    Runs jobs in a process pool and keeps track of their results.
+    """
+
+    def __init__(self, max_workers=None, keep=100, store=None,
+                 running_timeout=600, start_method='forkserver',
+                 namespace=''):
+        """
+        Create the job manager. The process pool is created lazily when the
+        first job is submitted, so that it belongs to the (forked) worker
+        process that uses it.
+        :param max_workers: Number of processes in the pool (defaults to the
+        number of cores)
+        :param keep: Number of finished jobs whose results are kept
+        :param store: Cache shared with the other worker processes (optional)
+        :param running_timeout: Seconds after which a job another process
+        started is no longer considered running (e.g. because the process
+        died)
+        :param start_method: How the processes of the pool are started
+        ('forkserver' or 'spawn'; 'spawn' is used where forkserver is not
+        available)
+        :param namespace: Prefix of the keys in the store, so that apps
+        sharing it do not see each other's jobs
+        """
+        self.max_workers = max_workers
+        self.keep = keep
+        self.store = store
+        self.running_timeout = running_timeout
+        self.namespace = namespace
+        if start_method not in multiprocessing.get_all_start_methods():
+            start_method = 'spawn'
+        self._context = multiprocessing.get_context(start_method)
+
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+        # Jobs that are running, as job id: future
+        self._running = {}
+        # Finished jobs, as job id: (status, result or error message)
+        self._finished = OrderedDict()
+
+    @staticmethod
+    def job_id(key):
+        """
+        :param key: The key of a job, e.g. a tuple of its parameters
+        :return: The id of the job with this key
+        """
+        return hashlib.sha1(repr(key).encode('utf-8')).hexdigest()[:16]
+
+    def _key(self, kind, job_id):
+        """
+        :param kind: 'job_' for the outcome, 'job_running_' for the marker
+        :param job_id: The id of a job
+        :return: The key of the job in the store
+        """
+        return self.namespace + kind + job_id
+
+    def _get_executor(self):
+        """
+        Get the process pool, creating it if it does not exist in this
+        process yet or is broken. Must be called with the lock held.
+        :return: The process pool
+        """
+        if self._executor is None or self._pid != os.getpid():
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.max_workers, mp_context=self._context)
+            self._pid = os.getpid()
+            self._running = {}
+        return self._executor
+
+    def _start(self, function, *args):
+        """
+        Submit a function to the process pool, replacing the pool if it is
+        broken. Must be called with the lock held.
+        :return: The pool and the future of the job
+        """
+        executor = self._get_executor()
+        try:
+            return executor, executor.submit(function, *args)
+        except BrokenProcessPool:
+            logger.warning('The process pool is broken, starting a new one.')
+            if self._executor is executor:
+                self._executor = None
+            executor.shutdown(wait=False)
+            executor = self._get_executor()
+            return executor, executor.submit(function, *args)
+
+    def submit(self, key, function, *args):
+        """
+        Run function(*args) as a job, unless a job with the same key is
+        already running (in any worker process) or has finished. Failed jobs
+        are not run again, their key has to change (e.g. because the data
+        changed), unless the process running them died.
+        :param key: The key of the job
+        :param function: The function to run, which has to be picklable
+        (i.e. defined at the top level of a module)
+        :param args: The arguments of the function
+        :return: The id of the job
+        """
+        job_id = self.job_id(key)
+        with self._lock:
+            if job_id in self._running:
+                return job_id
+            if job_id in self._finished:
+                self._finished.move_to_end(job_id)
+                return job_id
+        if self._outcome(job_id) is not None:
+            return job_id
+        if self.store is not None and not self.store.add(
+                self._key('job_running_', job_id), os.getpid(),
+                self.running_timeout):
+            # Another worker process is computing it
+            return job_id
+        try:
+            with self._lock:
+                executor, future = self._start(function, *args)
+                self._running[job_id] = future
+        except Exception:
+            if self.store is not None:
+                self.store.delete(self._key('job_running_', job_id))
+            raise
+        start = time.perf_counter()
+        future.add_done_callback(
+            lambda f: self._finish(job_id, f, function.__name__, start,
+                                   executor))
+        return job_id
+
+    def _finish(self, job_id, future, name, start, executor):
+        """
+        Store the result of a finished job.
+        :param job_id: The id of the job
+        :param future: The future of the job
+        :param name: The name of the function of the job
+        :param start: Time (time.perf_counter()) the job was submitted
+        :param executor: The process pool that ran the job
+        :return: None
+        """
+        crashed = False
+        try:
+            outcome = ('done', future.result())
+        except BrokenProcessPool:
+            logger.exception('The process of job %s died.', job_id)
+            crashed = True
+            outcome = ('failed', 'The process computing the job died.')
+        except Exception as e:
+            logger.exception('Job %s failed.', job_id)
+            outcome = ('failed', str(e))
+        metrics.observe('app_job_seconds', time.perf_counter() - start,
+                        function=name, status=outcome[0])
+        if not crashed:
+            self._keep(job_id, outcome)
+        with self._lock:
+            self._running.pop(job_id, None)
+            # The broken pool shuts itself down, the next job starts a new
+            # one
+            if crashed and self._executor is executor:
+                self._executor = None
+        if self.store is not None:
+            try:
+                # The failure of a crashed job does not depend on its
+                # arguments, so it is kept only briefly
+                self.store.set(self._key('job_', job_id), outcome,
+                               CRASH_TIMEOUT if crashed else None)
+                self.store.delete(self._key('job_running_', job_id))
+            except Exception:
+                logger.exception('Storing the outcome of job %s failed.',
+                                 job_id)
+
+    def _keep(self, job_id, outcome):
+        """
+        Keep the outcome of a finished job in this process.
+        :param job_id: The id of the job
+        :param outcome: Tuple of status and result or error message
+        :return: None
+        """
+        with self._lock:
+            self._finished[job_id] = outcome
+            while len(self._finished) > self.keep:
+                self._finished.popitem(last=False)
+
+    def _outcome(self, job_id):
+        """
+        Look up the outcome of a finished job, in this process or in the
+        shared store.
+        :param job_id: The id of the job
+        :return: Tuple of status ('done' or 'failed') and result or error
+        message, or None if the job has not finished
+        """
+        with self._lock:
+            outcome = self._finished.get(job_id)
+        if outcome is None and self.store is not None:
+            outcome = self.store.get(self._key('job_', job_id))
+            # Failures are not copied, as they may expire (see _finish())
+            if outcome is not None and outcome[0] == 'done':
+                self._keep(job_id, outcome)
+        return outcome
+
+    def status(self, job_id):
+        """
+        :param job_id: The id of a job
+        :return: 'running', 'done', 'failed' or 'unknown'
+        """
+        with self._lock:
+            if job_id in self._running:
+                return 'running'
+        outcome = self._outcome(job_id)
+        if outcome is not None:
+            return outcome[0]
+        if self.store is not None and \
+                self.store.has(self._key('job_running_', job_id)):
+            return 'running'
+        return 'unknown'
+
+    def result(self, job_id):
+        """
+        :param job_id: The id of a job
+        :return: The result of the job if it has finished successfully,
+        otherwise None
+        """
+        outcome = self._outcome(job_id)
+        if outcome is None or outcome[0] != 'done':
+            return None
+        return outcome[1]
+
+    def error(self, job_id):
+        """
+        :param job_id: The id of a job
+        :return: The error message if the job failed, otherwise None
+        """
+        outcome = self._outcome(job_id)
+        if outcome is None or outcome[0] != 'failed':
+            return None
+        return outcome[1]
@@ -0,0 +1,273 @@
+"""
+This file contains the instrumentation of the app: latency histograms of
+every request and of the stages of the analysis (fetching the data,
+building the dataframe, interpolation, k-means, Bokeh serialization), counts
+of the processed rows, and an optional profiler recording a sample of the
+requests with cProfile.
+
+The metrics are kept per worker process and exported in the Prometheus text
+format at /metrics.
+"""
+import cProfile
+import os
+import random
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import g, request
+
+# Upper bounds of the histogram buckets, in seconds:
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+           30.0, 60.0)
+
+
+class Metrics:
+    """
+    Registry of histograms and counters, each identified by its name and
+    labels.
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        # (name, labels): [bucket counts, sum, count]
+        self._histograms = {}
+        # (name, labels): value
+        self._counters = {}
+        self._help = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def describe(self, name, text):
+        """
+        Set the help text of a metric.
+        :param name: The name of the metric
+        :param text: The help text
+        :return: None
+        """
+        self._help[name] = text
+
+    def observe(self, name, seconds, **labels):
+        """
+        Add a duration to a histogram.
+        :param name: The name of the histogram
+        :param seconds: The duration
+        :param labels: The labels of the histogram
+        :return: None
+        """
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = \
+                    [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    def count(self, name, n=1, **labels):
+        """
+        Increase a counter.
+        :param name: The name of the counter
+        :param n: The increment
+        :param labels: The labels of the counter
+        :return: None
+        """
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + n
+
+    def render(self, gauges=()):
+        """
+        Write all metrics in the Prometheus text format.
+        :param gauges: Further values to include, as list of (name, labels,
+        value)
+        :return: The metrics as string
+        """
+        lines = []
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            counters = sorted(self._counters.items())
+        written = set()
+
+        def header(name, kind):
+            if name not in written:
+                written.add(name)
+                if name in self._help:
+                    lines.append('# HELP {} {}'.format(name,
+                                                       self._help[name]))
+                lines.append('# TYPE {} {}'.format(name, kind))
+
+        for (name, labels), (buckets, total, n) in histograms:
+            header(name, 'histogram')
+            for bound, count in zip(self.buckets, buckets):
+                lines.append('{}_bucket{} {}'.format(
+                    name, _labels(labels + (('le', repr(bound)),)), count))
+            lines.append('{}_bucket{} {}'.format(
+                name, _labels(labels + (('le', '+Inf'),)), n))
+            lines.append('{}_sum{} {!r}'.format(name, _labels(labels),
+                                                float(total)))
+            lines.append('{}_count{} {}'.format(name, _labels(labels), n))
+        for (name, labels), value in counters:
+            header(name, 'counter')
+            lines.append('{}{} {}'.format(name, _labels(labels), value))
+        for name, labels, value in gauges:
+            header(name, 'gauge')
+            lines.append('{}{} {!r}'.format(
+                name, _labels(tuple(sorted(labels.items()))), float(value)))
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(labels):
+    """
+    :param labels: Tuple of (name, value) pairs
+    :return: The labels in the Prometheus format, e.g. {stage="sort_df"}
+    """
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(
+        k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+        for k, v in labels) + '}'
+
+
+metrics = Metrics()
+metrics.describe('app_request_seconds', 'Duration of the requests.')
+metrics.describe('app_stage_seconds', 'Duration of the analysis stages.')
+metrics.describe('app_rows_total', 'Number of rows processed by a stage.')
+metrics.describe('app_job_seconds', 'Duration of the background jobs.')
+
+
+@contextmanager
+def stage(name):
+    """
+    Time a stage of the analysis, as a with block or as a decorator:
+    with stage('sort_df'): ...
+    :param name: The name of the stage
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.observe('app_stage_seconds', time.perf_counter() - start,
+                        stage=name)
+
+
+def count_rows(stage_name, n):
+    """
+    Count the rows processed by a stage.
+    :param stage_name: The name of the stage
+    :param n: Number of rows
+    :return: None
+    """
+    metrics.count('app_rows_total', n, stage=stage_name)
+
+
+def init_app(app):
+    """
+    Time every request of the app, and profile a sample of them if
+    PROFILE_SAMPLE_RATE is set. Streamed responses are timed until their
+    body has been sent, and requests that failed with an exception are
+    recorded with status 500.
+    :param app: The app
+    :return: None
+    """
+    rate = app.config['PROFILE_SAMPLE_RATE']
+    directory = app.config['PROFILE_DIR']
+
+    @app.before_request
+    def start_timer():
+        g.request_start = time.perf_counter()
+        if rate and random.random() < rate:
+            g.profiler = cProfile.Profile()
+            g.profiler.enable()
+
+    @app.after_request
+    def stop_timer(response):
+        finish = _finish_request(directory)
+        if finish is not None:
+            if response.is_streamed:
+                response.response = _observe_stream(response.response,
+                                                    finish,
+                                                    response.status_code)
+            else:
+                finish(response.status_code)
+        return response
+
+    @app.teardown_request
+    def record_error(exception):
+        # The after_request functions are skipped if the request failed
+        # with an exception, in which case the timer is still set
+        finish = _finish_request(directory)
+        if finish is not None:
+            finish(500)
+
+
+def _finish_request(directory):
+    """
+    Take the timer and the profiler of the current request.
+    :param directory: The directory of the profiles
+    :return: Function that records the request with the given status, or
+    None if the request has already been recorded
+    """
+    start = g.pop('request_start', None)
+    if start is None:
+        return None
+    profiler = g.pop('profiler', None)
+    endpoint = request.endpoint or 'none'
+    method = request.method
+
+    def finish(status):
+        metrics.observe('app_request_seconds', time.perf_counter() - start,
+                        endpoint=endpoint, method=method, status=status)
+        if profiler is not None:
+            profiler.disable()
+            _dump_profile(profiler, directory, endpoint)
+
+    return finish
+
+
+def _observe_stream(body, finish, status):
+    """
+    Pass on the body of a streamed response, and record the request once
+    the body has been sent, the client has disconnected or the generator
+    has failed.
+    :param body: The iterable of the response
+    :param finish: Function recording the request (see _finish_request())
+    :param status: The status code of the response
+    """
+    try:
+        for chunk in body:
+            yield chunk
+    except Exception:
+        status = 500
+        raise
+    finally:
+        try:
+            # Closing the body ends stream_with_context() and its request
+            if hasattr(body, 'close'):
+                body.close()
+        finally:
+            finish(status)
+
+
+def _dump_profile(profiler, directory, endpoint):
+    """
+    Write the profile of a request to a file named after the time, endpoint
+    and process.
+    :param profiler: The profiler
+    :param directory: The directory of the profiles
+    :param endpoint: The endpoint of the request
+    :return: None
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    endpoint = re.sub(r'[^\w.-]', '_', endpoint)
+    filename = '{}_{}_{}.prof'.format(time.strftime('%Y%m%d-%H%M%S'),
+                                      endpoint, os.getpid())
+    profiler.dump_stats(os.path.join(directory, filename))
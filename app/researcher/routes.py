@@ -6,28 +6,26 @@ It has only the webpages belonging to the researcher blueprint,
 i.e. those belonging to the researcher interface.
 """
 
-import pandas as pd
 from flask import render_template, flash, current_app, request, redirect, \
-    url_for
+    url_for, Response, jsonify, stream_with_context, abort
 import numpy as np
-
-from bokeh.models import HoverTool
-from bokeh.plotting import figure
-from bokeh.embed import components
-from bokeh.palettes import Spectral6
-from bokeh.layouts import gridplot
-from bokeh.models.annotations import Title
+import base64
+import json
+import time
+from collections import OrderedDict
 
 from app.researcher import bp
+from app.metrics import stage
 from app.functionalities import collect_mongodbobjects, check_access_right, \
-    get_interpolators, get_videos, get_video_information, eucl, \
-    get_input_fields, extract_variable
-
-# PChipInterpolator finds monotonic interpolations, which we need to make
-# sure that our interpolated values don't go below 0 or above 100.
-from scipy.interpolate import PchipInterpolator
+    get_videos, get_video_information, \
+    get_input_fields, extract_variable, get_cached, resample_users, \
+    split_by_user, cluster_statistics, get_variable_names, lttb, \
+    get_selection, selection_key, untyped_posts, get_generation, \
+    select_variable
 
-from tslearn.clustering import TimeSeriesKMeans
+# pandas, scipy, bokeh, tslearn and scikit-learn are imported in the
+# functions that use them, so that workers which only serve the annotators
+# do not load them.
 
 # from tslearn.datasets import CachedDatasets
 # from tslearn.preprocessing import TimeSeriesScalerMeanVariance, \
@@ -46,9 +44,16 @@ def chart():
     """
     Display the web page for the researcher view.
 
+    The chart can be restricted to a part of the video and to some of the
+    users with the arguments 'start', 'end' and 'users' (see
+    get_selection()).
+
     This webpage is only for the role researcher.
     :return: Researcher view webpage
     """
+    from bokeh.embed import components
+    from bokeh.models import HoverTool, ColumnDataSource, CustomJS
+    from bokeh.plotting import figure
     check_access_right(forbidden='user', redirect_url='control.index')
 
     # Get the data:
@@ -56,46 +61,24 @@ def chart():
     currentVideo, vid_dict, _ = get_video_information(request.args.get('vid'),
                                                       request.args.get(
                                                           'cluster'))
-    _, data = collect_mongodbobjects(currentVideo[0])
-
-    if _ == False or data.empty:
+    selection = get_selection(request.args)
+    warn_untyped(selection)
+    # The series and the downsampled data are cached for the same generation
+    # of the data, so that they always match
+    generation = get_generation(currentVideo[0], 'chart')
+    series = get_chart_series(currentVideo[0], request.args.get('variable'),
+                              selection, generation)
+
+    if not series['found']:
         return render_template("researcher/chart.html",
                                the_div="There are no observations for this video!",
                                the_script="", vid_dict=vid_dict,
                                currentVideo=currentVideo,
                                currentVariable='-',
-                               variable_list=[])
-
-    data, currentVariable, variable_list = extract_variable(data,
-                                                            request.args.get(
-                                                                'variable'))
-
-    # Group by username and extract timestamps and values for each user
-    grouped_data = data.groupby('username')
-    data_by_user = [user for _, user in grouped_data]
-    ts = [np.array(t) for t in
-          (data_by_user[i]['timestamp'].apply(lambda x: float(x)) for i in
-           range(len(data_by_user)))]
-    vals = [np.array(val) for val in
-            (data_by_user[i][currentVariable].apply(lambda x: float(x)) for
-             i in
-             range(len(data_by_user)))]
-
-    vals = [v for v in vals if len(v) > 1]
-    ts = [t for t in ts if len(t) > 1]
-
-    # # Make sure all data starts and ends at the same time for each user, if the
-    # # data doesn't suggest otherwise start and end value are 50.
-    max_ts = [max(t) for t in ts]
-    min_ts = [min(t) for t in ts]
+                               variable_list=[], selection=selection)
 
-    # Create the interpolation
-    xs = [np.linspace(min_ts[i], max_ts[i], int(max_ts[i] - min_ts[i])) for i in
-          range(len(max_ts))]
-    interpolators = [PchipInterpolator(t, val) for (t, val) in
-                     zip(ts, vals)]
-    user_timeseries = [[xs[i], interpolator(xs[i])] for i, interpolator in
-                       enumerate(interpolators)]
+    currentVariable = series['variable']
+    variable_list = series['variable_list']
 
     # Create the Bokeh plot
     TOOLS = 'save,pan,box_zoom,reset,wheel_zoom,hover'
@@ -105,48 +88,408 @@ def chart():
     p.xaxis.axis_label = 'Timestamp (seconds)'
     p.yaxis.axis_label = 'Valence rating'
 
-    for i, tseries in enumerate(user_timeseries):
-        p.line(tseries[0], tseries[1], line_color=Spectral6[i % 6],
-               line_width=1.5, name=data_by_user[i]['username'].iloc[0])
-    for i in range(len(ts)):
-        for j in range(len(ts[i])):
-            p.circle(ts[i][j], vals[i][j], fill_color=Spectral6[i % 6],
-                     line_color='black', radius=0.5)
+    # All lines and all points are drawn from one data source each, with at
+    # most CHART_POINTS_PER_USER points per user.
+    lines_data, points_data = get_cached(
+        currentVideo[0], 'chart',
+        'downsampled_' + selection_key(currentVariable, selection),
+        lambda: chart_data(series), generation)
+    lines = ColumnDataSource(data=lines_data, name='chart_lines')
+    points = ColumnDataSource(data=points_data, name='chart_points')
+    p.multi_line('xs', 'ys', line_color='color', line_width=1.5,
+                 source=lines)
+    p.circle('x', 'y', fill_color='color', line_color='black', radius=0.5,
+             source=points)
 
     p.select_one(HoverTool).tooltips = [
-        ('Time', '@x'),
-        ('Valence', '@y'),
-        ('User', '$name')
+        ('Time', '$x'),
+        ('Valence', '$y'),
+        ('User', '@username')
 
     ]
 
-    script, div = components(p)
+    # When zooming in, load the data of the visible range again, so that
+    # more details are shown the further one zooms in.
+    data_url = url_for('researcher.chart_window', vid=currentVideo[0],
+                       variable=currentVariable, **selection)
+    reload_data = CustomJS(args=dict(lines=lines, points=points,
+                                     x_range=p.x_range), code="""
+        clearTimeout(window.chartWindowTimer);
+        window.chartWindowTimer = setTimeout(function () {
+            var url = %s + '&from=' + x_range.start + '&to=' + x_range.end;
+            $.getJSON(url).done(function (data) {
+                lines.data = data.lines;
+                points.data = data.points;
+            });
+        }, 300);
+    """ % json.dumps(data_url))
+    p.x_range.js_on_change('start', reload_data)
+    p.x_range.js_on_change('end', reload_data)
+
+    with stage('bokeh_components'):
+        script, div = components(p)
 
     return render_template("researcher/chart.html", the_div=div,
                            the_script=script, vid_dict=vid_dict,
                            currentVideo=currentVideo,
                            variable_list=variable_list,
-                           currentVariable=currentVariable)
+                           currentVariable=currentVariable,
+                           last_id=series['last_id'] or '',
+                           selection=selection)
+
+
+@bp.route('/chart/stream')
+def chart_stream():
+    """
+    Stream the annotations of a video that are saved from now on as
+    server-sent events, so that a live chart only receives the new points.
+    Each event contains the new points as JSON (see new_points()) and has
+    the id of the newest post as event id, so that the browser continues
+    where it stopped when it reconnects.
+
+    Arguments: 'vid', 'variable', 'after' (the id of the last post the
+    chart already shows) and the selection of the chart (see
+    get_selection()).
+
+    A stream keeps a worker busy while it is open, so it is only available
+    if LIVE_STREAM is switched on, which needs an asynchronous gunicorn
+    worker class. Otherwise the live chart polls /chart/updates.
+
+    This is only for the role researcher.
+    :return: Event stream
+    """
+    check_access_right(forbidden='user', redirect_url='control.index')
+    if not current_app.config['LIVE_STREAM']:
+        abort(404)
+
+    videoid = request.args.get('vid')
+    variable = request.args.get('variable')
+    after = request.headers.get('Last-Event-ID') or request.args.get('after')
+    selection = get_selection(request.args)
+    d = current_app.d
+    interval = current_app.config['LIVE_POLL_INTERVAL']
+    duration = current_app.config['LIVE_STREAM_SECONDS']
+    overlap = current_app.config['LIVE_OVERLAP_SECONDS']
+
+    def generate():
+        last = after
+        # Ids of the posts sent, so that posts checked again are not sent
+        # twice
+        seen = set()
+        deadline = time.time() + duration
+        yield 'retry: 1000\n\n'
+        while time.time() < deadline:
+            points, last = new_points(d, videoid, variable, last, selection,
+                                      overlap, seen)
+            if len(points['x']):
+                yield 'id: {}\ndata: {}\n\n'.format(last, json.dumps(points))
+            else:
+                # Comment line, which keeps the connection alive
+                yield ': \n\n'
+            time.sleep(interval)
+
+    return Response(stream_with_context(generate()),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache',
+                             'X-Accel-Buffering': 'no'})
+
+
+@bp.route('/chart/updates')
+def chart_updates():
+    """
+    Polling alternative to /chart/stream: return the annotations saved
+    after the post 'after' once. The points include the ids of the posts,
+    because posts that may have been written late are returned again (see
+    DatabaseClient.posts_after()) and the chart has to drop the ones it
+    already shows.
+
+    This is only for the role researcher.
+    :return: JSON with the new 'points' and the id of the newest post
+    ('after') to use for the next request
+    """
+    check_access_right(forbidden='user', redirect_url='control.index')
+
+    points, last = new_points(current_app.d, request.args.get('vid'),
+                              request.args.get('variable'),
+                              request.args.get('after'),
+                              get_selection(request.args),
+                              current_app.config['LIVE_OVERLAP_SECONDS'])
+    return jsonify(points=points, after=last)
+
+
+def new_points(d, videoid, variable, after, selection=None, overlap=0,
+               seen=None):
+    """
+    Collect the values of a variable saved for a video after a given post.
+    :param d: The database client
+    :param videoid: The id of the video
+    :param variable: The variable
+    :param after: Id of the last known post (None to start from the first)
+    :param selection: Only collect the values in the part of the video and
+    of the users selected for the chart (optional, see get_selection())
+    :param overlap: Seconds of posts before the last known post that are
+    checked again for posts written late (see DatabaseClient.posts_after())
+    :param seen: Set of the ids of the posts that have already been
+    collected, which are skipped and to which the new ones are added
+    (optional)
+    :return: Dictionary with the lists 'x' (timestamps), 'y' (values),
+    'username' and 'id' (of the posts), and the id of the newest post
+    """
+    selection = selection or {}
+    start, end = selection.get('start'), selection.get('end')
+    users = selection.get('users')
+    points = {'x': [], 'y': [], 'username': [], 'id': []}
+    for post in d.posts_after(videoid, after, variable, overlap=overlap):
+        after = str(post['_id'])
+        if seen is not None:
+            if after in seen:
+                continue
+            seen.add(after)
+        try:
+            x = float(post['timestamp'])
+            y = float(post.get(variable))
+        except (TypeError, ValueError):
+            continue
+        if y != y:
+            # Value is nan
+            continue
+        if (start is not None and x < start) or \
+                (end is not None and x > end) or \
+                (users is not None and post['username'] not in users):
+            # Not part of the selection
+            continue
+        points['x'].append(x)
+        points['y'].append(y)
+        points['username'].append(post['username'])
+        points['id'].append(after)
+    return points, after
+
+
+@bp.route('/chart/window')
+def chart_window():
+    """
+    Return the chart data of a video between the timestamps 'from' and 'to',
+    downsampled to CHART_POINTS_PER_USER points per user. The chart loads
+    this when the researcher zooms, so that the visible range is shown in
+    more detail. The data is taken from the selection of the chart (see
+    get_selection()).
+
+    This is only for the role researcher.
+    :return: JSON with the data of the 'lines' and the 'points' of the chart
+    """
+    check_access_right(forbidden='user', redirect_url='control.index')
+
+    currentVideo, _, _ = get_video_information(request.args.get('vid'))
+    series = get_chart_series(currentVideo[0], request.args.get('variable'),
+                              get_selection(request.args))
+    if not series['found']:
+        return jsonify(lines={}, points={})
+
+    try:
+        start = float(request.args.get('from'))
+        end = float(request.args.get('to'))
+    except (TypeError, ValueError):
+        start = end = None
+
+    lines_data, points_data = chart_data(series, start, end)
+    return jsonify(lines=to_json(lines_data), points=to_json(points_data))
+
+
+# Shown when posts are selected by timestamp while some have been saved with
+# their timestamp as text, see untyped_posts():
+UNTYPED_TIMESTAMPS = 'Some posts were saved with their timestamp as text ' \
+                     'by an older version and are left out when selecting ' \
+                     'by timestamp. Run "flask migrate-types" to include ' \
+                     'them.'
+
+
+def warn_untyped(selection):
+    """
+    Warn the researcher if a selection by timestamp misses posts saved with
+    their timestamp as text.
+    :param selection: The selection, see get_selection()
+    :return: None
+    """
+    if (selection['start'] is not None or selection['end'] is not None) and \
+            untyped_posts('timestamp'):
+        flash(UNTYPED_TIMESTAMPS)
+
+
+# Maximum number of points shown per user and series in the chart:
+CHART_POINTS_PER_USER = 500
+
+
+def get_chart_series(videoid, request_variable, selection=None,
+                     generation=None):
+    """
+    Get the series shown in the chart of a video, see user_series(). The
+    result is cached until the data of the video changes.
+    :param videoid: The id of the video
+    :param request_variable: The variable requested by the website
+    :param selection: The selected part of the video and users (optional,
+    see get_selection())
+    :param generation: The generation of the data (optional, see
+    get_cached())
+    :return: The series, as returned by user_series()
+    """
+    selection = selection or {}
+    return get_cached(videoid, 'chart',
+                      selection_key(request_variable, selection),
+                      lambda: user_series(videoid, request_variable,
+                                          **selection), generation)
+
+
+def chart_data(series, start=None, end=None):
+    """
+    Prepare the data sources of the chart: the interpolated line and the
+    observed points of every user, cropped to a window and downsampled with
+    the Largest-Triangle-Three-Buckets algorithm.
+    :param series: The series, as returned by user_series()
+    :param start: Start of the window (optional)
+    :param end: End of the window (optional)
+    :return: Dictionary with the columns of the line data source ('xs',
+    'ys', 'username', 'color') and of the point data source ('x', 'y',
+    'username', 'color')
+    """
+    from bokeh.palettes import Spectral6
+    lines = {'xs': [], 'ys': [], 'username': [], 'color': []}
+    point_parts = {'x': [], 'y': [], 'username': [], 'color': []}
+
+    def window(x):
+        """Mask of the values in the window, with one more on each side."""
+        mask = np.ones(len(x), dtype=bool)
+        if start is not None:
+            mask &= np.r_[x[1:] >= start, True]
+        if end is not None:
+            mask &= np.r_[True, x[:-1] <= end]
+        return mask
+
+    for i, username in enumerate(series['usernames']):
+        color = Spectral6[i % 6]
+
+        line_x, line_y = series['user_timeseries'][i]
+        mask = window(line_x)
+        line_x, line_y = lttb(line_x[mask], line_y[mask],
+                              CHART_POINTS_PER_USER)
+        lines['xs'].append(line_x)
+        lines['ys'].append(line_y)
+        lines['username'].append(username)
+        lines['color'].append(color)
+
+        ts, vals = series['ts'][i], series['vals'][i]
+        mask = window(ts)
+        ts, vals = lttb(ts[mask], vals[mask], CHART_POINTS_PER_USER)
+        point_parts['x'].append(ts)
+        point_parts['y'].append(vals)
+        point_parts['username'].append(np.repeat(username, len(ts)))
+        point_parts['color'].append(np.repeat(color, len(ts)))
+
+    points = dict((k, np.concatenate(v) if v else np.array([]))
+                  for k, v in point_parts.items())
+    return lines, points
+
+
+def to_json(columns):
+    """
+    Convert the columns of a data source to lists, so that they can be sent
+    as JSON.
+    :param columns: Dictionary of columns (arrays or lists of arrays)
+    :return: Dictionary of lists
+    """
+    return dict((k, [x.tolist() if isinstance(x, np.ndarray) else x
+                     for x in v] if isinstance(v, list) else v.tolist())
+                for k, v in columns.items())
+
+
+def user_series(videoid, request_variable, start=None, end=None, users=None):
+    """
+    Fetch the data of a video and interpolate the series of every user
+    between the first and last timestamp the user annotated.
+    :param videoid: The id of the video
+    :param request_variable: The variable requested by the website
+    :param start: Only use the data from this timestamp on (optional)
+    :param end: Only use the data up to this timestamp (optional)
+    :param users: Only use the data of the users in this list (optional)
+    :return: Dictionary with 'found' indicating if there is data, and if so
+    'variable', 'variable_list', 'usernames', the raw timestamps 'ts' and
+    values 'vals' of each user, the interpolated 'user_timeseries' and the
+    id of the newest post included ('last_id')
+    """
+    # PChipInterpolator finds monotonic interpolations, which we need to make
+    # sure that our interpolated values don't go below 0 or above 100.
+    from scipy.interpolate import PchipInterpolator
+    # Remember the newest post before fetching, so that a live chart can
+    # continue from there:
+    last_id = current_app.d.last_post_id(videoid)
+    # Only the shown variable is fetched
+    currentVariable, variable_list = select_variable(videoid,
+                                                     request_variable)
+    if currentVariable is None:
+        return {'found': False}
+    found, data = collect_mongodbobjects(videoid, currentVariable,
+                                         start=start, end=end, users=users)
+    if not found or currentVariable not in data.columns:
+        return {'found': False}
+
+    data, _, _ = extract_variable(data, currentVariable)
+    if data.empty:
+        return {'found': False}
+
+    # Extract timestamps and values for each user
+    usernames, ts, vals = split_by_user(data, currentVariable)
+
+    # Users with a single observation can't be interpolated
+    keep = [i for i in range(len(ts)) if len(ts[i]) > 1]
+    vals = [vals[i] for i in keep]
+    ts = [ts[i] for i in keep]
+    usernames = [usernames[i] for i in keep]
+
+    # # Make sure all data starts and ends at the same time for each user, if the
+    # # data doesn't suggest otherwise start and end value are 50.
+    max_ts = [t[-1] for t in ts]
+    min_ts = [t[0] for t in ts]
+
+    # Create the interpolation
+    xs = [np.linspace(min_ts[i], max_ts[i], int(max_ts[i] - min_ts[i])) for i in
+          range(len(max_ts))]
+    interpolators = [PchipInterpolator(t, val) for (t, val) in
+                     zip(ts, vals)]
+    user_timeseries = [[xs[i], interpolator(xs[i])] for i, interpolator in
+                       enumerate(interpolators)]
+
+    return {'found': True, 'variable': currentVariable,
+            'variable_list': variable_list, 'usernames': usernames, 'ts': ts,
+            'vals': vals, 'user_timeseries': user_timeseries,
+            'last_id': last_id}
 
 
 @bp.route('/clusters', methods=['GET'])
 def clusters():
     """
-        Display correlation plot for the researcher.
+        Display correlation plot for the researcher. The clustering can be
+        restricted to a part of the video and to some of the users with the
+        arguments 'start', 'end' and 'users' (see get_selection()).
 
         This webpage is only for the role researcher.
         :return: Correlation plot
         """
+    from bokeh.embed import components
+    from bokeh.layouts import gridplot, column
+    from bokeh.models.annotations import Title
+    from bokeh.plotting import figure
     check_access_right(forbidden='user', redirect_url='control.index')
 
     currentVideo, vid_dict, n_clusters = get_video_information(
         request.args.get('vid'), request.args.get('cluster'))
-    _, data = collect_mongodbobjects(currentVideo[0])
+    selection = get_selection(request.args)
+    warn_untyped(selection)
+    resampled = resample_users(currentVideo[0], request.args.get('variable'),
+                               **selection)
 
     ### set desired amount of clusters
-    clustervals = np.arange(1, 10, 1)
+    clustervals = CLUSTER_VALUES
 
-    if _ == False or data.empty:
+    if resampled is None:
         return render_template("researcher/clusters.html",
                                the_div="There is no data for this video!",
                                the_script="", vid_dict=vid_dict,
@@ -154,34 +497,48 @@ def clusters():
                                currentCluster=n_clusters,
                                clustervals=clustervals,
                                currentVariable='-',
-                               variable_list=[])
-
-    data, currentVariable, variable_list = extract_variable(data,
-                                                            request.args.get(
-                                                                'variable'))
-
-    interpolators, max_t = get_interpolators(data, currentVariable)
-    xs = np.arange(0, int(max_t) + 1.5, 1)
-
-    # Generate data
-    user_timeseries = [[interpolator(xs)] for interpolator in interpolators]
-
-    seed = np.random.randint(0, int(1e5), 1)[0]
-    np.random.seed(seed)
+                               variable_list=[], selection=selection)
+
+    currentVariable = resampled['variable']
+    variable_list = resampled['variable_list']
+
+    # One series per user, shaped like tslearn expects it
+    user_timeseries = resampled['matrix'][:, np.newaxis, :]
+
+    # Cluster in the job pool. The clustering is only computed once for the
+    # same data, variable, number of clusters and seed.
+    seed = get_seed(request.args.get('seed'))
+    n_clusters = min(n_clusters, len(user_timeseries))
+    key = cluster_job_key(currentVideo[0], resampled, n_clusters, seed)
+    job_id = current_app.jobs.submit(key, compute_clusters,
+                                     resampled['matrix'], n_clusters, seed)
+    # Compute the other numbers of clusters too, for the elbow plot and so
+    # that they are ready when the researcher switches to them:
+    sweep_jobs = submit_cluster_sweep(currentVideo[0], resampled,
+                                      clustervals, seed)
+    result = current_app.jobs.result(job_id)
+
+    if result is None:
+        error = current_app.jobs.error(job_id)
+        if error:
+            the_div = "Computing the clusters failed: " + error
+        else:
+            the_div = "The clusters are being computed, the page will be " \
+                      "updated when they are ready."
+        return render_template("researcher/clusters.html",
+                               the_div=the_div, the_script="",
+                               vid_dict=vid_dict, currentVideo=currentVideo,
+                               currentCluster=n_clusters,
+                               clustervals=clustervals,
+                               variable_list=variable_list,
+                               currentVariable=currentVariable,
+                               job_id=None if error else job_id,
+                               selection=selection)
 
-    # Set cluster count
-    # n_clusters = 3
-    if n_clusters > np.array(user_timeseries).shape[0]:
-        n_clusters = np.array(user_timeseries).shape[0]
+    y_pred = result['labels']
+    stats = result['stats']
 
-    # Euclidean k-means
-    km = TimeSeriesKMeans(n_clusters=n_clusters, verbose=True,
-                          random_state=seed)
-    y_pred = km.fit_predict(user_timeseries)
-
-    # Generate plots and calculate statistics
-    all_plots = ""
-    all_scripts = ""
+    # Generate plots
     plots = []
 
     ### TODO MAYBE: intra-cluster correlation with rpy2. Might not work with matrices
@@ -199,44 +556,303 @@ def clusters():
     icc_val = icc_res[0]
     print("ICC" + str(icc_val))"""
 
-    for yi in range(n_clusters):
+    # Timestamps of the grid, starting at the start of the selection
+    xs = resampled['xs']
+    for st in stats:
         p = figure()
-        n = 0
-        values = km.cluster_centers_[yi].ravel()
-        centerMean = np.mean(km.cluster_centers_[yi].ravel())
-        varsum = 0
-        for xx in range(0, len(y_pred)):
-            if y_pred[xx] == yi:
-                n = n + 1
-                for iii in range(len(user_timeseries[xx][0])):
-                    varsum = varsum + eucl(user_timeseries[xx][0][iii],
-                                           values[iii]) / len(
-                        user_timeseries[xx][0])
-
-                p.line(range(0, len(user_timeseries[xx][0])),
-                       user_timeseries[xx][0], line_width=0.3)
-        varsum = np.sqrt(varsum)
-
-        titleString = "C#" + str(yi + 1) + ", n: " + str(n) + ", μ: " + str(
-            np.round(centerMean, decimals=3)) + ", σ: " + str(
-            np.round(varsum, decimals=3)) + ", σ²: " + str(
-            np.round(varsum ** 2, decimals=3))
+        for xx in np.flatnonzero(y_pred == st['cluster']):
+            p.line(xs, user_timeseries[xx][0], line_width=0.3)
+
+        titleString = "C#" + str(st['cluster'] + 1) + ", n: " + str(
+            st['size']) + ", μ: " + str(
+            np.round(st['center_mean'], decimals=3)) + ", σ: " + str(
+            np.round(st['sigma'], decimals=3)) + ", σ²: " + str(
+            np.round(st['variance'], decimals=3))
         t = Title()
         t.text = titleString
         p.title = t
-        p.line(range(0, len(values)), values, line_width=2)
+        p.line(xs, st['center'], line_width=2)
         plots.append(p)
 
     # Get plot codes
-    script, div = components(
-        gridplot(plots, ncols=3, plot_width=350, plot_height=300))
+    grid = gridplot(plots, ncols=3, plot_width=350, plot_height=300)
+    # The elbow plot is drawn once no clustering of the sweep is running
+    # any more; until then the page polls the sweep and reloads when it is
+    # complete.
+    statuses = [current_app.jobs.status(j) for j in sweep_jobs.values()]
+    sweep_pending = any(s not in ('done', 'failed') for s in statuses)
+    sweep = OrderedDict((k, current_app.jobs.result(j)) for k, j in
+                        sweep_jobs.items())
+    sweep = OrderedDict((k, r) for k, r in sweep.items() if r is not None)
+    if not sweep_pending and sweep:
+        grid = column(elbow_plot(sweep), grid)
+    with stage('bokeh_components'):
+        script, div = components(grid)
 
     return render_template("researcher/clusters.html", the_div=div,
                            the_script=script, vid_dict=vid_dict,
                            currentVideo=currentVideo,
                            currentCluster=n_clusters, clustervals=clustervals,
                            variable_list=variable_list,
-                           currentVariable=currentVariable)
+                           currentVariable=currentVariable, seed=seed,
+                           selection=selection, sweep_pending=sweep_pending)
+
+
+# The numbers of clusters the clusters page offers:
+CLUSTER_VALUES = np.arange(1, 10, 1)
+
+# Seed used for clustering if the website does not request another one, so
+# that the same data always gives the same clusters:
+DEFAULT_SEED = 0
+
+
+def get_seed(requested_seed=None):
+    """
+    Parse the random seed requested by the website, or use the default seed.
+    :param requested_seed: The seed given by the website (optional)
+    :return: The seed
+    """
+    if requested_seed and requested_seed.isdigit():
+        return int(requested_seed)
+    return DEFAULT_SEED
+
+
+@stage('kmeans')
+def fit_clusters(user_timeseries, n_clusters, seed):
+    """
+    Cluster the users' series with euclidean k-means.
+    :param user_timeseries: Array of the series, shaped as tslearn expects it
+    :param n_clusters: Number of clusters (at most the number of series)
+    :param seed: Random seed
+    :return: The fitted TimeSeriesKMeans object and the cluster of each series
+    """
+    from tslearn.clustering import TimeSeriesKMeans
+    np.random.seed(seed)
+
+    # Set cluster count
+    if n_clusters > len(user_timeseries):
+        n_clusters = len(user_timeseries)
+
+    # Euclidean k-means
+    km = TimeSeriesKMeans(n_clusters=n_clusters, verbose=True,
+                          random_state=seed)
+    y_pred = km.fit_predict(user_timeseries)
+    return km, y_pred
+
+
+def cluster_job_key(videoid, resampled, n_clusters, seed):
+    """
+    :param videoid: The id of the video
+    :param resampled: The resampled data, as returned by resample_users()
+    :param n_clusters: Number of clusters
+    :param seed: Random seed
+    :return: The key of the clustering job for these parameters
+    """
+    selection = resampled['selection']
+    return ('clusters', current_app.d.target, videoid, resampled['generation'],
+            resampled['variable'], selection['start'], selection['end'],
+            selection['users'], n_clusters, seed)
+
+
+def compute_clusters(matrix, n_clusters, seed):
+    """
+    Cluster the users' series and calculate the cluster statistics. This
+    runs as a job in the job pool (see app/jobs.py).
+    :param matrix: Users x time array of resampled values
+    :param n_clusters: Number of clusters
+    :param seed: Random seed
+    :return: Dictionary with the cluster of each user ('labels') and the
+    statistics of each cluster ('stats', see cluster_statistics())
+    """
+    from sklearn.metrics import silhouette_score
+    km, y_pred = fit_clusters(matrix[:, np.newaxis, :], n_clusters, seed)
+    stats = cluster_statistics(matrix, y_pred, km.cluster_centers_)
+
+    # The silhouette is only defined for 2 <= k <= number of users - 1
+    n_labels = len(np.unique(y_pred))
+    if 1 < n_labels < len(matrix):
+        silhouette = float(silhouette_score(matrix, y_pred))
+    else:
+        silhouette = None
+    return {'labels': y_pred, 'stats': stats,
+            'inertia': float(km.inertia_), 'silhouette': silhouette}
+
+
+def submit_cluster_sweep(videoid, resampled, clustervals, seed):
+    """
+    Submit clustering jobs for every number of clusters the page offers, so
+    that they are computed in parallel in the job pool and switching between
+    them only needs a lookup. Jobs that already exist are not submitted
+    again (see JobManager.submit()).
+    :param videoid: The id of the video
+    :param resampled: The resampled data, as returned by resample_users()
+    :param clustervals: The numbers of clusters
+    :param seed: Random seed
+    :return: Ordered dictionary from number of clusters to job id
+    """
+    n_users = len(resampled['matrix'])
+    ks = sorted(set(min(int(k), n_users) for k in clustervals))
+    return OrderedDict(
+        (k, current_app.jobs.submit(
+            cluster_job_key(videoid, resampled, k, seed), compute_clusters,
+            resampled['matrix'], k, seed)) for k in ks)
+
+
+def elbow_plot(sweep):
+    """
+    Plot the inertia and silhouette of the clusterings for each number of
+    clusters, which helps to choose the number of clusters.
+    :param sweep: Ordered dictionary from number of clusters to the result
+    of the clustering
+    :return: The Bokeh figure
+    """
+    from bokeh.models import Range1d, LinearAxis
+    from bokeh.plotting import figure
+    ks = list(sweep)
+    p = figure(title="Inertia (blue) and silhouette (orange) by number of "
+                     "clusters", plot_width=700, plot_height=300)
+    p.xaxis.axis_label = 'Number of clusters'
+    p.yaxis.axis_label = 'Inertia'
+    inertia = [sweep[k]['inertia'] for k in ks]
+    p.line(ks, inertia, line_width=2)
+    p.circle(ks, inertia, size=6)
+
+    silhouette_ks = [k for k in ks if sweep[k]['silhouette'] is not None]
+    if silhouette_ks:
+        silhouette = [sweep[k]['silhouette'] for k in silhouette_ks]
+        p.extra_y_ranges = {'silhouette': Range1d(start=-1, end=1)}
+        p.add_layout(LinearAxis(y_range_name='silhouette',
+                                axis_label='Silhouette'), 'right')
+        p.line(silhouette_ks, silhouette, line_width=2, line_color='orange',
+               y_range_name='silhouette')
+        p.circle(silhouette_ks, silhouette, size=6, color='orange',
+                 y_range_name='silhouette')
+    return p
+
+
+@bp.route('/clusters/sweep')
+def cluster_sweep():
+    """
+    Tell the inertia and silhouette of the clusterings for each number of
+    clusters, starting the clusterings that are missing.
+
+    This is only for the role researcher.
+    :return: JSON with a list of 'clusterings', each containing the number
+    of clusters 'k', the 'status' of its job and, if it is done, 'inertia'
+    and 'silhouette'
+    """
+    check_access_right(forbidden='user', redirect_url='control.index')
+
+    currentVideo, _, _ = get_video_information(request.args.get('vid'))
+    resampled = resample_users(currentVideo[0], request.args.get('variable'),
+                               **get_selection(request.args))
+    if resampled is None:
+        return jsonify(clusterings=[])
+
+    jobs = submit_cluster_sweep(currentVideo[0], resampled,
+                                CLUSTER_VALUES,
+                                get_seed(request.args.get('seed')))
+    clusterings = []
+    for k, job_id in jobs.items():
+        entry = {'k': k, 'status': current_app.jobs.status(job_id)}
+        result = current_app.jobs.result(job_id)
+        if result is not None:
+            entry['inertia'] = result['inertia']
+            entry['silhouette'] = result['silhouette']
+        clusterings.append(entry)
+    return jsonify(clusterings=clusterings)
+
+
+@bp.route('/clusters/jobs/<job_id>')
+def cluster_job_status(job_id):
+    """
+    Tell the status of a clustering job, which the clusters page polls.
+
+    This is only for the role researcher.
+    :param job_id: The id of the job
+    :return: JSON with the 'status' ('running', 'done', 'failed' or
+    'unknown') and an 'error' message for failed jobs
+    """
+    check_access_right(forbidden='user', redirect_url='control.index')
+    return jsonify(status=current_app.jobs.status(job_id),
+                   error=current_app.jobs.error(job_id))
+
+
+@bp.route('/clusters/jobs/<job_id>/result')
+def cluster_job_result(job_id):
+    """
+    Return the result of a finished clustering job.
+
+    This is only for the role researcher.
+    :param job_id: The id of the job
+    :return: JSON with the cluster of each user ('labels') and the
+    statistics of each cluster ('clusters'), or an error with status 404 if
+    the job has not finished
+    """
+    check_access_right(forbidden='user', redirect_url='control.index')
+    result = current_app.jobs.result(job_id)
+    if result is None:
+        return jsonify(status=current_app.jobs.status(job_id)), 404
+
+    clusters = [{'cluster': st['cluster'] + 1, 'size': st['size'],
+                 'center': st['center'].tolist(),
+                 'center_mean': float(st['center_mean']),
+                 'sigma': float(st['sigma']),
+                 'variance': float(st['variance']),
+                 'percentiles': dict((str(q), v.tolist()) for q, v in
+                                     st['percentiles'].items())}
+                for st in result['stats']]
+    return jsonify(status='done', labels=result['labels'].tolist(),
+                   clusters=clusters)
+
+
+@bp.route('/export_clusters', methods=['GET'])
+def export_clusters():
+    """
+    Export the cluster statistics shown on the clusters page as a csv file,
+    with one row per cluster and timestamp. Passing the seed shown on the
+    clusters page reproduces the same clustering.
+
+    This is only for the role researcher.
+    :return: csv file
+    """
+    import pandas as pd
+    check_access_right(forbidden='user', redirect_url='control.index')
+
+    currentVideo, _, n_clusters = get_video_information(
+        request.args.get('vid'), request.args.get('cluster'))
+    resampled = resample_users(currentVideo[0], request.args.get('variable'),
+                               **get_selection(request.args))
+    if resampled is None:
+        flash('No data to export!')
+        return redirect(url_for('researcher.clusters'))
+
+    seed = get_seed(request.args.get('seed'))
+    n_clusters = min(n_clusters, len(resampled['matrix']))
+    key = cluster_job_key(currentVideo[0], resampled, n_clusters, seed)
+    result = current_app.jobs.result(current_app.jobs.job_id(key))
+    if result is None:
+        result = compute_clusters(resampled['matrix'], n_clusters, seed)
+    stats = result['stats']
+
+    xs = resampled['xs']
+    frames = []
+    for st in stats:
+        columns = {'cluster': st['cluster'] + 1, 'size': st['size'],
+                   'center_mean': st['center_mean'], 'sigma': st['sigma'],
+                   'variance': st['variance'], 'timestamp': xs,
+                   'center': st['center']}
+        for q, series in st['percentiles'].items():
+            columns['p' + str(q)] = series
+        frames.append(pd.DataFrame(columns, columns=list(columns)))
+    data = pd.concat(frames, ignore_index=True)
+
+    filename = 'clusters_{vid}_{var}_{k}_{seed}.csv'.format(
+        vid=currentVideo[0], var=resampled['variable'], k=len(stats),
+        seed=seed)
+    return Response(data.to_csv(index=False), mimetype='text/csv',
+                    headers={'Content-Disposition':
+                             'attachment; filename=' + filename})
 
 
 @bp.route('/config')
@@ -255,8 +871,7 @@ def config():
     oneDsliders = [x for x in field_list if x[0] == 'slider']
     twoDsliders = [x for x in field_list if x[0] == '2dslider']
 
-    with open(current_app.user_instructions_file, 'r') as f:
-        instructions = f.read()
+    instructions = current_app.user_instructions_store.read()
 
     return render_template("researcher/config.html", vid_dict=vid_dict,
                            dbs=current_app.dbs,
@@ -268,23 +883,113 @@ def config():
 @bp.route('/data')
 def data():
     """
-    Function to print all data that is stored in the MongoDB database.
+    Function to browse the data that is stored in the MongoDB database, one
+    page at a time. The posts can be filtered by video ('vid'), user
+    ('user') and timestamp window ('start', 'end') and sorted ('sort').
 
     Operation is not allowed for role user.
-    :return: Webpage displaying currently stored data
+    :return: Webpage displaying a page of the currently stored data
     """
     check_access_right(forbidden='user', redirect_url='control.index')
 
-    b, data = collect_mongodbobjects()
-    if b:
-        # The names of the data fields:
-        headers = list(data)
-        # And a list of their contents:
-        data_rows = list(data.values)
-        return render_template('researcher/data.html', data=data_rows,
-                               headers=headers)
-    else:
-        return render_template('researcher/data.html', data='', headers='')
+    vid_dict, _ = get_videos()
+    page = get_data_page(request.args)
+    if (page['filters']['start'] or page['filters']['end']) and \
+            untyped_posts('timestamp'):
+        flash(UNTYPED_TIMESTAMPS)
+    return render_template('researcher/data.html', data=page['rows'],
+                           headers=page['headers'], next=page['next'],
+                           filters=page['filters'], vid_dict=vid_dict,
+                           sort_options=DATA_SORT_OPTIONS)
+
+
+@bp.route('/data/rows')
+def data_rows():
+    """
+    Return a page of the stored data as JSON, taking the same arguments as
+    /data and additionally the token 'after' returned as 'next' for the
+    previous page.
+
+    Operation is not allowed for role user.
+    :return: JSON with 'headers', 'rows' and 'next'
+    """
+    check_access_right(forbidden='user', redirect_url='control.index')
+
+    page = get_data_page(request.args)
+    return jsonify(headers=page['headers'], rows=page['rows'],
+                   next=page['next'])
+
+
+# The ways the raw data can be sorted, as sort field and whether the order is
+# descending:
+DATA_SORT_OPTIONS = {'newest': ('_id', True), 'oldest': ('_id', False),
+                     'timestamp': ('timestamp', False)}
+
+# Number of posts on a page of raw data, by default and at most:
+DATA_PAGE_SIZE = 100
+DATA_MAX_PAGE_SIZE = 1000
+
+
+def get_data_page(args):
+    """
+    Collect a page of raw data according to the arguments of a request.
+    :param args: The request arguments
+    :return: Dictionary with the column 'headers', the 'rows' of the page,
+    the token of the 'next' page (None if this is the last page) and the
+    'filters' that were applied
+    """
+    filters = {'vid': args.get('vid', ''), 'user': args.get('user', ''),
+               'start': args.get('start', ''), 'end': args.get('end', ''),
+               'sort': args.get('sort', 'newest')}
+    if filters['sort'] not in DATA_SORT_OPTIONS:
+        filters['sort'] = 'newest'
+    sort_field, descending = DATA_SORT_OPTIONS[filters['sort']]
+
+    try:
+        start = float(filters['start']) if filters['start'] else None
+        end = float(filters['end']) if filters['end'] else None
+    except ValueError:
+        start = end = None
+    try:
+        limit = max(1, min(int(args.get('limit', DATA_PAGE_SIZE)),
+                           DATA_MAX_PAGE_SIZE))
+    except ValueError:
+        limit = DATA_PAGE_SIZE
+
+    after = None
+    if args.get('after'):
+        try:
+            after = json.loads(base64.urlsafe_b64decode(
+                args.get('after').encode()).decode())
+        except ValueError:
+            after = None
+        if not isinstance(after, list) or len(after) != 2:
+            after = None
+
+    posts, more = current_app.d.page_posts(
+        videoid=filters['vid'] or None, username=filters['user'] or None,
+        start=start, end=end, sort_field=sort_field, descending=descending,
+        after=after, limit=limit)
+
+    standard_data_cols = ['videoid', 'username', 'timestamp', 'date']
+    headers = standard_data_cols[:3] + get_variable_names()
+    for post in posts:
+        for key in post:
+            if key not in headers and key not in standard_data_cols and \
+                    key != '_id':
+                headers.append(key)
+    headers += standard_data_cols[-1:]
+    rows = [[post.get(h, '') for h in headers] for post in posts]
+
+    next_page = None
+    if more:
+        last = posts[-1]
+        token = [last.get(sort_field) if sort_field != '_id' else None,
+                 str(last['_id'])]
+        next_page = base64.urlsafe_b64encode(
+            json.dumps(token).encode()).decode()
+    return {'headers': headers, 'rows': rows, 'next': next_page,
+            'filters': filters}
 
 
 @bp.route('/instructions')
@@ -310,9 +1015,7 @@ def save_user_instructions():
     check_access_right(forbidden='user', redirect_url='control.index')
 
     instructions = request.form.get('user_instructions')
-    with open(current_app.user_instructions_file, 'w') as f:
-        f.write(instructions)
-        f.close()
+    current_app.user_instructions_store.write(instructions)
 
     flash('Instructions saved!')
     return redirect(url_for('researcher.config'))
@@ -0,0 +1,366 @@
+"""
+This file contains the embedded SQLite storage backend. It offers the same
+methods as the MongoDB DatabaseClient, so the app can run on a single
+machine without a database server (select it with DB=sqlite).
+
+The posts are stored with typed columns: the standard fields in the table
+posts and the slider values in the table post_values, one row per post and
+variable. The file is opened in WAL mode, so that the worker processes can
+read while another one writes.
+"""
+import os
+import sqlite3
+import threading
+
+from flask import current_app
+
+from app.database_client import STANDARD_FIELDS
+
+# Fields posts can be sorted by, and their columns:
+SORT_COLUMNS = {'_id': 'id', 'videoid': 'videoid', 'username': 'username',
+                'timestamp': 'timestamp', 'date': 'date'}
+
+SCHEMA = ['CREATE TABLE IF NOT EXISTS posts ('
+          'id INTEGER PRIMARY KEY AUTOINCREMENT, videoid TEXT, '
+          'username TEXT, timestamp REAL, date INTEGER)',
+          'CREATE TABLE IF NOT EXISTS post_values ('
+          'post_id INTEGER NOT NULL, variable TEXT NOT NULL, value REAL, '
+          'PRIMARY KEY (post_id, variable)) WITHOUT ROWID',
+          'CREATE INDEX IF NOT EXISTS posts_video_user_time '
+          'ON posts (videoid, username, timestamp)',
+          'CREATE INDEX IF NOT EXISTS posts_video_time '
+          'ON posts (videoid, timestamp)',
+          'CREATE INDEX IF NOT EXISTS posts_user_time '
+          'ON posts (username, timestamp)',
+          'CREATE INDEX IF NOT EXISTS posts_date ON posts (date)',
+          # Like every index, this ends with the id, so the pages of raw
+          # data sorted by (timestamp, id) are read from it in order:
+          'CREATE INDEX IF NOT EXISTS posts_time ON posts (timestamp)']
+
+
+class SQLiteClient:
+    """
+    Class specifying the connection to the embedded SQLite database.
+    """
+
+    def __init__(self, path=None):
+        """
+        Initiate the database. The file is only opened when it is first
+        used, once per thread and process.
+        :param path: Path of the database file, defaults to the SQLITE_PATH
+        config value
+        """
+        self.target = 'sqlite'
+        self.path = path or current_app.config['SQLITE_PATH']
+        self._local = threading.local()
+
+    def _connection(self):
+        """
+        Get the connection of the current thread, connecting if this thread
+        (or this process, after a fork) has no connection yet.
+        :return: The connection
+        """
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+            self.ensure_indexes()
+        return connection
+
+    def ensure_indexes(self):
+        """
+        Create the tables and indexes if they do not exist yet.
+        :return: None
+        """
+        connection = self._local.connection
+        with connection:
+            for statement in SCHEMA:
+                connection.execute(statement)
+
+    def insert_post(self, post_data):
+        """
+        Insert a post into the database.
+        :param post_data: Data is to be posted
+        :return: None
+        """
+        self.insert_posts([post_data])
+
+    def insert_posts(self, posts):
+        """
+        Insert several posts into the database in a single transaction.
+        :param posts: List of posts to be inserted
+        :return: None
+        """
+        connection = self._connection()
+        with connection:
+            for p in posts:
+                post_id = connection.execute(
+                    'INSERT INTO posts (videoid, username, timestamp, date) '
+                    'VALUES (?, ?, ?, ?)',
+                    [p.get(f) for f in STANDARD_FIELDS]).lastrowid
+                connection.executemany(
+                    'INSERT OR REPLACE INTO post_values (post_id, variable, '
+                    'value) VALUES (?, ?, ?)',
+                    [(post_id, k, v) for k, v in p.items()
+                     if k not in STANDARD_FIELDS and k != '_id'])
+
+    @staticmethod
+    def _build_where(videoid=None, username=None, start=None, end=None,
+                     date_from=None, date_to=None):
+        """
+        Build the condition selecting posts by video, user, timestamp range
+        and date range. See query_posts() for the parameters.
+        :return: The condition and its parameters
+        """
+        conditions = []
+        params = []
+        if videoid is not None:
+            conditions.append('videoid = ?')
+            params.append(videoid)
+        if username is not None:
+            if isinstance(username, (list, tuple, set)):
+                username = list(username)
+                conditions.append('username IN (' +
+                                  ', '.join('?' * len(username)) + ')')
+                params += username
+            else:
+                conditions.append('username = ?')
+                params.append(username)
+        for column, op, value in [('timestamp', '>=', start),
+                                  ('timestamp', '<=', end),
+                                  ('date', '>=', date_from),
+                                  ('date', '<=', date_to)]:
+            if value is not None:
+                conditions.append(column + ' ' + op + ' ?')
+                params.append(value)
+        return ' AND '.join(conditions) or '1', params
+
+    def _select_posts(self, where, params, order, variable=None, limit=None,
+                      with_id=False):
+        """
+        Select posts together with their values.
+        :param where: Condition on the columns of posts
+        :param params: Parameters of the condition
+        :param order: ORDER BY clause on the columns of posts
+        :param variable: If given, only return this variable instead of all
+        slider values
+        :param limit: Maximum number of posts (optional)
+        :param with_id: Include the id of the posts as '_id'
+        :return: Generator of posts
+        """
+        order = order + ', id' if order else 'id'
+        posts_query = 'SELECT * FROM posts WHERE ' + where + \
+                      ' ORDER BY ' + order
+        if limit is not None:
+            posts_query += ' LIMIT ' + str(int(limit))
+        join = 'v.post_id = p.id'
+        if variable is not None:
+            join += ' AND v.variable = ?'
+            params = list(params) + [variable]
+        rows = self._connection().execute(
+            'SELECT p.id, p.videoid, p.username, p.timestamp, p.date, '
+            'v.variable, v.value FROM (' + posts_query + ') p '
+            'LEFT JOIN post_values v ON ' + join + ' ORDER BY ' + order,
+            params)
+
+        post = None
+        post_id = None
+        for row in rows:
+            if row[0] != post_id:
+                if post is not None:
+                    yield post
+                post_id = row[0]
+                post = dict(zip(STANDARD_FIELDS, row[1:5]))
+                if with_id:
+                    post['_id'] = post_id
+            if row[5] is not None:
+                post[row[5]] = row[6]
+        if post is not None:
+            yield post
+
+    def collect_series(self, videoid, variable, username=None, start=None,
+                       end=None):
+        """
+        Collect the series of all users for a video and variable. See
+        DatabaseClient.collect_series() for the parameters.
+        :return: List of dictionaries containing 'username' and 'points'
+        (list of {'t': timestamp, 'v': value}, sorted by timestamp), sorted
+        by username
+        """
+        where, params = self._build_where(videoid, username, start, end)
+        rows = self._connection().execute(
+            'SELECT p.username, p.timestamp, v.value FROM posts p '
+            'JOIN post_values v ON v.post_id = p.id '
+            'WHERE ' + where + ' AND v.variable = ? '
+            "AND typeof(p.timestamp) IN ('real', 'integer') "
+            "AND typeof(v.value) IN ('real', 'integer') "
+            'ORDER BY p.username, p.timestamp', params + [variable])
+        series = []
+        for username, t, v in rows:
+            if not series or series[-1]['username'] != username:
+                series.append({'username': username, 'points': []})
+            series[-1]['points'].append({'t': t, 'v': v})
+        return series
+
+    def series_variables(self, videoid):
+        """
+        Find the variables there are values of for a video.
+        :param videoid: The id of the video
+        :return: Sorted list of variable names
+        """
+        rows = self._connection().execute(
+            'SELECT DISTINCT v.variable FROM posts p '
+            'JOIN post_values v ON v.post_id = p.id WHERE p.videoid = ? '
+            'ORDER BY v.variable', (videoid,))
+        return [row[0] for row in rows]
+
+    def rebuild_series(self, batch_size=1000):
+        """
+        The series are read directly from the indexed posts, so there is no
+        separate store to rebuild.
+        :param batch_size: Unused
+        :return: Number of posts
+        """
+        return self._connection().execute(
+            'SELECT COUNT(*) FROM posts').fetchone()[0]
+
+    def migrate_types(self, batch_size=1000):
+        """
+        The typed columns convert the values when they are inserted, so
+        there is nothing to migrate.
+        :param batch_size: Unused
+        :return: Number of converted posts, always 0
+        """
+        return 0
+
+    def post_variables(self, videoid=None, date_from=None, date_to=None):
+        """
+        Find the names of the slider values stored in the posts. See
+        DatabaseClient.post_variables() for the parameters.
+        :return: Sorted list of names
+        """
+        where, params = self._build_where(videoid, date_from=date_from,
+                                          date_to=date_to)
+        rows = self._connection().execute(
+            'SELECT DISTINCT v.variable FROM posts p '
+            'JOIN post_values v ON v.post_id = p.id WHERE ' + where +
+            ' ORDER BY v.variable', params)
+        return [row[0] for row in rows]
+
+    def has_untyped(self, field):
+        """
+        Check whether a field of some posts is stored as text. The typed
+        columns convert the values when they are inserted, so only values
+        that are not numbers are text.
+        :param field: 'timestamp' or 'date'
+        :return: Boolean
+        """
+        return self._connection().execute(
+            'SELECT 1 FROM posts WHERE typeof(' + SORT_COLUMNS[field] +
+            ") = 'text' LIMIT 1").fetchone() is not None
+
+    def collect_posts(self):
+        """
+        Collect all entries from the database.
+        :return: Contents of the database
+        """
+        return self._select_posts('1', [], None, with_id=True)
+
+    def query_posts(self, videoid=None, username=None, start=None, end=None,
+                    variable=None, sort=True, date_from=None, date_to=None,
+                    batch_size=None):
+        """
+        Collect the entries matching the given filters. See
+        DatabaseClient.query_posts() for the parameters.
+        :return: Iterator over the matching posts (without '_id')
+        """
+        where, params = self._build_where(videoid, username, start, end,
+                                          date_from, date_to)
+        if sort is True:
+            sort = ['username', 'timestamp']
+        order = ', '.join(SORT_COLUMNS[f] for f in sort or [])
+        return self._select_posts(where, params, order, variable)
+
+    def page_posts(self, videoid=None, username=None, start=None, end=None,
+                   sort_field='_id', descending=False, after=None,
+                   limit=100):
+        """
+        Collect one page of posts, using keyset pagination. See
+        DatabaseClient.page_posts() for the parameters.
+        :return: List of posts on the page, and a boolean indicating whether
+        there are more posts
+        """
+        where, params = self._build_where(videoid, username, start, end)
+        column = SORT_COLUMNS[sort_field]
+        direction = ' DESC' if descending else ''
+        op = '<' if descending else '>'
+
+        if after is not None and str(after[1]).isdigit():
+            value, last_id = after[0], int(after[1])
+            if sort_field == '_id':
+                where += ' AND id ' + op + ' ?'
+                params.append(last_id)
+            else:
+                # Compared as row value, so that the page starts with a
+                # search in the index on (column, id) instead of a scan
+                where += ' AND (' + column + ', id) ' + op + ' (?, ?)'
+                params += [value, last_id]
+
+        if sort_field == '_id':
+            order = 'id' + direction
+        else:
+            order = column + direction + ', id' + direction
+        posts = list(self._select_posts(where, params, order, limit=limit + 1,
+                                        with_id=True))
+        return posts[:limit], len(posts) > limit
+
+    def last_post_id(self, videoid):
+        """
+        Find the id of the newest post of a video.
+        :param videoid: The id of the video
+        :return: The id as string, or None if there are no posts
+        """
+        last = self._connection().execute(
+            'SELECT MAX(id) FROM posts WHERE videoid = ?',
+            (videoid,)).fetchone()[0]
+        return None if last is None else str(last)
+
+    def posts_after(self, videoid, after=None, variable=None, limit=1000,
+                    overlap=0):
+        """
+        Collect the posts of a video saved after a given post, in the order
+        they were saved. See DatabaseClient.posts_after() for the parameters.
+        The ids are assigned in the order the posts are committed, as SQLite
+        has a single writer, so no posts are returned again and overlap is
+        not used.
+        :return: List of posts, including their '_id'
+        """
+        where = 'videoid = ?'
+        params = [videoid]
+        if after is not None and str(after).isdigit():
+            where += ' AND id > ?'
+            params.append(int(after))
+        return list(self._select_posts(where, params, 'id', variable, limit,
+                                       with_id=True))
+
+    def delete_many(self, rule):
+        """
+        Delete posts according to a rule.
+        :param rule: The rule, a dictionary of standard fields and the values
+        of the posts to delete ({} deletes everything)
+        :return: None
+        """
+        if any(f not in STANDARD_FIELDS for f in rule):
+            raise ValueError('Only standard fields can be used in the rule.')
+        fields = sorted(rule)
+        where = ' AND '.join(f + ' = ?' for f in fields) or '1'
+        params = [rule[f] for f in fields]
+        connection = self._connection()
+        with connection:
+            connection.execute('DELETE FROM post_values WHERE post_id IN '
+                               '(SELECT id FROM posts WHERE ' + where + ')',
+                               params)
+            connection.execute('DELETE FROM posts WHERE ' + where, params)
@@ -1,11 +1,74 @@
+// Samples are buffered on the client and sent to the server in batches,
+// either when the buffer is full, after a while, or when the page is left.
+const BATCH_SIZE = 20;
+const BATCH_INTERVAL = 2000; // milliseconds
+let sampleBuffer = [];
+let flushTimer = null;
+
+function flushSamples(useBeacon) {
+  if (flushTimer !== null) {
+    clearTimeout(flushTimer);
+    flushTimer = null;
+  }
+  if (sampleBuffer.length === 0) {
+    return;
+  }
+  let samples = sampleBuffer;
+  let payload = JSON.stringify({'samples': samples});
+  sampleBuffer = [];
+  if (useBeacon && navigator.sendBeacon) {
+    navigator.sendBeacon("/save_batch",
+      new Blob([payload], {type: 'application/json'}));
+  }
+  else {
+    $.ajax({url: "/save_batch", type: "POST", data: payload,
+      contentType: "application/json"})
+      .done(function (data, status, xhr) {
+        // Invalid samples are not saved, sending them again does not help.
+        if (xhr.status === 207) {
+          console.warn('Samples not saved:', data.rejected);
+        }
+        else {
+          console.log(data);
+        }
+      })
+      .fail(function (xhr) {
+        // The server is busy, keep the samples and try again later.
+        if (xhr.status === 503) {
+          sampleBuffer = samples.concat(sampleBuffer);
+          let retry = parseInt(xhr.getResponseHeader('Retry-After')) || 1;
+          if (flushTimer === null) {
+            flushTimer = setTimeout(function () { flushSamples(false); },
+              retry * 1000);
+          }
+        }
+      });
+  }
+}
+
+function bufferSample(sample) {
+  sampleBuffer.push(sample);
+  if (sampleBuffer.length >= BATCH_SIZE) {
+    flushSamples(false);
+  }
+  else if (flushTimer === null) {
+    flushTimer = setTimeout(function () { flushSamples(false); },
+      BATCH_INTERVAL);
+  }
+}
+
+window.addEventListener('pagehide', function () { flushSamples(true); });
+document.addEventListener('visibilitychange', function () {
+  if (document.visibilityState === 'hidden') {
+    flushSamples(true);
+  }
+});
+
 function sendData(tstamp, values, names, vId) {
   let epoch = + new Date();
   if (tstamp > 0 && values !== null && vId !== null) {
-    $.post("/save", {'timestamp': tstamp, 'values': JSON.stringify(values),
-    'names': JSON.stringify(names), 'videoid': vId , 'date': epoch})
-      .done(function (data) {
-        console.log(data);
-      });
+    bufferSample({'timestamp': tstamp, 'values': values, 'names': names,
+      'videoid': String(vId), 'date': epoch});
   }
   else {
     console.log("no sufficient information given");
@@ -15,10 +78,8 @@ function sendData(tstamp, values, names, vId) {
 function sendData2D(tstamp, v1, v2, vId) {
   let epoch = + new Date();
   if (tstamp > 0 && v1 !== null && v2 !== null && vId !== null) {
-    $.post("/save2D", { "timestamp": tstamp, "value": v1, "value2": v2, "videoid": vId , "date": epoch})
-      .done(function (data) {
-        console.log(data);
-      });
+    bufferSample({'timestamp': tstamp, 'values': [v1, v2],
+      'names': ['value', 'value2'], 'videoid': String(vId), 'date': epoch});
   }
   else {
     console.log("no sufficient information given");
@@ -57,8 +57,7 @@ def userinstructions():
     """
     check_access_right(forbidden='', redirect_url='control.index')
 
-    with open(current_app.user_instructions_file, 'r') as f:
-        instructions = f.read()
+    instructions = current_app.user_instructions_store.read()
 
     return render_template('user/userinstructions.html',
                            instructions=instructions)
@@ -0,0 +1,7 @@
+"""
+This package contains benchmarks for the analysis functions of the app.
+Run them from the root of the repository, e.g.
+python -m benchmarks.interpolators
+python -m benchmarks.analytics
+python -m benchmarks.startup
+"""
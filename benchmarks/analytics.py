@@ -0,0 +1,256 @@
+"""
+Benchmark of the analysis paths of the app on synthetic annotations: loading
+the data, preparing the dataframe, resampling, k-means, rendering the chart
+and clusters pages (including Bokeh's components()) and the csv export.
+
+The data is written to an embedded SQLite database in a temporary file by
+default, or to the local MongoDB (only the generated posts are deleted
+afterwards). The timings are written as JSON, and can be compared with the
+output of an earlier run.
+
+Run from the root of the repository:
+python -m benchmarks.analytics --videos 3 --users 50 --samples 500
+python -m benchmarks.analytics --compare old_results.json
+
+The results of runs on one core against SQLite are kept in results/ (Python
+3.11, numpy 1.26, pandas 1.5, bokeh 2.4, tslearn 0.6). Medians of 3 runs:
+
+    stage                    3 x 50 x 500   3 x 200 x 1000
+    insert                       1.57 s         22.83 s
+    collect_mongodbobjects       0.43 s          3.69 s
+    sort_df                      0.05 s          0.47 s
+    extract_variable             0.00 s          0.02 s
+    get_interpolators            0.06 s          0.24 s
+    resample                     0.01 s          0.04 s
+    kmeans                       0.14 s          0.45 s
+    chart_page                   0.51 s          1.36 s
+    clusters_page                1.55 s          5.43 s
+    export_all                   0.72 s          4.50 s
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from app import create_app
+from app.cache import LRUCache
+from app.config import Config
+from app.functionalities import collect_mongodbobjects, sort_df, \
+    extract_variable, get_interpolators, get_videos
+from app.researcher.routes import compute_clusters
+from benchmarks.generator import generate_posts
+
+
+def git_commit():
+    """
+    :return: The current git commit, or None if it cannot be found
+    """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode(
+            ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def summary(seconds):
+    """
+    :param seconds: List of the durations of the repetitions of a stage
+    :return: Dictionary with the minimum, median and mean duration and all
+    durations
+    """
+    return {'min': min(seconds), 'median': float(np.median(seconds)),
+            'mean': float(np.mean(seconds)), 'runs': seconds}
+
+
+def get(client, url):
+    """
+    Request a page, so that a failing page is not timed as if it worked.
+    :param client: The test client
+    :param url: The url of the page
+    :return: The response
+    """
+    response = client.get(url)
+    if response.status_code != 200:
+        raise RuntimeError('{} returned {}.'.format(url,
+                                                    response.status_code))
+    return response
+
+
+def wait_for_clusters(client, url, timeout=600):
+    """
+    Request the clusters page until the clustering jobs have finished.
+    :param client: The test client
+    :param url: The url of the page
+    :param timeout: Seconds to wait at most
+    :return: None
+    """
+    start = time.time()
+    while b'being computed' in get(client, url).data:
+        if time.time() - start > timeout:
+            raise RuntimeError('The clustering did not finish in time.')
+        time.sleep(0.2)
+
+
+def run(args):
+    """
+    Generate the data and time every stage.
+    :param args: The parsed command line arguments
+    :return: Dictionary with the parameters and the timings
+    """
+    sqlite_path = None
+    if args.db == 'sqlite':
+        fd, sqlite_path = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+
+    class BenchmarkConfig(Config):
+        DB = args.db
+        SQLITE_PATH = sqlite_path
+        CACHE = LRUCache()
+
+    app = create_app(BenchmarkConfig)
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['role'] = 'researcher'
+
+    vid_dict, _ = get_videos()
+    videoids = sorted(vid_dict)[:args.videos]
+    two_d = videoids[1::2] if args.two_d else []
+    posts = list(generate_posts(videoids, args.users, args.samples, two_d,
+                                args.seed))
+
+    timings = {}
+    try:
+        start = time.perf_counter()
+        for i in range(0, len(posts), 1000):
+            # Copies, as MongoDB adds the _id to the posts
+            app.d.insert_posts([dict(p) for p in posts[i:i + 1000]])
+        timings['insert'] = summary([time.perf_counter() - start])
+
+        stages = ['collect_mongodbobjects', 'sort_df', 'extract_variable',
+                  'get_interpolators', 'resample', 'kmeans', 'chart_page',
+                  'clusters_page', 'export_all']
+        runs = dict((stage, []) for stage in stages)
+
+        def timed(stage, function, *function_args):
+            start = time.perf_counter()
+            result = function(*function_args)
+            runs[stage][-1] += time.perf_counter() - start
+            return result
+
+        for repetition in range(args.repeat):
+            for stage in stages:
+                runs[stage].append(0.0)
+            for videoid in videoids:
+                _, df = timed('collect_mongodbobjects',
+                              collect_mongodbobjects, videoid)
+                raw = pd.DataFrame(list(app.d.query_posts(videoid=videoid,
+                                                          sort=False)))
+                timed('sort_df', sort_df, raw)
+                data, variable, _ = timed('extract_variable',
+                                          extract_variable, df, None)
+                interpolators, max_t = timed('get_interpolators',
+                                             get_interpolators, data,
+                                             variable)
+                xs = np.arange(0, int(max_t) + 1, 1)
+                matrix = timed('resample',
+                               lambda: np.vstack([f(xs) for f in
+                                                  interpolators]))
+                timed('kmeans', compute_clusters, matrix, args.clusters,
+                      args.seed)
+
+                # The pages are timed with the data already resampled and
+                # clustered, so that these timings show the plotting
+                chart_url = '/chart?vid=' + videoid
+                clusters_url = '/clusters?vid={}&cluster={}'.format(
+                    videoid, args.clusters)
+                if repetition == 0:
+                    get(client, chart_url)
+                    wait_for_clusters(client, clusters_url)
+                timed('chart_page', get, client, chart_url)
+                timed('clusters_page', get, client, clusters_url)
+            timed('export_all', lambda: len(get(client, '/export_all').data))
+
+        for stage in stages:
+            timings[stage] = summary(runs[stage])
+    finally:
+        for username in set(p['username'] for p in posts):
+            app.d.delete_many({'username': username})
+        if sqlite_path is not None:
+            for suffix in ['', '-wal', '-shm']:
+                if os.path.exists(sqlite_path + suffix):
+                    os.remove(sqlite_path + suffix)
+
+    return {'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'numpy': np.__version__, 'pandas': pd.__version__,
+            'parameters': {'db': args.db, 'videos': len(videoids),
+                           'users': args.users, 'samples': args.samples,
+                           'two_d': args.two_d, 'clusters': args.clusters,
+                           'repeat': args.repeat, 'seed': args.seed},
+            'posts': len(posts),
+            'timings': timings}
+
+
+def print_results(results, previous=None):
+    """
+    Print the median duration of every stage, and the ratio to the median
+    of a previous run if given.
+    :param results: The results of this run
+    :param previous: The results of a previous run (optional)
+    :return: None
+    """
+    print('{} posts, parameters: {}'.format(results['posts'],
+                                            results['parameters']))
+    for stage, timing in results['timings'].items():
+        line = '{:24} {:9.3f} s'.format(stage, timing['median'])
+        if previous is not None and stage in previous['timings']:
+            old = previous['timings'][stage]['median']
+            line += '   previous {:9.3f} s   ratio {:.2f}'.format(
+                old, timing['median'] / old if old else float('nan'))
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--db', choices=['sqlite', 'local'], default='sqlite',
+                        help='Database to run against')
+    parser.add_argument('--videos', type=int, default=3,
+                        help='Number of videos (at most the number of '
+                             'configured videos)')
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--samples', type=int, default=500,
+                        help='Number of posts per user and video')
+    parser.add_argument('--two-d', action='store_true',
+                        help='Annotate every second video with a 2D slider')
+    parser.add_argument('--clusters', type=int, default=3)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmark_results.json',
+                        help='File the results are written to as JSON')
+    parser.add_argument('--compare',
+                        help='Results of an earlier run to compare with')
+    args = parser.parse_args()
+
+    results = run(args)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+    print_results(results, previous)
+
+
+if __name__ == '__main__':
+    main()
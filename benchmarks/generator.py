@@ -0,0 +1,48 @@
+"""
+Generator of synthetic annotation posts, shaped and typed like the posts
+the save routes store: every user watches every video and moves the
+slider(s) at irregular times, each movement being saved with the video
+timestamp.
+"""
+
+import time
+
+import numpy as np
+
+
+def generate_posts(videoids, n_users, n_samples, two_d=(), seed=0):
+    """
+    Generate annotation posts.
+    :param videoids: The ids of the videos
+    :param n_users: Number of users annotating every video
+    :param n_samples: Number of posts per user and video
+    :param two_d: Ids of the videos annotated with a 2D slider (posting
+    'value' and 'value2'), the others are annotated with a 1D slider
+    (posting 'Valence')
+    :param seed: Random seed
+    :return: Generator of posts, one video and user after the other
+    """
+    rng = np.random.RandomState(seed)
+    now = int(time.time() * 1000)
+    for videoid in videoids:
+        names = ['value', 'value2'] if videoid in two_d else ['Valence']
+        for user in range(n_users):
+            username = 'bench-user-' + str(user)
+            # Users move the slider in bursts: mostly short, sometimes long
+            # pauses between two saved values
+            steps = rng.exponential(0.5, n_samples) + \
+                    rng.binomial(1, 0.05, n_samples) * \
+                    rng.exponential(10, n_samples) + 0.01
+            timestamps = np.cumsum(steps)
+            # The values wander around like a slider that is dragged
+            values = np.clip(np.cumsum(rng.normal(0, 5, (len(names),
+                                                         n_samples)),
+                                       axis=1), -50, 50)
+            dates = now + (timestamps * 1000).astype(int)
+            for i in range(n_samples):
+                post = {'videoid': videoid, 'username': username,
+                        'timestamp': round(float(timestamps[i]), 3),
+                        'date': int(dates[i])}
+                for name, v in zip(names, values[:, i]):
+                    post[name] = round(float(v), 2)
+                yield post
@@ -0,0 +1,107 @@
+"""
+Benchmark of splitting the data by user and creating the interpolators,
+comparing get_interpolators() with the previous implementation that grouped
+with groupby() and converted every value separately.
+
+Run from the root of the repository:
+python -m benchmarks.interpolators --users 10000 --points 1000
+
+Measured on one core (Python 3.11, numpy 2.4, pandas 3.0, scipy 1.17):
+
+    users x points    get_interpolators   previous   speedup
+     1000 x 1000            1.02 s          2.02 s      2.0x
+    10000 x 1000           10.17 s         20.72 s      2.0x
+
+Most of the remaining time is spent constructing one PchipInterpolator per
+user, which both versions do.
+"""
+
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+from scipy.interpolate import PchipInterpolator
+
+from app.functionalities import get_interpolators
+
+
+def make_frame(n_users, n_points, seed=0):
+    """
+    Create a dataframe like the one collect_mongodbobjects() returns, with
+    irregular timestamps.
+    :param n_users: Number of users
+    :param n_points: Number of observations per user
+    :param seed: Random seed
+    :return: Dataframe
+    """
+    rng = np.random.RandomState(seed)
+    steps = rng.exponential(1., size=(n_users, n_points)) + 0.01
+    timestamps = np.cumsum(steps, axis=1).ravel()
+    values = rng.uniform(-50, 50, size=n_users * n_points)
+    usernames = np.repeat(['user' + str(i) for i in range(n_users)], n_points)
+    return pd.DataFrame({'videoid': '65107797', 'username': usernames,
+                         'timestamp': timestamps, 'Valence': values})
+
+
+def legacy_get_interpolators(df, currentVariable):
+    """
+    The implementation of get_interpolators() before it was vectorized.
+    """
+    grouped_data = df.groupby('username')
+    data_by_user = [user for _, user in grouped_data]
+    ts = [np.array(t) for t in
+          (data_by_user[i]['timestamp'].apply(lambda x: float(x)) for i in
+           range(len(data_by_user)))]
+    vals = [np.array(val) for val in
+            (data_by_user[i][currentVariable].apply(lambda x: float(x)) for i in
+             range(len(data_by_user)))]
+
+    max_t = max([max(t) for t in ts])
+    total = np.sum([np.sum(v) for v in vals])
+    avg = total / np.sum([len(v) for v in vals])
+    for i in range(len(ts)):
+        if min(ts[i]) != 0:
+            ts[i] = np.append([0], ts[i])
+            vals[i] = np.append([avg], vals[i])
+        if max(ts[i]) != max_t:
+            ts[i] = np.append(ts[i], [max_t])
+            vals[i] = np.append(vals[i], [avg])
+        ts[i] = np.append(ts[i][:-1], int(ts[i][-1]) + 1)
+
+    interpolators = [PchipInterpolator(t, val) for (t, val) in zip(ts, vals)]
+    return interpolators, max_t
+
+
+def timed(function, *args):
+    """
+    :return: Result of function(*args) and the seconds it took
+    """
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--points', type=int, default=1000)
+    args = parser.parse_args()
+
+    df = make_frame(args.users, args.points)
+    print('{} users x {} points'.format(args.users, args.points))
+
+    (new, new_max_t), new_time = timed(get_interpolators, df, 'Valence')
+    print('get_interpolators:        {:.2f} s'.format(new_time))
+    (old, old_max_t), old_time = timed(legacy_get_interpolators, df,
+                                       'Valence')
+    print('legacy get_interpolators: {:.2f} s'.format(old_time))
+    print('speedup:                  {:.1f}x'.format(old_time / new_time))
+
+    xs = np.arange(0, int(new_max_t) + 1.5, 1)
+    assert new_max_t == old_max_t
+    assert all(np.allclose(a(xs), b(xs)) for a, b in zip(new[:10], old[:10]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""
+Import-time budget of the app: measures in fresh processes how long
+importing the app and calling create_app() takes and how much memory the
+process uses afterwards, and checks that the analytics stack (pandas, scipy,
+bokeh, tslearn, scikit-learn) is not loaded at start-up. Exits with status 1
+if the budget is exceeded, so it can be used as a check in CI.
+
+Run from the root of the repository:
+python -m benchmarks.startup --budget 2.0
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+
+# Modules that must only be imported when the analysis is used:
+ANALYTICS_MODULES = ['pandas', 'scipy', 'bokeh', 'tslearn', 'sklearn']
+
+MEASURE = """
+import json, resource, sys, time
+start = time.perf_counter()
+from app import create_app
+create_app()
+seconds = time.perf_counter() - start
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps({'seconds': seconds,
+                  'max_rss_mb': rss / (1024. ** 2 if sys.platform == 'darwin'
+                                       else 1024.),
+                  'modules': sorted(m for m in %r if m in sys.modules)}))
+""" % (ANALYTICS_MODULES,)
+
+
+def measure():
+    """
+    Start the app in a new process.
+    :return: Dictionary with the seconds create_app() took (including the
+    imports), the maximum resident memory in MB and the analytics modules
+    that were loaded
+    """
+    output = subprocess.check_output([sys.executable, '-c', MEASURE])
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--budget', type=float, default=2.0,
+                        help='Maximum seconds for importing and creating '
+                             'the app')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Number of processes started, the fastest one '
+                             'counts')
+    parser.add_argument('--output', help='File the results are written to '
+                                         'as JSON (optional)')
+    args = parser.parse_args()
+
+    runs = [measure() for _ in range(args.repeat)]
+    best = min(runs, key=lambda r: r['seconds'])
+    results = {'budget': args.budget, 'seconds': best['seconds'],
+               'max_rss_mb': best['max_rss_mb'],
+               'analytics_modules_loaded': best['modules'],
+               'runs': runs}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    print('create_app(): {:.3f} s (budget {:.3f} s), {:.0f} MB'.format(
+        best['seconds'], args.budget, best['max_rss_mb']))
+    failed = False
+    if best['seconds'] > args.budget:
+        print('Start-up is over budget.')
+        failed = True
+    if best['modules']:
+        print('Loaded at start-up: ' + ', '.join(best['modules']))
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,16 @@
+"""
+Settings of gunicorn, taking the number of worker processes and threads from
+the profile the app runs with (APP_PROFILE, see PROFILES in app/config.py)
+unless WORKERS or THREADS are set:
+
+gunicorn -c gunicorn_conf.py video_annotator:app
+"""
+
+from app.config import Config, apply_profile
+
+_settings = {'WORKERS': Config.WORKERS, 'THREADS': Config.THREADS,
+             'CLUSTER_WORKERS': Config.CLUSTER_WORKERS}
+apply_profile(_settings, Config.PROFILE)
+
+workers = _settings['WORKERS']
+threads = _settings['THREADS']